@@ -47,11 +47,13 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'forum.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'forum.middleware.RoleCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -94,6 +96,23 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+# forum's roles and pages data are cached here: use a backend shared by all processes (e.g. file based or redis) when
+# running more than one worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': config.get('cache', 'BACKEND', fallback='') or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': config.get('cache', 'LOCATION', fallback=''),
+    }
+}
+
+# when true, board and thread pages of users who don't moderate any board are cached for PAGE_CACHE_TIMEOUT seconds
+# at most (see forum.pagecache)
+PAGE_CACHE = config.get('cache', 'PAGE_CACHE', fallback='').lower() == 'true'
+PAGE_CACHE_TIMEOUT = config.getint('cache', 'PAGE_CACHE_TIMEOUT', fallback=300)
+
 MEDIA_ROOT = os.path.join(BASE_DIR, 'djangle', 'static', 'djangle', 'images')
 MEDIA_URL = '/media/'
 
@@ -138,11 +157,38 @@ DEFAULT_FROM_EMAIL = config.get('email', 'DEFAULT_FROM_EMAIL')
 
 EMAIL_SUBJECT_PREFIX = '[Djangle] '
 
+# use django.core.mail.backends.filebased.EmailBackend and EMAIL_FILE_PATH to write mails to files instead of sending
+EMAIL_BACKEND = config.get('email', 'EMAIL_BACKEND', fallback='') or 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_FILE_PATH = config.get('email', 'EMAIL_FILE_PATH', fallback='') or None
+
+# notifications are queued and sent by the flush_mail periodic task, MAIL_BATCH_SIZE at a time over one connection.
+# failed deliveries are retried after MAIL_RETRY_DELAY seconds, doubling the delay each time, up to MAIL_MAX_ATTEMPTS
+MAIL_BATCH_SIZE = config.getint('email', 'MAIL_BATCH_SIZE', fallback=100)
+MAIL_RETRY_DELAY = 60
+MAIL_MAX_ATTEMPTS = 5
+
 
 ELEM_PER_PAGE = 20
 
+# when true, votes are logged and added to posts' counters and users' reputation by the fold_votes periodic task
+ASYNC_VOTES = config.get('votes', 'ASYNC', fallback='').lower() == 'true'
+
+# when true, a task removing each temporary ban is scheduled at its expiration date, instead of waiting for check_ban
+BAN_EXPIRY_ETA = config.get('bans', 'EXPIRY_ETA', fallback='').lower() == 'true'
+
+# when true, queries, database time, template time, total time and response size of each view are measured and written
+# to INSTRUMENTATION_CSV every INSTRUMENTATION_FLUSH_INTERVAL seconds (see forum.instrumentation)
+INSTRUMENTATION = config.get('instrumentation', 'ENABLED', fallback='').lower() == 'true'
+INSTRUMENTATION_CSV = config.get('instrumentation', 'CSV', fallback='') or os.path.join(BASE_DIR, 'view_stats.csv')
+INSTRUMENTATION_FLUSH_INTERVAL = config.getint('instrumentation', 'FLUSH_INTERVAL', fallback=60)
+
 BROKER_URL = 'django://'
 
+# tasks receive primary keys and snapshots of the fields they need (see forum.payloads), never pickled model instances
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json']
+
 CELERYBEAT_SCHEDULE = {
     'async_subscriptions': {
         'task': 'forum.tasks.async_mail',
@@ -151,5 +197,13 @@ CELERYBEAT_SCHEDULE = {
     'check_ban': {
         'task': 'forum.tasks.check_ban',
         'schedule': timedelta(hours=6)
+    },
+    'fold_votes': {
+        'task': 'forum.tasks.fold_votes',
+        'schedule': timedelta(minutes=1),
+    },
+    'flush_mail': {
+        'task': 'forum.tasks.flush_mail',
+        'schedule': timedelta(seconds=30),
     }
 }
@@ -3,7 +3,8 @@ from django.contrib.admin.widgets import AdminFileWidget
 from django.contrib.auth.hashers import make_password
 from django.utils.safestring import mark_safe
 from djangle.settings import MEDIA_URL
-from .models import User, Post, Thread, Board, Subscription, Moderation, Ban, Comment
+from . import search
+from .models import User, Post, Thread, Board, Subscription, Moderation, Ban, Comment, Tag, QueuedMail
 
 # Register your models here.
 
@@ -53,7 +54,8 @@ class UserAdmin(admin.ModelAdmin):
         """
         given a model instance, save it to the database
 
-        saves model instance to the database. If password was changed, hashes it before saving
+        saves model instance to the database. If password was changed, hashes it before saving. If avatar was changed,
+        records if its file exists and makes its resized variants
 
         :param request: the HttpRequest
         :param obj: User instance
@@ -67,6 +69,9 @@ class UserAdmin(admin.ModelAdmin):
         if not change or user.password != obj.password:
             obj.password = make_password(obj.password)
         obj.save()
+        if 'avatar' in form.changed_data:
+            obj.record_avatar()
+            obj.save(update_fields=['has_avatar', 'avatar_hash'])
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -81,6 +86,21 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ['pub_date']
     search_fields = ['message']
 
+    def save_model(self, request, obj, form, change):
+        """
+        given a model instance, save it to the database
+
+        saves model instance to the database and updates the search index with post's message
+
+        :param request: the HttpRequest
+        :param obj: Post instance
+        :param form: ModelForm instance
+        :param change: boolean value based on whether it is adding or changing the object
+        :return: nothing
+        """
+        obj.save()
+        search.reindex_post(obj)
+
 
 class ThreadAdmin(admin.ModelAdmin):
     """
@@ -125,7 +145,8 @@ class ThreadAdmin(admin.ModelAdmin):
         """
         given a model instance, save it to the database
 
-        saves model instance to the database. Automatically update first_post field.
+        saves model instance to the database. Automatically update first_post field, thread's tags and the search
+        index with thread's title, tags and author.
 
         :param request: the HttpRequest
         :param obj: Thread instance
@@ -137,6 +158,8 @@ class ThreadAdmin(admin.ModelAdmin):
             post = obj.post_set.first()
             obj.first_post = post
         obj.save()
+        obj.update_tags()
+        search.reindex_thread(obj)
 
 
 class BoardAdmin(admin.ModelAdmin):
@@ -228,6 +251,24 @@ class CommentAdmin(admin.ModelAdmin):
     search_fields = ['message']
 
 
+class TagAdmin(admin.ModelAdmin):
+    """
+    representation of Tag model in the admin interface
+    """
+    readonly_fields = ['thread_count']
+    list_display = ['name', 'thread_count']
+    search_fields = ['name']
+
+
+class QueuedMailAdmin(admin.ModelAdmin):
+    """
+    representation of QueuedMail model in the admin interface
+    """
+    list_display = ['subject', 'recipients', 'attempts', 'next_try']
+    list_filter = ['attempts']
+    search_fields = ['subject', 'recipients']
+
+
 admin.site.register(User, UserAdmin)
 admin.site.register(Post, PostAdmin)
 admin.site.register(Thread, ThreadAdmin)
@@ -236,3 +277,5 @@ admin.site.register(Subscription, SubscriptionAdmin)
 admin.site.register(Moderation, ModerationAdmin)
 admin.site.register(Ban, BanAdmin)
 admin.site.register(Comment, CommentAdmin)
+admin.site.register(Tag, TagAdmin)
+admin.site.register(QueuedMail, QueuedMailAdmin)
@@ -0,0 +1,259 @@
+"""
+module for users' avatars
+
+checking that an avatar's file exists on every rendered avatar is expensive (thread pages show one for each post and
+comment), so existence is recorded on user's row (User.has_avatar) when the avatar is saved or reset, and templates
+resolve avatars with the avatar_img tag (see forum.templatetags.forum_extra), which never touches the filesystem: users
+without a recorded avatar get the default picture. urls are built by the storage once per file and kept in a bounded
+lru cache of the process.
+
+uploaded avatars are also resized to a few variants, one for each size pages show them at (see VARIANTS), encoded as
+JPEG and as WebP when Pillow supports it. variants are stored alongside the original avatar and their names contain the
+hash of the original's content (User.avatar_hash), so they never change and browsers can cache them forever.
+"""
+import hashlib
+import os
+from functools import lru_cache
+from io import BytesIO
+from PIL import Image, ImageOps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+DEFAULT_AVATAR = os.path.join('prof_pic', 'Djangle_user_default.png')
+
+CACHE_SIZE = 1024
+"""
+maximum number of avatars' urls kept in memory, least recently used are evicted first
+"""
+
+VARIANTS = {
+    'small': (60, True),
+    'thumbnail': (140, True),
+    'profile': (400, False),
+}
+"""
+variants of avatars, mapping names to (size, crop) couples. size is twice the css size pages show the variant at, so
+that it's sharp on high density screens. cropped variants are square, the others keep original's proportions and fit
+in a size x size box
+"""
+
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+MAX_PIXELS = 4096 * 4096
+"""
+maximum number of pixels of avatars to resize: avatars are limited to 200 KB, but a compressed image can still decode
+to a huge bitmap
+"""
+
+UNREADABLE = (IOError, OSError, SyntaxError, ValueError, getattr(Image, 'DecompressionBombError', ValueError))
+"""
+errors raised by Pillow for files which can't be decoded (DecompressionBombError doesn't exist in old versions)
+"""
+
+ORIENTATION = 0x0112
+"""
+exif tag of the orientation the camera was held at
+"""
+
+TRANSPOSITIONS = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.FLIP_LEFT_RIGHT, Image.ROTATE_90),
+    6: (Image.ROTATE_270,),
+    7: (Image.FLIP_LEFT_RIGHT, Image.ROTATE_270),
+    8: (Image.ROTATE_90,),
+}
+"""
+transpositions making images upright, for each exif orientation. variants are saved without exif, so browsers show
+them as they are stored
+"""
+
+
+def is_default(name):
+    """
+    check if an avatar is the default picture
+
+    :param name: avatar's file name
+    :return: True if name is empty or refers to the default picture, else False
+    """
+    return not name or name.endswith('Djangle_user_default.png')
+
+
+def exists(name):
+    """
+    check on the storage if an avatar's file exists
+
+    this is meant to be called when the avatar changes, not while serving pages
+
+    :param name: avatar's file name
+    :return: True if the avatar is not the default picture and its file exists, else False
+    """
+    return not is_default(name) and default_storage.exists(name)
+
+
+@lru_cache(maxsize=None)
+def webp_supported():
+    """
+    check if Pillow can encode WebP images
+
+    :return: True if WebP variants are made, else False
+    """
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def variant_name(name, digest, variant, extension):
+    """
+    build the file name of an avatar's variant
+
+    :param name: original avatar's file name
+    :param digest: hash of original avatar's content
+    :param variant: name of the variant (see VARIANTS)
+    :param extension: 'jpg' or 'webp'
+    :return: variant's file name
+    """
+    return '%s.%s.%s.%s' % (os.path.splitext(name)[0], digest, variant, extension)
+
+
+def _orientation(image):
+    # exif is read from the file's header, before pixels are decoded
+    getexif = getattr(image, 'getexif', None) or getattr(image, '_getexif', None)
+    try:
+        exif = getexif() if getexif is not None else None
+    except Exception:
+        exif = None
+    return (exif or {}).get(ORIENTATION, 1)
+
+
+def _scaled(size, shortest):
+    factor = float(shortest) / min(size)
+    return max(1, int(round(size[0] * factor))), max(1, int(round(size[1] * factor)))
+
+
+def _prepare(image):
+    """
+    decode an avatar at a reduced size, upright, in RGBA mode
+
+    the image is downscaled before converting it, so that big images are never converted at full size: its shortest
+    side is kept at least as long as the biggest variant
+
+    :param image: opened image, not loaded yet
+    :return: prepared image
+    """
+    largest = max(size for size, crop in VARIANTS.values())
+    orientation = _orientation(image)
+    # JPEG images are decoded directly at a reduced scale
+    image.draft('RGB', (largest, largest))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        if min(image.size) > 2 * largest:
+            # palette images can't be resized smoothly: sample them down to twice the needed size before converting
+            image = image.resize(_scaled(image.size, 2 * largest), Image.NEAREST)
+        image = image.convert('RGBA')
+    if min(image.size) > largest:
+        image = image.resize(_scaled(image.size, largest), Image.LANCZOS)
+    for method in TRANSPOSITIONS.get(orientation, ()):
+        image = image.transpose(method)
+    return image.convert('RGBA')
+
+
+def _resize(image, size, crop):
+    if crop:
+        return ImageOps.fit(image, (size, size), Image.LANCZOS)
+    image = image.copy()
+    image.thumbnail((size, size), Image.LANCZOS)
+    return image
+
+
+def _encode(image, image_format, **options):
+    output = BytesIO()
+    image.save(output, image_format, **options)
+    return ContentFile(output.getvalue())
+
+
+def make_variants(name):
+    """
+    resize an avatar to its variants and store them
+
+    variants already stored are not written again. images bigger than MAX_PIXELS are not resized
+
+    :param name: avatar's file name
+    :return: hash of avatar's content, empty string if avatar is the default picture or can't be read as an image
+    """
+    if is_default(name):
+        return ''
+    try:
+        with default_storage.open(name, 'rb') as avatar_file:
+            content = avatar_file.read()
+        image = Image.open(BytesIO(content))
+        if image.size[0] * image.size[1] > MAX_PIXELS:
+            return ''
+        image = _prepare(image)
+    except UNREADABLE:
+        return ''
+    digest = hashlib.sha1(content).hexdigest()[:16]
+    for variant, (size, crop) in VARIANTS.items():
+        resized = _resize(image, size, crop)
+        jpeg_name = variant_name(name, digest, variant, 'jpg')
+        if not default_storage.exists(jpeg_name):
+            # JPEG has no transparency, transparent pixels are shown on white
+            flat = Image.new('RGB', resized.size, (255, 255, 255))
+            flat.paste(resized, mask=resized.split()[3])
+            default_storage.save(jpeg_name, _encode(flat, 'JPEG', quality=JPEG_QUALITY, optimize=True))
+        webp_name = variant_name(name, digest, variant, 'webp')
+        if webp_supported() and not default_storage.exists(webp_name):
+            default_storage.save(webp_name, _encode(resized, 'WEBP', quality=WEBP_QUALITY))
+    return digest
+
+
+def delete_variants(name, digest):
+    """
+    delete stored variants of an avatar
+
+    :param name: avatar's file name
+    :param digest: hash of avatar's content, nothing is deleted if empty
+    :return: nothing
+    """
+    if not digest:
+        return
+    for variant in VARIANTS:
+        for extension in ('jpg', 'webp'):
+            default_storage.delete(variant_name(name, digest, variant, extension))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _url(name):
+    return default_storage.url(name)
+
+
+def url(user):
+    """
+    return the url of user's avatar
+
+    :param user: the user
+    :return: url of user's avatar if recorded as existing, else url of the default picture
+    """
+    name = user.avatar.name
+    if user.has_avatar and not is_default(name):
+        return _url(name)
+    return _url(DEFAULT_AVATAR)
+
+
+def variant_urls(user, variant):
+    """
+    return the urls of a variant of user's avatar
+
+    :param user: the user
+    :param variant: name of the variant (see VARIANTS)
+    :return: (JPEG url, WebP url) couple. WebP url is None if WebP is not supported, both are None if user's avatar
+    has no variants (e.g. the default picture)
+    """
+    name = user.avatar.name
+    if not user.has_avatar or not user.avatar_hash or is_default(name) or variant not in VARIANTS:
+        return None, None
+    webp = None
+    if webp_supported():
+        webp = _url(variant_name(name, user.avatar_hash, variant, 'webp'))
+    return _url(variant_name(name, user.avatar_hash, variant, 'jpg')), webp
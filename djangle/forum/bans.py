@@ -0,0 +1,42 @@
+"""
+module for banned users cache
+
+ban status is checked for users shown in forum pages, so the ids of all currently banned users are kept in the cache
+(see CACHES in djangle.settings) as a single set. the set depends on the 'bans' version (see forum.caching), which is
+bumped whenever a ban is created, changed or removed, and its entry expires when the first temporary ban expires, so
+checks never need the database.
+"""
+import math
+from django.core.cache import cache
+from django.utils import timezone
+from .caching import versioned_key, bump_version
+
+
+def invalidate():
+    """
+    invalidate cached banned users
+
+    :return: nothing
+    """
+    bump_version('bans')
+
+
+def banned_ids():
+    """
+    return ids of currently banned users
+
+    :return: frozenset of users' primary keys
+    """
+    from .models import Ban
+    key = versioned_key('banned', 'bans')
+    ids = cache.get(key)
+    if ids is None:
+        now = timezone.now()
+        active = list(Ban.active(now).values_list('user', 'expires_at'))
+        ids = frozenset(user for user, expires_at in active)
+        expiries = [expires_at for user, expires_at in active if expires_at is not None]
+        timeout = None
+        if expiries:
+            timeout = max(int(math.ceil((min(expiries) - now).total_seconds())), 1)
+        cache.set(key, ids, timeout)
+    return ids
@@ -0,0 +1,161 @@
+"""
+module for forum's benchmarks
+
+each scenario requests a forum page through django's test client, or runs a celery task in eager mode, and measures
+the number of queries, the wall time and the peak of memory allocated by python. scenarios pick their objects among
+the biggest ones of the database (e.g. the thread with most posts), so they are meant to run on a forum generated by the
+generate_forum management command. results can be saved as a baseline and later runs compared with it.
+"""
+import json
+import statistics
+import time
+import tracemalloc
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from .models import Board, Thread, User, Post, ThreadTag
+from .payloads import dump, POST
+
+RESULT_FIELDS = ('queries', 'time_ms', 'memory_kb')
+
+
+class Scenario(object):
+    """
+    a measured operation
+
+    run is called with the logged in client and must perform the operation
+    """
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+
+
+def _page(client, url, data=None):
+    response = client.post(url, data) if data is not None else client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %d' % (url, response.status_code))
+
+
+def scenarios():
+    """
+    build the list of scenarios on current database
+
+    :return: list of scenarios
+    """
+    from . import tasks
+    board = Board.objects.annotate(num=Count('thread')).order_by('-num').first()
+    thread = Thread.objects.order_by('-post_count').first()
+    author = User.objects.filter(is_active=True).order_by('-posts').first()
+    tag = ThreadTag.objects.values('tag__name').annotate(num=Count('pk')).order_by('-num').first()
+    post = Post.objects.filter(thread__subscription__async=False).order_by('-pk').first()
+    result = [Scenario('index', lambda client: _page(client, reverse('forum:index')))]
+    if board is not None:
+        result.append(Scenario('board_view', lambda client: _page(client, reverse(
+            'forum:board', kwargs={'board_code': board.code, 'page': ''}))))
+        result.append(Scenario('board_view_last_page', lambda client: _page(client, reverse(
+            'forum:board', kwargs={'board_code': board.code, 'page': 1000000}))))
+    if thread is not None:
+        result.append(Scenario('thread_view', lambda client: _page(client, reverse(
+            'forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}))))
+        result.append(Scenario('thread_view_last_page', lambda client: _page(client, reverse(
+            'forum:thread', kwargs={'thread_pk': thread.pk, 'page': 1000000}))))
+    if author is not None:
+        result.append(Scenario('profile', lambda client: _page(client, reverse(
+            'forum:profile', kwargs={'username': author.username}))))
+    result.append(Scenario('search', lambda client: _page(client, reverse('forum:search', kwargs={'page': ''}),
+                                                          {'query_title': 'django'})))
+    if tag is not None:
+        result.append(Scenario('tag_view', lambda client: _page(client, reverse(
+            'forum:tag', kwargs={'tag': tag['tag__name'], 'page': ''}))))
+    result.append(Scenario('task_async_mail', lambda client: tasks.async_mail()))
+    if post is not None:
+        result.append(Scenario('task_sync_mail', lambda client: tasks.sync_mail(dump(post, *POST))))
+    result.append(Scenario('task_check_ban', lambda client: tasks.check_ban()))
+    result.append(Scenario('task_fold_votes', lambda client: tasks.fold_votes()))
+    result.append(Scenario('task_flush_mail', lambda client: tasks.flush_mail()))
+    return result
+
+
+def measure(scenario, client, repeat):
+    """
+    run a scenario many times
+
+    :param scenario: the scenario
+    :param client: the test client
+    :param repeat: number of runs
+    :return: dictionary with queries of the last run, median wall time and peak memory
+    """
+    times = []
+    peak = 0
+    queries = 0
+    for _ in range(repeat):
+        # changes are rolled back, so that every run finds the same data
+        with transaction.atomic():
+            tracemalloc.start()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                scenario.run(client)
+                times.append((time.perf_counter() - start) * 1000)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            transaction.set_rollback(True)
+        queries = len(captured)
+    return {'queries': queries, 'time_ms': round(statistics.median(times), 2), 'memory_kb': round(peak / 1024.0, 1)}
+
+
+def run(username, password, repeat=5, names=None):
+    """
+    run scenarios
+
+    :param username: user to log in with
+    :param password: user's password
+    :param repeat: number of runs of each scenario
+    :param names: names of scenarios to run (optional, default all)
+    :return: dictionary mapping scenarios' names to their results
+    """
+    client = Client()
+    if not client.login(username=username, password=password):
+        raise RuntimeError('can not log in as %s' % username)
+    results = {}
+    for scenario in scenarios():
+        if names and scenario.name not in names:
+            continue
+        results[scenario.name] = measure(scenario, client, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    compare results with a baseline
+
+    a scenario regresses when it makes more queries than in the baseline, or when its time or memory grow more than
+    tolerance
+
+    :param results: results of current run
+    :param baseline: results of baseline run
+    :param tolerance: allowed relative growth of time and memory (e.g. 0.2 for 20%)
+    :return: list of (scenario, field, baseline value, current value) regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['queries'] > old['queries']:
+            regressions.append((name, 'queries', old['queries'], result['queries']))
+        for field in ('time_ms', 'memory_kb'):
+            if result[field] > old[field] * (1 + tolerance):
+                regressions.append((name, field, old[field], result[field]))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
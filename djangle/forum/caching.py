@@ -0,0 +1,65 @@
+"""
+module for forum's cache helpers
+
+cached data related to a forum object (e.g. a board or a thread) is stored under keys containing the object's current
+version. bumping the version makes all the related entries unreachable, so they will be recomputed on next access and
+evicted by the cache backend later.
+"""
+import time
+from django.core.cache import cache
+
+VERSION_PREFIX = 'forum:version:'
+
+
+def get_version(key):
+    """
+    return current version of a cached resource
+
+    :param key: name of the resource (e.g. 'thread:42')
+    :return: version number
+    """
+    version = cache.get(VERSION_PREFIX + key)
+    if version is None:
+        # versions start from current time, so a lost counter never gets back to an already used value
+        version = int(time.time() * 1000)
+        if not cache.add(VERSION_PREFIX + key, version, None):
+            version = cache.get(VERSION_PREFIX + key, version)
+    return version
+
+
+def get_versions(keys):
+    """
+    return current versions of many cached resources with a single cache request
+
+    :param keys: names of the resources
+    :return: dictionary mapping resources' names to version numbers
+    """
+    keys = set(keys)
+    found = cache.get_many([VERSION_PREFIX + key for key in keys])
+    return dict((key, found[VERSION_PREFIX + key] if VERSION_PREFIX + key in found else get_version(key))
+                for key in keys)
+
+
+def bump_version(*keys):
+    """
+    invalidate cached data of resources by increasing their versions
+
+    :param keys: names of the resources to invalidate
+    :return: nothing
+    """
+    for key in keys:
+        try:
+            cache.incr(VERSION_PREFIX + key)
+        except ValueError:
+            cache.set(VERSION_PREFIX + key, int(time.time() * 1000), None)
+
+
+def versioned_key(name, *keys):
+    """
+    build a cache key for data depending on the given resources
+
+    :param name: name of cached data
+    :param keys: names of the resources the data depends on
+    :return: cache key
+    """
+    return ':'.join(['forum', name] + ['%s.%d' % (key, get_version(key)) for key in keys])
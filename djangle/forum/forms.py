@@ -121,9 +121,10 @@ class AddModeratorForm(forms.Form):
 
     def __init__(self, user, *args, **kwargs):
         super(AddModeratorForm, self).__init__(*args, **kwargs)
+        modded = set(user.moderation_set.values_list('board', flat=True))
         for board in Board.objects.all():
-            value = user.moderation_set.filter(board=board).exists()
-            self.fields['%s' % board.name] = forms.BooleanField(label=board.name, required=False, initial=value)
+            self.fields['%s' % board.name] = forms.BooleanField(label=board.name, required=False,
+                                                                initial=board.pk in modded)
 
 
 class AddBanForm(forms.ModelForm):
@@ -160,9 +161,10 @@ class BoardModForm(forms.Form):
 
     def __init__(self, board, *args, **kwargs):
         super(BoardModForm, self).__init__(*args, **kwargs)
+        moderators = set(board.moderation_set.values_list('user', flat=True))
         for user in User.objects.all().order_by('username'):
-            value = board.moderation_set.filter(user=user).exists()
-            self.fields[user.username] = forms.BooleanField(label=user.username, required=False, initial=value)
+            self.fields[user.username] = forms.BooleanField(label=user.username, required=False,
+                                                            initial=user.pk in moderators)
 
 
 class SearchForm(forms.Form):
@@ -0,0 +1,98 @@
+"""
+module for rendered posts' cache
+
+parts of the thread page which are the same for every viewer are rendered once and stored in the cache (see the
+fragment tag in forum.templatetags.forum_extra): post's author column and message, comment's author column and
+message. viewer's controls (delete and vote buttons, reply form) are rendered on every request around cached fragments.
+
+fragments' keys contain the versions (see forum.caching) of the objects they show: 'post:<pk>' is bumped when a post or
+a comment is saved, 'user:<pk>' when user's reputation, number of posts, avatar or status change, 'roles' when
+moderators change. deleted posts and comments are not shown anymore, so their fragments are just left to expire.
+versions and fragments of a whole page are read with two cache requests.
+"""
+from django.core.cache import cache
+from .caching import get_versions, bump_version
+
+FRAGMENT_TIMEOUT = 7 * 24 * 3600
+"""
+seconds a fragment is kept in the cache
+"""
+
+AUTHOR = 'author'
+COMMENTER = 'commenter'
+MESSAGE = 'message'
+COMMENT = 'comment'
+
+
+def invalidate_posts(*pks):
+    """
+    invalidate fragments of posts or comments
+
+    :param pks: primary keys of posts or comments
+    :return: nothing
+    """
+    bump_version(*['post:%d' % pk for pk in pks])
+
+
+def invalidate_users(*pks):
+    """
+    invalidate fragments of users' author columns
+
+    :param pks: primary keys of users
+    :return: nothing
+    """
+    bump_version(*['user:%d' % pk for pk in pks])
+
+
+class Fragments(object):
+    """
+    fragments of a page
+
+    keys maps (kind, primary key) couples to cache keys. cached fragments are loaded with a single request when the
+    object is built
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.cached = cache.get_many(list(keys.values())) if keys else {}
+
+    def get(self, kind, pk):
+        """
+        return a fragment's cache key and its cached content
+
+        :param kind: kind of fragment (AUTHOR, COMMENTER, MESSAGE or COMMENT)
+        :param pk: primary key of the object shown by the fragment
+        :return: (key, content) couple, key is None if the fragment is not part of the page, content is None if it
+        isn't cached
+        """
+        key = self.keys.get((kind, pk))
+        return key, self.cached.get(key)
+
+    def set(self, key, content):
+        self.cached[key] = content
+        cache.set(key, content, FRAGMENT_TIMEOUT)
+
+
+def thread_fragments(posts, board):
+    """
+    load fragments of a thread page
+
+    :param posts: posts of the page, with comments prefetched
+    :param board: thread's board
+    :return: page's fragments
+    """
+    comments = [comment for post in posts for comment in post.reply.all()]
+    resources = ['roles']
+    resources += ['post:%d' % obj.pk for obj in list(posts) + comments]
+    resources += ['user:%d' % obj.author_id for obj in list(posts) + comments]
+    versions = get_versions(resources)
+
+    def key(name, *resources):
+        return ':'.join(['forum:fragment:%s' % name] + ['%s.%d' % (res, versions[res]) for res in resources])
+    keys = {}
+    for post in posts:
+        keys[(AUTHOR, post.author_id)] = key('author.%d' % board.pk, 'user:%d' % post.author_id, 'roles')
+        keys[(MESSAGE, post.pk)] = key('message', 'post:%d' % post.pk)
+    for comment in comments:
+        keys[(COMMENTER, comment.author_id)] = key('commenter', 'user:%d' % comment.author_id)
+        keys[(COMMENT, comment.pk)] = key('comment', 'post:%d' % comment.pk)
+    return Fragments(keys)
@@ -0,0 +1,218 @@
+"""
+module for views' cost measurement
+
+when INSTRUMENTATION is set (see djangle.settings), forum.middleware.InstrumentationMiddleware measures for every
+request the number of queries, the time spent in the database, the time spent rendering templates, the total time and
+the size of the response. measures are grouped by url name (e.g. 'forum:board') into histograms kept in process
+memory, which are appended to the INSTRUMENTATION_CSV file every INSTRUMENTATION_FLUSH_INTERVAL seconds.
+
+histograms use buckets growing by a factor of sqrt(2), so they take constant memory and those written by many
+processes or in different periods can be merged (see the view_stats management command) before computing percentiles.
+"""
+import csv
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+METRICS = ('queries', 'db_ms', 'template_ms', 'total_ms', 'bytes')
+"""
+measured values, in the order they are reported
+"""
+
+PERCENTILES = (50, 90, 99)
+
+CSV_FIELDS = ['time', 'pid', 'view', 'metric', 'count', 'total', 'buckets']
+
+
+class Histogram(object):
+    """
+    histogram of non negative values with logarithmic buckets
+
+    bucket 0 counts values up to 1, bucket n counts values greater than sqrt(2)^(n - 1) and up to sqrt(2)^n
+    """
+    def __init__(self, buckets=None, count=0, total=0.0):
+        self.buckets = defaultdict(int, buckets or {})
+        self.count = count
+        self.total = total
+
+    @staticmethod
+    def bucket_of(value):
+        if value <= 1:
+            return 0
+        return int(math.ceil(2 * math.log(value, 2)))
+
+    @staticmethod
+    def upper_bound(bucket):
+        return 2 ** (bucket / 2.0)
+
+    def add(self, value):
+        """
+        add a value to the histogram
+
+        :param value: the value
+        :return: nothing
+        """
+        self.buckets[self.bucket_of(value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """
+        add another histogram's values to this one
+
+        :param other: the other histogram
+        :return: nothing
+        """
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, percent):
+        """
+        estimate a percentile
+
+        :param percent: the percentile (e.g. 90)
+        :return: upper bound of the bucket containing the percentile, None if histogram is empty
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.upper_bound(bucket)
+        return self.upper_bound(max(self.buckets))
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def dump_buckets(self):
+        """
+        encode buckets as a string
+
+        :return: space separated list of bucket:count couples
+        """
+        return ' '.join('%d:%d' % (bucket, self.buckets[bucket]) for bucket in sorted(self.buckets))
+
+    @classmethod
+    def load(cls, buckets, count, total):
+        """
+        rebuild a histogram from the values written by dump_buckets
+
+        :return: the histogram
+        """
+        return cls(dict((int(bucket), int(num)) for bucket, num in (item.split(':') for item in buckets.split())),
+                   int(count), float(total))
+
+
+class Recorder(object):
+    """
+    histograms of a process' requests, grouped by url name and metric
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+        self.last_flush = time.time()
+
+    def record(self, view, values):
+        """
+        record a request's measures, flushing histograms if flush interval has passed
+
+        :param view: url name of the request
+        :param values: dictionary mapping metrics to measured values
+        :return: nothing
+        """
+        with self.lock:
+            for metric, value in values.items():
+                self.histograms[(view, metric)].add(value)
+            if time.time() - self.last_flush >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """
+        append histograms to the CSV file and start new ones
+
+        :return: nothing
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        histograms, self.histograms = self.histograms, defaultdict(Histogram)
+        self.last_flush = time.time()
+        if not histograms or not self.path:
+            return
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, CSV_FIELDS)
+            if new_file:
+                writer.writeheader()
+            now = int(self.last_flush)
+            for (view, metric), histogram in sorted(histograms.items()):
+                writer.writerow({'time': now, 'pid': os.getpid(), 'view': view, 'metric': metric,
+                                 'count': histogram.count, 'total': '%.3f' % histogram.total,
+                                 'buckets': histogram.dump_buckets()})
+
+
+def read_histograms(path, since=None):
+    """
+    read and merge histograms written to a CSV file
+
+    :param path: CSV file path
+    :param since: ignore rows written before this unix time (optional)
+    :return: dictionary mapping (view, metric) couples to merged histograms
+    """
+    histograms = defaultdict(Histogram)
+    with open(path, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            if since is not None and int(row['time']) < since:
+                continue
+            histograms[(row['view'], row['metric'])].merge(Histogram.load(row['buckets'], row['count'],
+                                                                           row['total']))
+    return histograms
+
+
+_render_state = threading.local()
+
+
+def template_time():
+    """
+    return time spent rendering templates by current thread since last reset
+
+    :return: seconds
+    """
+    return getattr(_render_state, 'elapsed', 0.0)
+
+
+def reset_template_time():
+    _render_state.elapsed = 0.0
+
+
+def patch_template_render():
+    """
+    wrap django templates' render method to measure rendering time
+
+    only templates rendered by views are measured (included templates are rendered by the engine directly), so nested
+    renders are not counted twice. calling it again does nothing.
+
+    :return: nothing
+    """
+    from django.template.backends.django import Template
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def timed_render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            _render_state.elapsed = template_time() + time.time() - start
+    timed_render.instrumented = True
+    Template.render = timed_render
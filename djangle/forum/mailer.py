@@ -0,0 +1,130 @@
+"""
+module for forum's outgoing mail
+
+notifications are not sent as soon as they are created: they are stored in a queue (see forum.models.QueuedMail) and
+the flush_mail periodic task sends them in batches of MAIL_BATCH_SIZE (see djangle.settings) over a single connection
+of the configured email backend. messages which can't be delivered are retried later, waiting twice as long after each
+failure, up to MAIL_MAX_ATTEMPTS times.
+"""
+import datetime
+from django.conf import settings
+from django.core.mail import get_connection, EmailMessage
+from django.db import transaction
+from django.utils import timezone
+
+RECIPIENT_SEPARATOR = ','
+
+CLAIM_TIMEOUT = datetime.timedelta(minutes=15)
+"""
+time after which messages claimed by a sender which didn't record their delivery are sent again
+"""
+
+
+def queue_mass_mail(datatuple):
+    """
+    queue many messages with a single query
+
+    :param datatuple: iterable of (subject, message, sender, recipient list) tuples, as for
+        django.core.mail.send_mass_mail
+    :return: number of queued messages
+    """
+    from .models import QueuedMail
+    now = timezone.now()
+    messages = [QueuedMail(subject=subject, message=message, sender=sender or '',
+                           recipients=RECIPIENT_SEPARATOR.join(recipients), next_try=now)
+                for subject, message, sender, recipients in datatuple]
+    QueuedMail.objects.bulk_create(messages)
+    return len(messages)
+
+
+def queue_mail(subject, message, sender, recipients):
+    """
+    queue a message
+
+    :param subject: email subject
+    :param message: email message
+    :param sender: email from (None for DEFAULT_FROM_EMAIL)
+    :param recipients: list of email addresses
+    :return: nothing
+    """
+    queue_mass_mail([(subject, message, sender, recipients)])
+
+
+def retry_delay(attempts):
+    """
+    return how long to wait before sending again a message
+
+    :param attempts: number of failed attempts
+    :return: timedelta
+    """
+    return datetime.timedelta(seconds=settings.MAIL_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def claim_queued_mail(batch_size, now):
+    """
+    claim due queued messages for sending
+
+    messages are locked only while their next try is moved CLAIM_TIMEOUT ahead, so that concurrent calls skip them
+    while they are being sent, and calls made after a crash send them again once the claim expires
+
+    :param batch_size: maximum number of messages to claim
+    :param now: current time
+    :return: list of claimed messages
+    """
+    from .models import QueuedMail
+    with transaction.atomic():
+        queued = list(QueuedMail.objects.select_for_update().filter(next_try__lte=now).order_by('next_try', 'pk')
+                      [:batch_size])
+        if queued:
+            QueuedMail.objects.filter(pk__in=[queued_mail.pk for queued_mail in queued]).update(
+                next_try=now + CLAIM_TIMEOUT)
+    return queued
+
+
+def send_queued_mail(batch_size=None):
+    """
+    send due queued messages
+
+    messages are claimed by a short transaction (see claim_queued_mail) and sent outside of it, so that no lock is held
+    while talking to the mail server and concurrent calls never send the same message twice. sent messages are then
+    removed from the queue and failed ones are scheduled for a later attempt by a second transaction. if that
+    transaction is not committed (e.g. the worker is killed), messages are sent again when their claim expires.
+
+    :param batch_size: maximum number of messages to send (default MAIL_BATCH_SIZE)
+    :return: number of sent messages and number of failed ones
+    """
+    from .models import QueuedMail
+    now = timezone.now()
+    queued = claim_queued_mail(batch_size or settings.MAIL_BATCH_SIZE, now)
+    if not queued:
+        return 0, 0
+    sent = []
+    failed = []
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+        for queued_mail in queued:
+            message = EmailMessage(queued_mail.subject, queued_mail.message, queued_mail.sender or None,
+                                   queued_mail.recipients.split(RECIPIENT_SEPARATOR), connection=connection)
+            try:
+                connection.send_messages([message])
+            except Exception:
+                failed.append(queued_mail)
+            else:
+                sent.append(queued_mail.pk)
+    except Exception:
+        # connection could not be opened: retry the whole batch
+        failed = [queued_mail for queued_mail in queued if queued_mail.pk not in sent]
+    finally:
+        connection.close()
+    with transaction.atomic():
+        QueuedMail.objects.filter(pk__in=sent).delete()
+        for queued_mail in failed:
+            queued_mail.attempts += 1
+            if queued_mail.attempts >= settings.MAIL_MAX_ATTEMPTS:
+                # give up, message is kept in the queue for inspection
+                queued_mail.next_try = None
+            else:
+                queued_mail.next_try = now + retry_delay(queued_mail.attempts)
+            queued_mail.save(update_fields=['attempts', 'next_try'])
+    return len(sent), len(failed)
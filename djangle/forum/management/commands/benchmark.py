@@ -0,0 +1,59 @@
+"""
+module for benchmark management command
+"""
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+from forum import benchmark
+from .generate_forum import PASSWORD
+
+
+class Command(BaseCommand):
+    """
+    run forum's benchmarks
+
+    request forum's pages and run celery tasks in eager mode (see forum.benchmark), printing queries, wall time and
+    memory of each scenario. mails are kept in memory and changes to the database are rolled back. use
+    generate_forum to build the data first.
+    """
+    help = "measure queries, time and memory of forum's pages and tasks, optionally comparing them with a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help='names of scenarios to run (default all)')
+        parser.add_argument('--username', default='bench_user0', help='user to log in with')
+        parser.add_argument('--password', default=PASSWORD)
+        parser.add_argument('--repeat', type=int, default=5, help='runs of each scenario')
+        parser.add_argument('--baseline', default=None, help='JSON file of results to compare with')
+        parser.add_argument('--save-baseline', default=None, help='write results to this JSON file')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth of time and memory')
+
+    def handle(self, *args, **options):
+        in_tests = hasattr(mail, 'outbox')
+        if not in_tests:
+            # test client needs test environment (e.g. allowed hosts, in memory mail backend)
+            setup_test_environment()
+        try:
+            with override_settings(CELERY_ALWAYS_EAGER=True, INSTRUMENTATION=False):
+                results = benchmark.run(options['username'], options['password'], options['repeat'],
+                                        options['scenarios'])
+        except RuntimeError as error:
+            raise CommandError(str(error))
+        finally:
+            if not in_tests:
+                teardown_test_environment()
+
+        baseline = benchmark.load_baseline(options['baseline']) if options['baseline'] else {}
+        self.stdout.write('%-24s %8s %10s %10s' % (('scenario',) + benchmark.RESULT_FIELDS))
+        for name, result in sorted(results.items()):
+            line = '%-24s %8d %10.2f %10.1f' % (name, result['queries'], result['time_ms'], result['memory_kb'])
+            if name in baseline:
+                old = baseline[name]
+                line += '   (baseline %d, %.2f, %.1f)' % (old['queries'], old['time_ms'], old['memory_kb'])
+            self.stdout.write(line)
+        if options['save_baseline']:
+            benchmark.save_baseline(options['save_baseline'], results)
+        regressions = benchmark.compare(results, baseline, options['tolerance'])
+        for name, field, old, new in regressions:
+            self.stderr.write('regression: %s %s %s -> %s' % (name, field, old, new))
+        if regressions:
+            raise CommandError('%d regressions' % len(regressions))
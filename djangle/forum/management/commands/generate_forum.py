@@ -0,0 +1,205 @@
+"""
+module for generate_forum management command
+"""
+import datetime
+import random
+from collections import Counter
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from forum import bans, roles
+from forum.models import Board, User, GenericPost, Post, Comment, Thread, Vote, Subscription, Ban
+from forum.votes import add_to_counters, reconcile_votes
+
+PASSWORD = 'benchmark'
+"""
+password of generated users
+"""
+
+WORDS = ('django', 'python', 'celery', 'query', 'index', 'cache', 'thread', 'board', 'forum', 'template', 'view',
+         'model', 'database', 'server', 'mail', 'vote', 'search', 'page', 'user', 'ban', 'tag', 'post', 'comment',
+         'worker', 'task', 'queue', 'latency', 'memory', 'profile', 'avatar', 'image', 'request', 'response', 'debug')
+
+TAGS = WORDS[:20]
+
+BATCH_SIZE = 500
+
+
+def sentence(rand, length):
+    return ' '.join(rand.choice(WORDS) for _ in range(length))
+
+
+def insert_children(model, parents, rows):
+    """
+    insert rows of a model inheriting from GenericPost
+
+    django can't bulk create models with parents, so parents are bulk created first and children rows are inserted
+    with a single executemany. parents' primary keys are read back in insertion order, so the database must not be
+    written by others meanwhile.
+
+    :param model: child model (Post or Comment)
+    :param parents: list of GenericPost instances
+    :param rows: list of tuples of child's own columns values, one for each parent
+    :return: list of primary keys of inserted objects
+    """
+    last = GenericPost.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    GenericPost.objects.bulk_create(parents, batch_size=BATCH_SIZE)
+    pks = list(GenericPost.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True))
+    qn = connection.ops.quote_name
+    opts = model._meta
+    columns = [opts.pk.column] + [field.column for field in opts.local_fields if field is not opts.pk]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table), ', '.join(qn(column) for column in columns),
+                                               ', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(pk,) + tuple(row) for pk, row in zip(pks, rows)])
+    return pks
+
+
+class Command(BaseCommand):
+    """
+    generate a synthetic forum
+
+    create boards, users, threads, posts, comments, votes, subscriptions and bans with bulk queries, then fill the
+    denormalized fields, tags table and search index, so that the result looks like a forum grown through the
+    forum's views. it's meant for benchmarks (see the benchmark management command): run it on an empty database which
+    is not used by others meanwhile. generated users' password is 'benchmark'.
+    """
+    help = "generate a synthetic forum for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='bench', help='prefix of boards codes and users names')
+        parser.add_argument('--boards', type=int, default=5)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=40, help='threads per board')
+        parser.add_argument('--posts', type=int, default=30, help='maximum posts per thread')
+        parser.add_argument('--comments', type=float, default=0.2, help='comments per post')
+        parser.add_argument('--votes', type=float, default=2, help='votes per post')
+        parser.add_argument('--subscriptions', type=int, default=3, help='subscriptions per user')
+        parser.add_argument('--bans', type=int, default=5)
+        parser.add_argument('--days', type=int, default=90, help='age of the forum')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-search-index', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        prefix = options['prefix']
+        now = timezone.now()
+        start = now - datetime.timedelta(days=options['days'])
+        span = (now - start).total_seconds()
+
+        with transaction.atomic():
+            Board.objects.bulk_create([Board(name='%s board %d' % (prefix, num), code='%s%d' % (prefix, num))
+                                       for num in range(options['boards'])])
+            boards = list(Board.objects.filter(code__startswith=prefix).order_by('pk'))
+
+            password = make_password(PASSWORD)
+            User.objects.bulk_create([User(username='%s_user%d' % (prefix, num), password=password,
+                                           email='%s_user%d@example.com' % (prefix, num), date_joined=start)
+                                      for num in range(options['users'])], batch_size=BATCH_SIZE)
+            users = list(User.objects.filter(username__startswith=prefix + '_user').values_list('pk', flat=True))
+
+            # plan threads' posts: dates and authors, so that threads can be created with their last activity
+            plans = []
+            threads = []
+            for board in boards:
+                for num in range(options['threads']):
+                    dates = sorted(start + datetime.timedelta(seconds=rand.random() * span)
+                                   for _ in range(rand.randint(1, options['posts'])))
+                    authors = [rand.choice(users) for _ in dates]
+                    tags = rand.sample(TAGS, rand.randint(0, 2)) + [None, None]
+                    threads.append(Thread(title=sentence(rand, 5), board=board, tag1=tags[0], tag2=tags[1],
+                                          last_activity=dates[-1], last_poster_id=authors[-1],
+                                          post_count=len(dates)))
+                    plans.append(list(zip(dates, authors)))
+            last_thread = Thread.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            Thread.objects.bulk_create(threads, batch_size=BATCH_SIZE)
+            thread_pks = list(Thread.objects.filter(pk__gt=last_thread).order_by('pk').values_list('pk', flat=True))
+
+            parents = []
+            rows = []
+            for thread_pk, plan in zip(thread_pks, plans):
+                for ordinal, (pub_date, author) in enumerate(plan, 1):
+                    parents.append(GenericPost(message=sentence(rand, rand.randint(5, 60)), pub_date=pub_date,
+                                               author_id=author))
+                    rows.append((thread_pk, ordinal))
+            post_pks = insert_children(Post, parents, rows)
+            self.link_posts(last_thread)
+            posts = [(pk, parent.author_id, parent.pub_date) for pk, parent in zip(post_pks, parents)]
+
+            comment_parents = []
+            comment_rows = []
+            for _ in range(int(len(posts) * options['comments'])):
+                post_pk, author, pub_date = rand.choice(posts)
+                comment_parents.append(GenericPost(message=sentence(rand, rand.randint(3, 20)),
+                                                   pub_date=pub_date + datetime.timedelta(minutes=rand.randint(1, 60)),
+                                                   author_id=rand.choice(users)))
+                comment_rows.append((post_pk,))
+            insert_children(Comment, comment_parents, comment_rows)
+
+            votes = {}
+            for _ in range(int(len(posts) * options['votes'])):
+                post_pk, author, pub_date = rand.choice(posts)
+                voter = rand.choice(users)
+                if voter != author:
+                    votes[(post_pk, voter)] = rand.random() < 0.8
+            Vote.objects.bulk_create([Vote(post_id=post_pk, user_id=voter, value=value)
+                                      for (post_pk, voter), value in votes.items()], batch_size=BATCH_SIZE)
+            reconcile_votes()
+            add_to_counters(User, dict((pk, {'posts': count})
+                                       for pk, count in Counter(author for pk, author, date in posts).items()))
+
+            subscriptions = {}
+            for user in users:
+                for _ in range(options['subscriptions']):
+                    thread_pk = rand.choice(thread_pks)
+                    is_async = rand.random() < 0.7
+                    interval = datetime.timedelta(minutes=15) if is_async else None
+                    last_sync = now - datetime.timedelta(seconds=rand.random() * span / 10)
+                    subscriptions[(thread_pk, user)] = Subscription(
+                        thread_id=thread_pk, user_id=user, async=is_async, sync_interval=interval,
+                        last_sync=last_sync)
+            Subscription.objects.bulk_create(subscriptions.values(), batch_size=BATCH_SIZE)
+            Subscription.refresh_due(Subscription.objects.filter(user__in=users))
+
+            banned = rand.sample(users[1:], min(options['bans'], len(users) - 1))
+            ban_list = []
+            for user in banned:
+                ban_start = now - datetime.timedelta(days=rand.randint(0, 10))
+                duration = rand.choice([datetime.timedelta(days=1), datetime.timedelta(weeks=4), None])
+                ban_list.append(Ban(user_id=user, banner_id=users[0], start=ban_start, duration=duration,
+                                    reason=sentence(rand, 3),
+                                    expires_at=None if duration is None else ban_start + duration))
+            Ban.objects.bulk_create(ban_list)
+            User.objects.filter(pk__in=banned).update(is_active=False)
+
+            call_command('rebuild_tags', stdout=self.stdout)
+            if not options['no_search_index']:
+                call_command('rebuild_search_index', stdout=self.stdout)
+        roles.invalidate()
+        bans.invalidate()
+        self.stdout.write('%d boards, %d users, %d threads, %d posts, %d comments, %d votes, %d subscriptions, %d bans '
+                          'generated' % (len(boards), len(users), len(thread_pks), len(posts), len(comment_parents),
+                                         len(votes), len(subscriptions), len(ban_list)))
+
+    @staticmethod
+    def link_posts(last_thread):
+        """
+        set first and last post of threads created after last_thread with two set based updates
+        """
+        qn = connection.ops.quote_name
+        thread = Thread._meta
+        post = Post._meta
+        sql = ('UPDATE {thread} SET {field} = (SELECT {post}.{pk} FROM {post} WHERE {post}.{thread_fk} = {thread}.{id} '
+               'AND {post}.{ordinal} = {position}) WHERE {thread}.{id} > %s')
+        names = dict(thread=qn(thread.db_table), id=qn(thread.pk.column), post=qn(post.db_table),
+                     pk=qn(post.pk.column), thread_fk=qn(post.get_field('thread').column),
+                     ordinal=qn(post.get_field('ordinal').column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(field=qn(thread.get_field('first_post').column), position='1', **names),
+                           [last_thread])
+            cursor.execute(sql.format(field=qn(thread.get_field('latest_post').column),
+                                      position='{thread}.{count}'.format(
+                                          thread=names['thread'], count=qn(thread.get_field('post_count').column)),
+                                      **names), [last_thread])
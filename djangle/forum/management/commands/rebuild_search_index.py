@@ -0,0 +1,26 @@
+"""
+module for rebuild_search_index management command
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from forum.models import Thread, Post, SearchTerm
+from forum.search import index_thread, index_post
+
+
+class Command(BaseCommand):
+    """
+    rebuild forum's search index
+
+    the search index (see forum.search) is updated when threads and posts are created. use this command to index
+    threads and posts created before the index existed or changed outside the forum's models methods.
+    """
+    help = "rebuild threads' and posts' search index"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            SearchTerm.objects.all().delete()
+            for thread in Thread.objects.select_related('first_post__author').iterator():
+                index_thread(thread)
+            for post in Post.objects.select_related('thread').iterator():
+                index_post(post)
+        self.stdout.write('%d search terms indexed' % SearchTerm.objects.count())
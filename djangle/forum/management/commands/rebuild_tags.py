@@ -0,0 +1,40 @@
+"""
+module for rebuild_tags management command
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from forum.models import Thread, Tag, ThreadTag
+
+
+class Command(BaseCommand):
+    """
+    rebuild the tags table from threads' tag fields
+
+    tags table (see forum.models.Tag) is updated when threads are created or changed from the admin interface. use this
+    command to fill it from threads created before the table existed: threads' tags are read with a single query and
+    entries are inserted in bulk, then tags' thread counters are recomputed.
+    """
+    help = "rebuild tags table from threads' tag1, tag2 and tag3 fields"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            ThreadTag.objects.all().delete()
+            pairs = set()
+            activities = {}
+            for pk, last_activity, tag1, tag2, tag3 in Thread.objects.values_list('pk', 'last_activity', 'tag1',
+                                                                                  'tag2', 'tag3').iterator():
+                activities[pk] = last_activity
+                for name in (tag1, tag2, tag3):
+                    if name:
+                        pairs.add((pk, name))
+            names = set(name for pk, name in pairs)
+            existing = set(Tag.objects.values_list('name', flat=True))
+            Tag.objects.bulk_create([Tag(name=name) for name in names - existing])
+            tags = dict(Tag.objects.values_list('name', 'pk'))
+            ThreadTag.objects.bulk_create([ThreadTag(thread_id=pk, tag_id=tags[name], last_activity=activities[pk])
+                                           for pk, name in pairs], batch_size=500)
+            Tag.objects.update(thread_count=0)
+            for tag in Tag.objects.annotate(num=Count('threadtag')).filter(num__gt=0).values('pk', 'num'):
+                Tag.objects.filter(pk=tag['pk']).update(thread_count=tag['num'])
+        self.stdout.write('%d tags, %d tagged threads' % (Tag.objects.count(), ThreadTag.objects.count()))
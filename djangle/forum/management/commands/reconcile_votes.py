@@ -0,0 +1,20 @@
+"""
+module for reconcile_votes management command
+"""
+from django.core.management.base import BaseCommand
+from forum.votes import reconcile_votes
+
+
+class Command(BaseCommand):
+    """
+    recompute votes' counters
+
+    posts' counters and users' reputation are updated by forum.models.Vote.vote (or by the fold_votes task when votes
+    are counted asynchronously). use this command to repair them from the votes table, e.g. after votes were changed
+    outside the forum's models methods.
+    """
+    help = "recompute posts' votes counters and users' reputation from votes"
+
+    def handle(self, *args, **options):
+        posts, users = reconcile_votes()
+        self.stdout.write('%d posts and %d users updated' % (posts, users))
@@ -0,0 +1,26 @@
+"""
+module for refresh_avatars management command
+"""
+from django.core.management.base import BaseCommand
+from forum.models import User
+
+
+class Command(BaseCommand):
+    """
+    record if users' avatars exist and make their resized variants
+
+    users store if their avatar's file exists and the hash naming its resized variants, which are kept up to date when
+    the avatar is uploaded or reset (see forum.avatars). use this command to fill them for users created before those
+    fields existed, to repair them after files were changed outside the forum or to make variants added since.
+    """
+    help = "record if users' avatars' files exist and make their resized variants"
+
+    def handle(self, *args, **options):
+        count = 0
+        for user in User.objects.all().iterator():
+            recorded = user.has_avatar, user.avatar_hash
+            user.record_avatar()
+            if (user.has_avatar, user.avatar_hash) != recorded:
+                user.save(update_fields=['has_avatar', 'avatar_hash'])
+                count += 1
+        self.stdout.write('%d users refreshed' % count)
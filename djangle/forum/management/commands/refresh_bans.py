@@ -0,0 +1,25 @@
+"""
+module for refresh_bans management command
+"""
+import datetime
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from forum.models import Ban
+
+
+class Command(BaseCommand):
+    """
+    recompute bans' expiration dates
+
+    bans store when they expire (start plus duration), which is kept up to date when they are saved. use this command
+    to fill it for bans created before that field existed or changed outside the forum's models methods.
+    """
+    help = "recompute bans' expiration dates"
+
+    def handle(self, *args, **options):
+        count = Ban.objects.filter(duration__isnull=True).update(expires_at=None)
+        durations = Ban.objects.filter(duration__isnull=False).order_by().values_list('duration', flat=True).distinct()
+        for duration in list(durations):
+            count += Ban.objects.filter(duration=duration).update(
+                expires_at=F('start') + datetime.timedelta(seconds=duration.total_seconds()))
+        self.stdout.write('%d bans refreshed' % count)
@@ -0,0 +1,22 @@
+"""
+module for refresh_subscriptions management command
+"""
+from django.core.management.base import BaseCommand
+from forum.models import Subscription
+
+
+class Command(BaseCommand):
+    """
+    recompute subscriptions' due dates
+
+    subscriptions store when their next notification is due (last_sync plus sync_interval, NULL if their thread has no
+    posts newer than last_sync), which is kept up to date when they are saved or synchronized and when posts are
+    created. use this command to fill it for subscriptions created before that field existed or changed outside the
+    forum's models methods.
+    """
+    help = "recompute subscriptions' next notification dates"
+
+    def handle(self, *args, **options):
+        count = Subscription.objects.count()
+        pending = Subscription.refresh_due(Subscription.objects.all())
+        self.stdout.write('%d subscriptions refreshed, %d waiting for a notification' % (count, pending))
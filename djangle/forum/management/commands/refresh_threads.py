@@ -0,0 +1,25 @@
+"""
+module for refresh_threads management command
+"""
+from django.core.management.base import BaseCommand
+from forum.models import Thread
+
+
+class Command(BaseCommand):
+    """
+    recompute threads' denormalized fields
+
+    threads store information about their last activity (last post, its date and author, number of posts) and posts
+    store their position in thread, which are kept up to date by forum.models.Post.create and forum.models.Post.remove.
+    use this command to fill them for threads created before those fields existed or to repair them after posts were
+    changed outside the forum's models methods.
+    """
+    help = "recompute threads' last activity fields and posts' ordinals"
+
+    def handle(self, *args, **options):
+        count = 0
+        for thread in Thread.objects.all().iterator():
+            thread.renumber_posts()
+            thread.update_last_activity()
+            count += 1
+        self.stdout.write('%d threads refreshed' % count)
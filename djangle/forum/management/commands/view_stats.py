@@ -0,0 +1,44 @@
+"""
+module for view_stats management command
+"""
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from forum.instrumentation import read_histograms, METRICS, PERCENTILES
+
+
+class Command(BaseCommand):
+    """
+    report views' cost
+
+    merge the histograms written by forum.middleware.InstrumentationMiddleware (by all processes) and print, for each
+    url name and metric, the number of requests, the mean and the percentiles.
+    """
+    help = "report queries, database time, template time, total time and response size of views"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', default=settings.INSTRUMENTATION_CSV, help='file written by the middleware')
+        parser.add_argument('--since', type=int, default=None, help='only consider the last SINCE minutes')
+        parser.add_argument('--sort', default='total_ms', choices=METRICS, help='metric used to sort views')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['csv']):
+            raise CommandError('%s not found: is INSTRUMENTATION enabled?' % options['csv'])
+        since = None
+        if options['since'] is not None:
+            since = time.time() - options['since'] * 60
+        histograms = read_histograms(options['csv'], since)
+        views = sorted(set(view for view, metric in histograms),
+                       key=lambda view: -(histograms[(view, options['sort'])].percentile(PERCENTILES[-1]) or 0))
+        header = '%-30s %-12s %8s %10s' % ('view', 'metric', 'requests', 'mean')
+        header += ''.join(' %10s' % ('p%d' % percent) for percent in PERCENTILES)
+        self.stdout.write(header)
+        for view in views:
+            for metric in METRICS:
+                histogram = histograms.get((view, metric))
+                if histogram is None or not histogram.count:
+                    continue
+                line = '%-30s %-12s %8d %10.1f' % (view, metric, histogram.count, histogram.mean())
+                line += ''.join(' %10.1f' % histogram.percentile(percent) for percent in PERCENTILES)
+                self.stdout.write(line)
@@ -0,0 +1,61 @@
+"""
+module for forum's middlewares
+"""
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from . import instrumentation
+
+
+class RoleCacheMiddleware(object):
+    """
+    middleware for preloading user's roles
+
+    load supermod status and modded boards of the authenticated user once per request (see
+    forum.models.User.load_roles), so that role checks in views and templates don't hit the database. it must be placed
+    after django.contrib.auth.middleware.AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        if request.user.is_authenticated():
+            request.user.load_roles()
+
+
+class InstrumentationMiddleware(object):
+    """
+    middleware for measuring views' cost
+
+    record queries, database time, template render time, total time and response size of each request, grouped by url
+    name (see forum.instrumentation). it's enabled by INSTRUMENTATION setting and should be placed first, so that it
+    measures the other middlewares too.
+    """
+    def __init__(self):
+        if not settings.INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        instrumentation.patch_template_render()
+        self.recorder = instrumentation.Recorder(settings.INSTRUMENTATION_CSV, settings.INSTRUMENTATION_FLUSH_INTERVAL)
+
+    def process_request(self, request):
+        connection.force_debug_cursor = True
+        if len(connection.queries_log) > connection.queries_log.maxlen // 2:
+            # keep room in the log, so that this request's queries are all kept
+            connection.queries_log.clear()
+        request._instrumentation = (time.time(), len(connection.queries_log))
+        instrumentation.reset_template_time()
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_instrumentation'):
+            return response
+        start, first_query = request._instrumentation
+        queries = list(connection.queries_log)[first_query:]
+        connection.force_debug_cursor = False
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        self.recorder.record(view, {
+            'queries': len(queries),
+            'db_ms': sum(float(query['time']) for query in queries) * 1000,
+            'template_ms': instrumentation.template_time() * 1000,
+            'total_ms': (time.time() - start) * 1000,
+            'bytes': 0 if response.streaming else len(response.content),
+        })
+        return response
@@ -1,13 +1,16 @@
 import datetime
-from operator import attrgetter
 import os
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.utils import timezone, six
 from django.core.exceptions import ValidationError
 from djangle.settings import ELEM_PER_PAGE
+from .caching import bump_version
+from . import avatars, bans, fragments, pagecache, roles, search, votes
 
 # Create your models here.
 
@@ -49,6 +52,35 @@ class Board(models.Model):
             board.save()
             return board
 
+    def save(self, *args, **kwargs):
+        """
+        save board and invalidate cached boards' table (see forum.roles)
+
+        :return: nothing
+        """
+        super(Board, self).save(*args, **kwargs)
+        roles.invalidate()
+
+    def delete(self, *args, **kwargs):
+        """
+        delete board and invalidate cached roles (see forum.roles)
+
+        :return: nothing
+        """
+        super(Board, self).delete(*args, **kwargs)
+        roles.invalidate()
+
+    def get_threads(self):
+        """
+        get board's threads ordered for board view
+
+        sticky threads come first, then threads are ordered by last activity. ordering is done by the database using
+        the (board, sticky, last_activity) index, so the result can be paginated without loading the whole board
+
+        :return: queryset of threads
+        """
+        return self.thread_set.filter(last_activity__isnull=False).order_by('-sticky', '-last_activity', '-pk')
+
     def get_latest(self, num=None):
         """
         get board's thread ordered by last post publish date
@@ -56,17 +88,10 @@ class Board(models.Model):
         :param num: number of threads to return (optional: default all)
         :return: list of threads
         """
-        latest_posts = []
         if (num is not None) and (not isinstance(num, six.integer_types)):
             num = None
-        for thread in self.thread_set.all():
-            if thread.last_post() is not None:
-                latest_posts.append(thread.last_post())
-        latest_posts = sorted(latest_posts, key=attrgetter('pub_date'), reverse=True)
-        latest_threads = []
-        for post in latest_posts[:num]:
-            latest_threads.append(post.thread)
-        return latest_threads
+        threads = self.thread_set.filter(last_activity__isnull=False).order_by('-last_activity', '-pk')
+        return list(threads[:num])
 
     def get_new(self, num=5):
         """
@@ -109,8 +134,10 @@ class User(AbstractUser):
     models.EmailField.unique = True
     rep = models.IntegerField(default=0, verbose_name='reputation')
     avatar = models.ImageField(upload_to='prof_pic',
-                               default=os.path.join('prof_pic', 'Djangle_user_default.png'),
+                               default=avatars.DEFAULT_AVATAR,
                                validators=[validate_image])
+    has_avatar = models.BooleanField(default=False)
+    avatar_hash = models.CharField(max_length=16, blank=True, default='')
     posts = models.PositiveIntegerField(default=0)
     threads = models.PositiveIntegerField(default=0)
 
@@ -122,31 +149,80 @@ class User(AbstractUser):
         """
         return Thread.objects.filter(first_post__author=self).count()
 
+    def save(self, *args, **kwargs):
+        """
+        save user and invalidate the fragments showing user's info (see forum.fragments)
+
+        :return: nothing
+        """
+        super(User, self).save(*args, **kwargs)
+        fragments.invalidate_users(self.pk)
+
     def reset_avatar(self):
         """
         set profile picture to default
 
         :return: nothing
         """
-        if not self.avatar.name.endswith('Djangle_user_default.png'):
+        if not avatars.is_default(self.avatar.name):
             img = self.avatar.path
             try:
                 os.remove(img)
             except:
                 pass
-            self.avatar = os.path.join('prof_pic', 'Djangle_user_default.png')
+            avatars.delete_variants(self.avatar.name, self.avatar_hash)
+            self.avatar = avatars.DEFAULT_AVATAR
+            self.has_avatar = False
+            self.avatar_hash = ''
             self.save()
 
+    def record_avatar(self):
+        """
+        record if avatar's file exists and make its resized variants, so that pages don't need to check it nor to show
+        the original avatar (see forum.avatars)
+
+        :return: nothing
+        """
+        self.has_avatar = avatars.exists(self.avatar.name)
+        self.avatar_hash = avatars.make_variants(self.avatar.name) if self.has_avatar else ''
+
+    def load_roles(self):
+        """
+        load user's roles
+
+        supermod status and modded boards are read from the shared roles cache (see forum.roles), which falls back to
+        the database only when roles changed, then they are memoized on the user instance, so that templates and views
+        can check them many times while serving a request. use invalidate_roles to discard them.
+
+        :return: nothing
+        """
+        if getattr(self, '_roles', None) is None:
+            mask = roles.get_mask(self)
+            self._roles = {
+                'supermod': self.is_superuser or bool(mask & roles.SUPERMOD),
+                'boards': roles.modded_boards(mask),
+            }
+
+    def invalidate_roles(self):
+        """
+        discard memoized roles and subscriptions
+
+        :return: nothing
+        """
+        self._roles = None
+        self._subscriptions = None
+
     def subscribed_threads(self):
         """
         return a list of thread subscribed by user
 
+        the list is memoized on the user instance
+
         :return: subscribed threads list
         """
-        threads = []
-        for subscription in self.subscription_set.all():
-            threads.append(subscription.thread)
-        return threads
+        if getattr(self, '_subscriptions', None) is None:
+            self._subscriptions = list(Thread.objects.filter(subscription__user=self).order_by('subscription__pk'))
+        return self._subscriptions
 
     def modded_boards(self):
         """
@@ -154,10 +230,8 @@ class User(AbstractUser):
 
         :return: list of modded board
         """
-        boards = []
-        for mod in self.moderation_set.all():
-            boards.append(mod.board)
-        return boards
+        self.load_roles()
+        return self._roles['boards']
 
     def set_supermod(self, do_set=True):
         """
@@ -184,6 +258,8 @@ class User(AbstractUser):
             if self.groups.filter(name='supermod').exists():
                 group.user_set.remove(self)
                 self.save()
+        roles.invalidate()
+        self.invalidate_roles()
 
     def is_supermod(self):
         """
@@ -191,10 +267,8 @@ class User(AbstractUser):
 
         :return: True if user is supermod, else False
         """
-        if self.groups.filter(name='supermod').exists() or self.is_superuser:
-            return True
-        else:
-            return False
+        self.load_roles()
+        return self._roles['supermod']
 
     def is_mod(self):
         """
@@ -202,7 +276,7 @@ class User(AbstractUser):
 
         :return: True if user is moderator, else False
         """
-        if self.moderation_set.all().exists():
+        if self.modded_boards():
             return True
         else:
             return False
@@ -211,12 +285,13 @@ class User(AbstractUser):
         """
         return whether user is banned
 
+        the answer comes from the cached set of banned users (see forum.bans) and is memoized on the instance
+
         :return: True if user is banned, else False
         """
-        for ban in Ban.objects.filter(user=self):
-            if ban.is_active():
-                return True
-        return False
+        if not hasattr(self, '_banned'):
+            self._banned = self.pk in bans.banned_ids()
+        return self._banned
 
 
 class GenericPost(models.Model):
@@ -240,6 +315,15 @@ class GenericPost(models.Model):
         """
         return self.message[:50]
 
+    def save(self, *args, **kwargs):
+        """
+        save message and invalidate its rendered fragment (see forum.fragments)
+
+        :return: nothing
+        """
+        super(GenericPost, self).save(*args, **kwargs)
+        fragments.invalidate_posts(self.pk)
+
 
 class Post(GenericPost):
     """
@@ -249,9 +333,11 @@ class Post(GenericPost):
     fields from GenericPost, moreover it has a related thread
     """
     thread = models.ForeignKey('Thread')
+    ordinal = models.PositiveIntegerField(default=0)
 
     class Meta:
         get_latest_by = 'pub_date'
+        index_together = (('thread', 'ordinal'),)
 
     @classmethod
     def create(cls, message, thread, author):
@@ -275,18 +361,46 @@ class Post(GenericPost):
             raise ValueError("message too long")
 
         pub_date = timezone.now()
-        try:
-            post = cls(message=message, pub_date=pub_date, thread=thread, author=author)
-            post.save()
-        except Exception as e:
-            raise e
-        if post.thread.first_post is None:
-            post.thread.first_post = post
-            post.thread.save()
+        with transaction.atomic():
+            # lock thread's row so that concurrent posts get different ordinals
+            count = Thread.objects.select_for_update().filter(pk=thread.pk).values_list('post_count', flat=True)[0]
+            try:
+                post = cls(message=message, pub_date=pub_date, thread=thread, author=author, ordinal=count + 1)
+                post.save()
+            except Exception as e:
+                raise e
+            Thread.objects.filter(pk=thread.pk).update(latest_post=post, last_activity=pub_date, last_poster=author,
+                                                       post_count=F('post_count') + 1)
+            if thread.get_tags():
+                ThreadTag.objects.filter(thread=thread).update(last_activity=pub_date)
+            Subscription.set_pending(thread)
+        thread.latest_post = post
+        thread.last_activity = pub_date
+        thread.last_poster = author
+        thread.post_count = count + 1
+        bump_version('thread:%d' % thread.pk, 'board:%d' % thread.board_id, 'listing:board:%d' % thread.board_id)
+        if thread.first_post is None:
+            thread.first_post = post
+            thread.save(update_fields=['first_post'])
+        search.index_post(post)
         author.posts += 1
         author.save()
         return post
 
+    def save(self, *args, **kwargs):
+        """
+        save post and keep thread's last activity fields up to date when an existing post is changed (e.g. pub_date
+        edited from admin interface)
+
+        :return: nothing
+        """
+        adding = self._state.adding
+        super(Post, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if not adding and (update_fields is None or 'pub_date' in update_fields):
+            self.thread.renumber_posts()
+            self.thread.update_last_activity()
+
     def remove(self):
         """
         method for removing a post
@@ -295,20 +409,53 @@ class Post(GenericPost):
         """
         self.author.posts -= 1
         self.author.save()
+        thread = self.thread
         self.delete()
+        Post.objects.filter(thread=thread, ordinal__gt=self.ordinal).update(ordinal=F('ordinal') - 1)
+        thread.update_last_activity()
         return
 
+    @staticmethod
+    def page_of(ordinal):
+        """
+        method for getting the page number of the post in the given position of a thread
+
+        :param ordinal: position of the post in thread (1 for the first post)
+        :return: page number
+        """
+        return max(ordinal - 1, 0) // ELEM_PER_PAGE + 1
+
     def get_page(self):
         """
         method for getting post's page number in thread's posts list
 
         :return: page number
         """
+        if self.ordinal:
+            return self.page_of(self.ordinal)
         older = Post.objects.filter(thread=self.thread, pub_date__lte=self.pub_date).count()
-        pages = older // ELEM_PER_PAGE
-        if older % ELEM_PER_PAGE == 0:
-            return pages
-        return pages + 1
+        return self.page_of(older)
+
+    @classmethod
+    def get_pages(cls, posts):
+        """
+        method for getting page numbers of many posts at once
+
+        ordinals of posts given as primary keys (or not loaded yet) are retrieved with a single query
+
+        :param posts: iterable of posts or posts' primary keys
+        :return: dictionary mapping posts' primary keys to page numbers
+        """
+        ordinals = {}
+        missing = []
+        for post in posts:
+            if isinstance(post, Post) and post.ordinal:
+                ordinals[post.pk] = post.ordinal
+            else:
+                missing.append(getattr(post, 'pk', post))
+        if missing:
+            ordinals.update(cls.objects.filter(pk__in=missing).values_list('pk', 'ordinal'))
+        return dict((pk, cls.page_of(ordinal)) for pk, ordinal in ordinals.items())
 
 
 class Comment(GenericPost):
@@ -346,6 +493,7 @@ class Comment(GenericPost):
             comment.save()
         except Exception as e:
             raise e
+        bump_version('thread:%d' % post.thread_id)
         return comment
 
 
@@ -355,7 +503,7 @@ class Thread(models.Model):
 
     thread is composed by posts and represents a discussion. a thread as a title, a first_post (the author's opening
     message), a close_date if post has been marked as closed, a closer field (the user who closed the thread), three
-    tags (not used yet, meant to simplify search), an associated board and a sticky flag, which determines whether the
+    tags (indexed in the tags table, see Tag), an associated board and a sticky flag, which determines whether the
     thread must be on top of board's threads' list or not.
     """
     title = models.CharField(max_length=200)
@@ -367,6 +515,15 @@ class Thread(models.Model):
     tag3 = models.CharField(max_length=50, blank=True, null=True, default=None)
     board = models.ForeignKey(Board)
     sticky = models.BooleanField(default=False)
+    latest_post = models.ForeignKey(Post, related_name='+', blank=True, null=True, default=None,
+                                    on_delete=models.SET_NULL)
+    last_activity = models.DateTimeField('last activity', blank=True, null=True, default=None)
+    last_poster = models.ForeignKey(User, related_name='+', blank=True, null=True, default=None,
+                                    on_delete=models.SET_NULL)
+    post_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        index_together = (('board', 'sticky', 'last_activity'), ('board', 'last_activity'))
 
     def __str__(self):
         """
@@ -382,7 +539,65 @@ class Thread(models.Model):
 
         :return: last post added
         """
-        return Post.objects.filter(thread=self).order_by('-pub_date')[0]
+        if self.latest_post_id is not None:
+            return self.latest_post
+        return Post.objects.filter(thread=self).order_by('-pub_date').first()
+
+    def update_last_activity(self):
+        """
+        recompute thread's last activity fields (last post, its date and author, number of posts) from thread's posts
+
+        :return: nothing
+        """
+        last = Post.objects.filter(thread=self).select_related('author').order_by('-pub_date', '-pk').first()
+        self.post_count = Post.objects.filter(thread=self).count()
+        if last is None:
+            self.latest_post = None
+            self.last_activity = None
+            self.last_poster = None
+        else:
+            self.latest_post = last
+            self.last_activity = last.pub_date
+            self.last_poster = last.author
+        Thread.objects.filter(pk=self.pk).update(latest_post=self.latest_post, last_activity=self.last_activity,
+                                                 last_poster=self.last_poster, post_count=self.post_count)
+        ThreadTag.objects.filter(thread=self).update(last_activity=self.last_activity)
+        bump_version('thread:%d' % self.pk, 'board:%d' % self.board_id, 'listing:board:%d' % self.board_id)
+
+    def update_tags(self):
+        """
+        synchronize thread's entries in the tags table with tag1, tag2 and tag3 fields
+
+        tags are created on first use and their threads' counters are kept up to date
+
+        :return: nothing
+        """
+        names = set(self.get_tags())
+        old = dict((thread_tag.tag.name, thread_tag) for thread_tag in
+                   ThreadTag.objects.filter(thread=self).select_related('tag'))
+        removed = [thread_tag for name, thread_tag in old.items() if name not in names]
+        if removed:
+            ThreadTag.objects.filter(pk__in=[thread_tag.pk for thread_tag in removed]).delete()
+            Tag.objects.filter(pk__in=[thread_tag.tag_id for thread_tag in removed]).update(
+                thread_count=F('thread_count') - 1)
+        added = [Tag.objects.get_or_create(name=name)[0] for name in names if name not in old]
+        if added:
+            ThreadTag.objects.bulk_create([ThreadTag(thread=self, tag=tag, last_activity=self.last_activity)
+                                           for tag in added])
+            Tag.objects.filter(pk__in=[tag.pk for tag in added]).update(thread_count=F('thread_count') + 1)
+
+    def renumber_posts(self):
+        """
+        recompute posts' ordinals following publish date order
+
+        only posts whose position changed are updated
+
+        :return: nothing
+        """
+        posts = Post.objects.filter(thread=self).order_by('pub_date', 'pk').values_list('pk', 'ordinal')
+        for ordinal, (pk, old) in enumerate(posts, 1):
+            if ordinal != old:
+                Post.objects.filter(pk=pk).update(ordinal=ordinal)
 
     @classmethod
     def create(cls, title, message, board, author, tag1=None, tag2=None, tag3=None):
@@ -423,10 +638,11 @@ class Thread(models.Model):
         thread = cls(title=title, board=board, tag1=tag1, tag2=tag2, tag3=tag3)
         thread.save()
         try:
-            post = Post.create(message=message, thread=thread, author=author)
-            post.save()
+            Post.create(message=message, thread=thread, author=author)
         except Exception as e:
             raise e
+        thread.update_tags()
+        search.index_thread(thread)
 
         return thread
 
@@ -436,9 +652,14 @@ class Thread(models.Model):
 
         :return: nothing
         """
-        for post in Post.objects.filter(thread=self):
-            post.remove()
+        authors = Post.objects.filter(thread=self).values('author').annotate(num=Count('pk'))
+        for author in authors:
+            User.objects.filter(pk=author['author']).update(posts=F('posts') - author['num'])
+        fragments.invalidate_users(*[author['author'] for author in authors])
+        Tag.objects.filter(threadtag__thread=self).update(thread_count=F('thread_count') - 1)
+        pk = self.pk
         self.delete()
+        bump_version('thread:%d' % pk, 'board:%d' % self.board_id, 'listing:board:%d' % self.board_id)
         return
 
     def sub_users(self):
@@ -479,6 +700,48 @@ class Thread(models.Model):
         return tags
 
 
+class Tag(models.Model):
+    """
+    a tag used to group threads by topic
+
+    threads are related to their tags through ThreadTag entries, thread_count keeps the number of tagged threads.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    thread_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        """
+        redefine id field to return name
+
+        :return: name
+        """
+        return self.name
+
+
+class ThreadTag(models.Model):
+    """
+    relation between a thread and one of its tags
+
+    thread's last activity is copied here, so that threads of a tag can be listed by an index on (tag, last_activity)
+    without sorting. entries are kept in sync with thread's tag fields by Thread.update_tags.
+    """
+    thread = models.ForeignKey(Thread)
+    tag = models.ForeignKey(Tag)
+    last_activity = models.DateTimeField('last activity', blank=True, null=True, default=None)
+
+    class Meta:
+        unique_together = (('tag', 'thread'),)
+        index_together = (('tag', 'last_activity'),)
+
+    def __str__(self):
+        """
+        redefine id field to return tag's name
+
+        :return: tag's name
+        """
+        return str(self.tag)
+
+
 class Subscription(models.Model):
     """
     class for managing subscriptions
@@ -488,6 +751,9 @@ class Subscription(models.Model):
     determinate if notification should be sent periodically or every time thread is updated, sync_interval time between
     asynchronous notification, last_sync datetime field to determinate which posts are to be notified, active flag (not
     used yet, it will give the user the possibility to disable subscription for some time without deleting it).
+    next_due (last_sync plus sync_interval) is set only while thread has posts newer than last_sync, NULL otherwise: it's
+    cleared when subscription is synchronized and filled when a post is created, so that the index range scan selecting
+    due subscriptions finds only the ones that have something to notify.
     """
     thread = models.ForeignKey(Thread)
     user = models.ForeignKey(User)
@@ -495,19 +761,95 @@ class Subscription(models.Model):
     sync_interval = models.DurationField('sync interval', blank=True, null=True, default=None)
     last_sync = models.DateTimeField('last synchronization', blank=True, null=True, default=None)
     active = models.BooleanField(default=True)
+    next_due = models.DateTimeField('next notification', blank=True, null=True, default=None)
 
-    def is_expired(self, time=timezone.now()):
+    def is_expired(self, time=None):
         """
         method to know if sync_interval has passed since last mail notification and there are new posts
 
         :param time: date to check (optional, default now)
         :return: True if subscription is expired, else False
         """
-        return ((self.last_sync + self.sync_interval < time) and
-                (Post.objects.filter(thread=self.thread).order_by('-pub_date')[0].pub_date > self.last_sync))
+        if time is None:
+            time = timezone.now()
+        return self.next_due is not None and self.next_due < time
 
     class Meta:
         unique_together = (('thread', 'user'),)
+        index_together = (('async', 'active', 'next_due'),)
+
+    @staticmethod
+    def due_date(last_sync, sync_interval):
+        """
+        return when a subscription will be due
+
+        :param last_sync: last sync time
+        :param sync_interval: period between two notifications
+        :return: due date, None if subscription was never synchronized
+        """
+        if last_sync is None:
+            return None
+        return last_sync + (sync_interval or datetime.timedelta(0))
+
+    @staticmethod
+    def _due_expression():
+        # last_sync plus sync_interval, computed by the database (a missing interval counts as zero)
+        return Coalesce(F('last_sync') + F('sync_interval'), F('last_sync'))
+
+    @classmethod
+    def set_pending(cls, thread):
+        """
+        set due date of thread's subscriptions which had nothing to notify, after a post is created
+
+        subscriptions are updated with one query, the ones already due keep their due date
+
+        :param thread: the thread
+        :return: nothing
+        """
+        cls.objects.filter(thread=thread, next_due__isnull=True, last_sync__isnull=False).update(
+            next_due=cls._due_expression())
+
+    @classmethod
+    def refresh_due(cls, subscriptions):
+        """
+        recompute due dates of many subscriptions from their last sync time and their thread's last activity
+
+        :param subscriptions: queryset of subscriptions
+        :return: number of subscriptions which are waiting for a notification
+        """
+        subscriptions.update(next_due=None)
+        return subscriptions.filter(last_sync__isnull=False, thread__last_activity__gt=F('last_sync')).update(
+            next_due=cls._due_expression())
+
+    @classmethod
+    def set_synced(cls, subscriptions, time):
+        """
+        set last sync time of many subscriptions
+
+        due dates are cleared, then set again for subscriptions whose thread has posts newer than time (e.g. created
+        while notifications were sent), so that none is lost
+
+        :param subscriptions: queryset of subscriptions
+        :param time: last sync time
+        :return: nothing
+        """
+        subscriptions.update(last_sync=time, next_due=None)
+        subscriptions.filter(thread__last_activity__gt=time).update(next_due=cls._due_expression())
+
+    def save(self, *args, **kwargs):
+        """
+        save subscription updating its due date
+
+        :return: nothing
+        """
+        self.next_due = None
+        if (self.last_sync is not None and
+                Thread.objects.filter(pk=self.thread_id, last_activity__gt=self.last_sync).exists()):
+            self.next_due = self.due_date(self.last_sync, self.sync_interval)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'next_due' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['next_due']
+        super(Subscription, self).save(*args, **kwargs)
 
     @classmethod
     def create(cls, thread, user, async, sync_interval=None, last_sync='default', active=True):
@@ -549,8 +891,18 @@ class Subscription(models.Model):
                          last_sync=last_sync, active=active)
             created = True
             subscr.save()
+            user.invalidate_roles()
         return subscr, created
 
+    def delete(self, *args, **kwargs):
+        """
+        delete subscription and discard subscriber's memoized subscriptions
+
+        :return: nothing
+        """
+        super(Subscription, self).delete(*args, **kwargs)
+        self.user.invalidate_roles()
+
 
 class Vote(models.Model):
     """
@@ -572,77 +924,119 @@ class Vote(models.Model):
         """
         method for new votes creation
 
-        this ensures posts' and users' static attributes to be updated whenever a vote is created or changed
+        this ensures posts' and users' static attributes to be updated whenever a vote is created or changed. voting
+        again with the same value withdraws the vote. counters are changed by atomic updates of their columns only, so
+        concurrent votes are never lost. if votes are counted asynchronously (see forum.votes), counters are left
+        unchanged and the vote's effect is added to the votes log.
 
-        :param post: voted message
+        :param post: voted message, with its thread loaded to purge cached pages without queries (see
+        forum.pagecache.purge_votes)
         :param user: voting user
         :param value: vote value (True for positive, False for negative)
-        :return: the new vote
+        :return: the new vote, None if the vote was withdrawn
         """
-        if user == post.author:
+        if user.pk == post.author_id:
             return
-        vote = Vote.objects.filter(post=post, user=user).first()
-        if vote is None:
-            vote = cls(post=post, user=user, value=value)
-            vote.save()
-            if value:
-                post.pos_votes += 1
-                post.save()
-                post.author.rep += 1
-                post.author.save()
-            else:
-                post.neg_votes += 1
-                post.save()
-                post.author.rep -= 1
-                post.author.save()
-        else:
-            if value:
-                if not vote.value:
-                    vote.value = value
-                    vote.save()
-                    post.pos_votes += 1
-                    post.neg_votes -= 1
-                    post.save()
-                    post.author.rep += 2
-                    post.author.save()
-                else:
-                    post.pos_votes -= 1
-                    post.save()
-                    post.author.rep -= 1
-                    post.author.save()
-                    vote.delete()
-                    return
+        with transaction.atomic():
+            # lock user's vote, so that concurrent requests of the same user are applied one at a time
+            vote = Vote.objects.select_for_update().filter(post=post, user=user).first()
+            created = False
+            if vote is None:
+                try:
+                    with transaction.atomic():
+                        vote = cls.objects.create(post=post, user=user, value=value)
+                    created = True
+                except IntegrityError:
+                    # a concurrent request created the same vote, apply this one as a change of it
+                    vote = Vote.objects.select_for_update().get(post=post, user=user)
+            if created:
+                pos, neg = (1, 0) if value else (0, 1)
+            elif vote.value == value:
+                # same vote again: withdraw it
+                pos, neg = (-1, 0) if value else (0, -1)
+                vote.delete()
+                vote = None
             else:
-                if vote.value:
-                    vote.value = value
-                    vote.save()
-                    post.pos_votes -= 1
-                    post.neg_votes += 1
-                    post.save()
-                    post.author.rep -= 2
-                    post.author.save()
-                else:
-                    post.neg_votes -= 1
-                    post.save()
-                    post.author.rep += 1
-                    post.author.save()
-                    vote.delete()
-                    return
+                pos, neg = (1, -1) if value else (-1, 1)
+                Vote.objects.filter(pk=vote.pk).update(value=value)
+                vote.value = value
+            if votes.is_async():
+                # counters will be updated by forum.tasks.fold_votes
+                VoteDelta.objects.create(post_id=post.pk, author_id=post.author_id, pos=pos, neg=neg)
+                return vote
+            GenericPost.objects.filter(pk=post.pk).update(pos_votes=F('pos_votes') + pos,
+                                                          neg_votes=F('neg_votes') + neg)
+            User.objects.filter(pk=post.author_id).update(rep=F('rep') + pos - neg)
+        fragments.invalidate_users(post.author_id)
+        pagecache.purge_votes(post)
+        post.pos_votes += pos
+        post.neg_votes += neg
         return vote
 
 
+class VoteDelta(models.Model):
+    """
+    pending effect of a vote on counters
+
+    when votes are counted asynchronously (see forum.votes) each vote stores here the values to add to its post's
+    counters and to its author's reputation, until they are folded in.
+    """
+    post = models.ForeignKey(GenericPost, related_name='+')
+    author = models.ForeignKey(User, related_name='+')
+    pos = models.SmallIntegerField(default=0)
+    neg = models.SmallIntegerField(default=0)
+
+
 class Ban(models.Model):
     """
     representation of ban
 
     ban class is used to store information about user's ban, such as banned user, date of ban, duration, banner user,
-    reason of ban.
+    reason of ban. expires_at (start plus duration, None for permanent bans) is kept up to date on save, so that expired
+    bans can be selected by an index range scan.
     """
     user = models.ForeignKey(User)
     start = models.DateTimeField('start on', default=timezone.now)
     duration = models.DurationField('duration', blank=True, null=True, default=None)
     banner = models.ForeignKey(User, related_name='banner')
     reason = models.CharField(max_length=50)
+    expires_at = models.DateTimeField('expires on', blank=True, null=True, default=None, db_index=True)
+
+    def save(self, *args, **kwargs):
+        """
+        save ban updating its expiration date
+
+        :return: nothing
+        """
+        self.expires_at = None if self.duration is None else self.start + self.duration
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'expires_at' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['expires_at']
+        super(Ban, self).save(*args, **kwargs)
+        bans.invalidate()
+
+    def delete(self, *args, **kwargs):
+        """
+        delete ban and invalidate cached banned users
+
+        :return: nothing
+        """
+        super(Ban, self).delete(*args, **kwargs)
+        bans.invalidate()
+
+    @classmethod
+    def active(cls, time=None):
+        """
+        return active bans
+
+        bans are selected by their expiration date, so the query can use its index
+
+        :param time: date to check (optional, default now)
+        :return: queryset of active bans
+        """
+        if time is None:
+            time = timezone.now()
+        return cls.objects.filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gte=time))
 
     def is_active(self):
         """
@@ -665,6 +1059,35 @@ class Ban(models.Model):
         self.user.save()
         self.delete()
 
+    @classmethod
+    def remove_expired(cls, time=None, pks=None):
+        """
+        remove all expired bans
+
+        expired bans are deleted and their users reactivated with bulk queries. users having another active ban are
+        left disabled.
+
+        :param time: date to check (optional, default now)
+        :param pks: primary keys of bans to check (optional, default all bans)
+        :return: list of reactivated users
+        """
+        if time is None:
+            time = timezone.now()
+        with transaction.atomic():
+            expired = cls.objects.filter(expires_at__lt=time)
+            if pks is not None:
+                expired = expired.filter(pk__in=pks)
+            expired_pks = list(expired.values_list('pk', flat=True))
+            if not expired_pks:
+                return []
+            users = list(User.objects.filter(ban__pk__in=expired_pks).exclude(ban__in=cls.active(time)).distinct())
+            User.objects.filter(pk__in=[user.pk for user in users]).update(is_active=True)
+            cls.objects.filter(pk__in=expired_pks).delete()
+        bans.invalidate()
+        for user in users:
+            user.is_active = True
+        return users
+
 
 class Moderation(models.Model):
     """
@@ -678,3 +1101,69 @@ class Moderation(models.Model):
 
     class Meta:
         unique_together = (('user', 'board'),)
+
+    def save(self, *args, **kwargs):
+        """
+        save moderation and invalidate cached roles
+
+        :return: nothing
+        """
+        super(Moderation, self).save(*args, **kwargs)
+        roles.invalidate()
+        self.user.invalidate_roles()
+
+    def delete(self, *args, **kwargs):
+        """
+        delete moderation and invalidate cached roles
+
+        :return: nothing
+        """
+        super(Moderation, self).delete(*args, **kwargs)
+        roles.invalidate()
+        self.user.invalidate_roles()
+
+
+class SearchTerm(models.Model):
+    """
+    entry of forum's search index
+
+    a search term relates a lowercase word to the thread containing it. field tells where the word was found (title,
+    tag, message or author, see forum.search), post is set only for words found in posts' messages and weight is the
+    number of occurrences. entries are removed by cascade when their thread or post is deleted.
+    """
+    term = models.CharField(max_length=50, db_index=True)
+    field = models.CharField(max_length=1)
+    weight = models.PositiveIntegerField(default=1)
+    thread = models.ForeignKey(Thread)
+    post = models.ForeignKey(Post, blank=True, null=True, default=None)
+
+    def __str__(self):
+        """
+        redefine id field to return term
+
+        :return: term
+        """
+        return self.term
+
+
+class QueuedMail(models.Model):
+    """
+    a message waiting to be sent
+
+    messages are sent in batches by forum.mailer.send_queued_mail. recipients are stored as a comma separated list,
+    attempts counts failed deliveries and next_try is the time of next attempt (None when delivery was given up).
+    """
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    sender = models.CharField(max_length=254, blank=True, default='')
+    recipients = models.TextField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_try = models.DateTimeField('next try', blank=True, null=True, default=None, db_index=True)
+
+    def __str__(self):
+        """
+        redefine id field to return subject
+
+        :return: subject
+        """
+        return self.subject
@@ -0,0 +1,213 @@
+"""
+module for board and thread pages' cache
+
+pages are the same for all the users who don't moderate any board, but for a few parts depending on the viewer (user's
+name in the header, csrf tokens, buttons shown to posts' authors, subscription's status). when PAGE_CACHE is set (see
+djangle.settings), pages requested by these users are rendered once with an include marker in place of each part
+depending on the viewer (see the esi tag in forum.templatetags.forum_extra) and stored in the cache. on every request,
+markers of the stored page are replaced by their parts rendered for the viewer, like edge side includes. moderators and
+supermoderators are always served a fully rendered page.
+
+pages' keys contain the versions (see forum.caching) of their surrogate keys ('board:<pk>' for board pages,
+'thread:<pk>' for thread pages, 'roles' for both), so bumping a version purges all the pages showing the object. users'
+reputation and avatar shown in cached pages may be late up to PAGE_CACHE_TIMEOUT seconds.
+"""
+import hashlib
+import re
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, QueryDict
+from django.template.loader import get_template
+from django.utils.http import urlencode
+from . import roles
+from .caching import versioned_key, bump_version
+
+include_re = re.compile(r'<esi:include src="(\w+)\?([^"]*)"/>')
+
+_templates = {}
+
+PURGE_CHUNK = 500
+"""
+maximum number of posts whose threads are looked up by a single query
+"""
+
+
+def is_enabled():
+    """
+    return whether pages are cached
+
+    :return: value of PAGE_CACHE setting
+    """
+    return getattr(settings, 'PAGE_CACHE', False)
+
+
+def is_shared_viewer(user):
+    """
+    return whether user is served cached pages
+
+    :param user: the user
+    :return: True if user doesn't moderate any board, else False
+    """
+    return not user.is_supermod() and not user.modded_boards()
+
+
+def include_marker(name, params):
+    """
+    build the marker of a part depending on the viewer
+
+    :param name: name of the part, it's rendered by template forum/esi/<name>.html
+    :param params: dictionary of strings passed to the template
+    :return: marker string
+    """
+    return '<esi:include src="%s?%s"/>' % (name, urlencode(sorted(params.items())))
+
+
+def render_include(request, name, query):
+    """
+    render a part depending on the viewer
+
+    :param request: the user's request
+    :param name: name of the part
+    :param query: url encoded parameters of the part
+    :return: rendered part
+    """
+    template = _templates.get(name)
+    if template is None:
+        template = _templates[name] = get_template('forum/esi/%s.html' % name)
+    return template.render(QueryDict(query).dict(), request)
+
+
+def stitch(request, page):
+    """
+    replace include markers of a page with their parts rendered for the viewer
+
+    parts with the same parameters are rendered once
+
+    :param request: the user's request
+    :param page: the page with markers
+    :return: the page for the viewer
+    """
+    rendered = {}
+
+    def replace(match):
+        if match.group(0) not in rendered:
+            rendered[match.group(0)] = render_include(request, match.group(1), match.group(2))
+        return rendered[match.group(0)]
+    return include_re.sub(replace, page)
+
+
+def purge_posts(pks):
+    """
+    purge cached pages showing posts' or comments' votes
+
+    threads containing the posts or the commented posts are purged, and their boards if the posts are first posts.
+    threads are found by primary key lookups of posts and comments, PURGE_CHUNK at a time
+
+    :param pks: primary keys of posts or comments
+    :return: nothing
+    """
+    from .models import Post, Comment
+    if not is_enabled() or not pks:
+        return
+    pks = sorted(set(pks))
+    keys = set()
+    for start in range(0, len(pks), PURGE_CHUNK):
+        chunk = pks[start:start + PURGE_CHUNK]
+        rows = Post.objects.filter(pk__in=chunk).values_list('pk', 'thread', 'thread__board', 'thread__first_post')
+        for pk, thread_pk, board_pk, first_post in rows:
+            keys.add('thread:%d' % thread_pk)
+            if first_post == pk:
+                keys.add('board:%d' % board_pk)
+        for thread_pk in Comment.objects.filter(pk__in=chunk).values_list('post__thread', flat=True):
+            keys.add('thread:%d' % thread_pk)
+    bump_version(*keys)
+
+
+def purge_votes(post):
+    """
+    purge cached pages showing a post's or a comment's votes
+
+    the thread is read from the post, so no query is made when it's already loaded (e.g. a GenericPost selected with
+    select_related('post__thread', 'comment__post__thread'))
+
+    :param post: voted post or comment (Post, Comment or GenericPost instance)
+    :return: nothing
+    """
+    from .models import Post, Comment
+    if not is_enabled():
+        return
+    if isinstance(post, Post):
+        thread = post.thread
+    elif isinstance(post, Comment):
+        thread = post.post.thread
+    else:
+        try:
+            thread = post.post.thread
+        except Post.DoesNotExist:
+            thread = post.comment.post.thread
+    keys = ['thread:%d' % thread.pk]
+    if thread.first_post_id == post.pk:
+        keys.append('board:%d' % thread.board_id)
+    bump_version(*keys)
+
+
+def board_keys(board_code, **kwargs):
+    """
+    return surrogate keys of a board page
+
+    boards' primary keys are read from the cached boards' table, without querying the database
+
+    :return: list of keys, None if board doesn't exist
+    """
+    for pk, (name, code) in roles.board_table().items():
+        if code == board_code:
+            return ['board:%d' % pk]
+    return None
+
+
+def thread_keys(thread_pk, **kwargs):
+    """
+    return surrogate keys of a thread page
+
+    :return: list of keys
+    """
+    return ['thread:%d' % int(thread_pk)]
+
+
+def cache_page(surrogate_keys):
+    """
+    decorator caching the pages of a view for users who don't moderate any board
+
+    only get requests are cached, and only responses with status 200 are stored
+
+    :param surrogate_keys: function called with view's keyword arguments and returning the surrogate keys of the page,
+    or None if the page must not be cached
+    :return: the decorator
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_enabled() or request.method != 'GET' or not is_shared_viewer(request.user):
+                return view(request, *args, **kwargs)
+            keys = surrogate_keys(**kwargs)
+            if keys is None:
+                return view(request, *args, **kwargs)
+            digest = hashlib.md5(request.get_full_path().encode()).hexdigest()
+            cache_key = versioned_key('page.%s' % digest, 'roles', *keys)
+            page = cache.get(cache_key)
+            if page is not None:
+                return HttpResponse(stitch(request, page))
+            request.page_cache = True
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                request.page_cache = False
+            if not response.streaming:
+                page = response.content.decode(response.charset)
+                if response.status_code == 200:
+                    cache.set(cache_key, page, getattr(settings, 'PAGE_CACHE_TIMEOUT', 300))
+                response.content = stitch(request, page)
+            return response
+        return wrapper
+    return decorator
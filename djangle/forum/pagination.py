@@ -0,0 +1,302 @@
+"""
+module for keyset (seek) pagination
+
+django.core.paginator.Paginator uses OFFSET and a COUNT query, so deep pages of long listings get slower and slower.
+KeysetPaginator instead retrieves pages by filtering on the ordering keys of the last (or first) shown element, which
+lets the database seek directly through its indexes. numbered pages are still supported through a cached table of the
+keys of each page's first element or, for listings storing each element's position (e.g. posts' ordinal in thread),
+directly by position.
+"""
+import calendar
+import datetime
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from .caching import versioned_key
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    # python < 3.3
+    from collections import Sequence
+
+CURSOR_SEPARATOR = '-'
+
+
+class KeysetPage(Sequence):
+    """
+    a page of a keyset paginated listing
+
+    exposes the same interface of django.core.paginator.Page used by templates, plus cursors for the neighbour pages
+    """
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __repr__(self):
+        return '<Page %s of %s>' % (self.number, self.paginator.num_pages)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        """
+        cursor for the page following this one
+
+        :return: cursor string, None if there is no next page
+        """
+        if not self._has_next:
+            return None
+        return self.paginator.cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        """
+        cursor for the page preceding this one
+
+        :return: cursor string, None if there is no previous page
+        """
+        if not self._has_previous:
+            return None
+        return self.paginator.cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    paginator which retrieves pages by seeking on ordering keys
+
+    keys are (field name, descending) couples: the last one must be unique (e.g. the primary key) so that the ordering
+    is total. resource is the name of the versioned resource (see forum.caching) whose version changes when elements
+    are added, removed or reordered: the page boundaries table is cached until its version changes. when elements store
+    their position in the listing (1 for the first one, without gaps), position is the name of that field and count
+    the number of elements: numbered pages are then selected by position and no boundaries table is built.
+    """
+    def __init__(self, queryset, keys, per_page, resource=None, position=None, count=0):
+        self.keys = keys
+        self.per_page = per_page
+        self.resource = resource
+        self.position = position
+        self.count = count
+        self.queryset = queryset.order_by(*[('-' if desc else '') + name for name, desc in keys])
+        self._boundaries = None
+
+    @property
+    def boundaries(self):
+        """
+        keys of the first element of each page
+
+        :return: list of keys tuples
+        """
+        if self._boundaries is None:
+            cache_key = versioned_key('pages.%d' % self.per_page, self.resource)
+            self._boundaries = cache.get(cache_key)
+            if self._boundaries is None:
+                names = [name for name, desc in self.keys]
+                self._boundaries = list(self.queryset.values_list(*names))[::self.per_page]
+                cache.set(cache_key, self._boundaries)
+        return self._boundaries
+
+    @property
+    def num_pages(self):
+        if self.position is not None:
+            return max((self.count + self.per_page - 1) // self.per_page, 1)
+        return max(len(self.boundaries), 1)
+
+    @property
+    def page_range(self):
+        return range(1, self.num_pages + 1)
+
+    def key_of(self, obj):
+        """
+        return ordering keys of an object
+
+        :param obj: an object of the listing
+        :return: tuple of keys
+        """
+        return tuple(getattr(obj, name) for name, desc in self.keys)
+
+    def cursor(self, obj):
+        """
+        encode ordering keys of an object in an url-safe string
+
+        :param obj: an object of the listing
+        :return: cursor string
+        """
+        values = []
+        for value in self.key_of(obj):
+            if isinstance(value, datetime.datetime):
+                value = calendar.timegm(value.utctimetuple()) * 1000000 + value.microsecond
+            values.append(str(int(value)))
+        return CURSOR_SEPARATOR.join(values)
+
+    def decode(self, cursor):
+        """
+        decode a cursor string
+
+        :param cursor: the cursor string
+        :return: tuple of keys, None if cursor is not valid
+        """
+        try:
+            values = [int(value) for value in cursor.split(CURSOR_SEPARATOR)]
+        except (ValueError, AttributeError):
+            return None
+        if len(values) != len(self.keys):
+            return None
+        keys = []
+        opts = self.queryset.model._meta
+        for (name, desc), value in zip(self.keys, values):
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            if isinstance(field, models.DateTimeField):
+                value = datetime.datetime.utcfromtimestamp(value // 1000000).replace(microsecond=value % 1000000,
+                                                                                     tzinfo=timezone.utc)
+            elif isinstance(field, models.BooleanField):
+                value = bool(value)
+            keys.append(value)
+        return tuple(keys)
+
+    def _seek(self, keys, forward, inclusive=False):
+        """
+        filter the listing from the given keys on
+
+        :param keys: tuple of keys to start from
+        :param forward: True to get following elements, False to get preceding ones
+        :param inclusive: True to include the element having the given keys
+        :return: filtered queryset
+        """
+        condition = Q()
+        equal = {}
+        for (name, desc), value in zip(self.keys, keys):
+            lookup = 'lt' if desc == forward else 'gt'
+            condition |= Q(**dict(equal, **{name + '__' + lookup: value}))
+            equal[name] = value
+        if inclusive:
+            condition |= Q(**equal)
+        queryset = self.queryset.filter(condition)
+        if not forward:
+            queryset = queryset.reverse()
+        return queryset
+
+    def _precedes(self, first, second):
+        """
+        return whether first keys come before second ones in listing's order
+        """
+        for (name, desc), a, b in zip(self.keys, first, second):
+            if a != b:
+                return (a > b) if desc else (a < b)
+        return False
+
+    def _number_of(self, keys):
+        """
+        return the number of the page containing the element with the given keys
+        """
+        low, high = 0, len(self.boundaries)
+        while low < high:
+            middle = (low + high) // 2
+            if self._precedes(keys, self.boundaries[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        return max(low, 1)
+
+    def _build(self, object_list, has_previous, has_next, number=None):
+        if number is None and not object_list:
+            number = 1
+        elif number is None and self.position is not None:
+            number = (getattr(object_list[0], self.position) - 1) // self.per_page + 1
+        elif number is None:
+            number = self._number_of(self.key_of(object_list[0]))
+        return KeysetPage(object_list, number, self, has_previous, has_next)
+
+    def page(self, number):
+        """
+        return a numbered page
+
+        invalid page numbers fall back to the first page, too big page numbers to the last one
+
+        :param number: page number
+        :return: the page
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            number = 1
+        number = min(max(number, 1), self.num_pages)
+        if self.position is not None:
+            objects = self.queryset.filter(**{self.position + '__gt': (number - 1) * self.per_page})
+            objects = list(objects[:self.per_page + 1])
+        elif not self.boundaries:
+            return self._build([], False, False, 1)
+        else:
+            objects = list(self._seek(self.boundaries[number - 1], True, True)[:self.per_page + 1])
+        return self._build(objects[:self.per_page], number > 1, len(objects) > self.per_page, number)
+
+    def page_after(self, cursor):
+        """
+        return the page following the element identified by cursor
+
+        :param cursor: cursor string
+        :return: the page
+        """
+        keys = self.decode(cursor)
+        if keys is None:
+            return self.page(1)
+        objects = list(self._seek(keys, True)[:self.per_page + 1])
+        if not objects:
+            return self.page(self.num_pages)
+        return self._build(objects[:self.per_page], True, len(objects) > self.per_page)
+
+    def page_before(self, cursor):
+        """
+        return the page preceding the element identified by cursor
+
+        :param cursor: cursor string
+        :return: the page
+        """
+        keys = self.decode(cursor)
+        if keys is None:
+            return self.page(1)
+        objects = list(self._seek(keys, False)[:self.per_page + 1])
+        if not objects:
+            return self.page(1)
+        has_previous = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        objects.reverse()
+        return self._build(objects, has_previous, True)
+
+    def get_page(self, page=None, after=None, before=None):
+        """
+        return the page selected by url parameters
+
+        :param page: page number
+        :param after: cursor of the element preceding the page
+        :param before: cursor of the element following the page
+        :return: the page
+        """
+        if after is not None:
+            return self.page_after(after)
+        if before is not None:
+            return self.page_before(before)
+        return self.page(page)
@@ -0,0 +1,77 @@
+"""
+module for celery tasks' arguments
+
+model instances are not passed to tasks: pickled instances are large, depend on the code which pickled them and may
+describe objects which are deleted before the task runs. tasks receive instead a JSON serializable snapshot containing
+the primary key and the few fields they need, read when the task is scheduled.
+"""
+import datetime
+from django.utils.dateparse import parse_datetime
+
+DATES = '__dates__'
+
+POST = ('message', 'pub_date', 'author.username', 'author.email', 'thread.pk', 'thread.title')
+THREAD = ('title', 'board.name')
+COMMENT = ('message', 'author.email', 'post.message')
+BAN = ('reason', 'banner.username', 'user.email')
+USER = ('username', 'email')
+
+
+class Snapshot(object):
+    """
+    read only copy of some of an object's fields
+
+    fields of related objects are exposed as nested snapshots, so that snapshot.author.email works as for the original
+    object
+    """
+    def __init__(self, fields):
+        for name, value in fields.items():
+            setattr(self, name, Snapshot(value) if isinstance(value, dict) else value)
+
+    def __repr__(self):
+        return '<Snapshot %s>' % sorted(self.__dict__)
+
+
+def dump(obj, *fields):
+    """
+    build the snapshot of an object to pass to a task
+
+    :param obj: a model instance
+    :param fields: names of fields to copy, fields of related objects are named by dotted paths (e.g. 'author.email')
+    :return: dictionary mapping paths to values, datetimes are stored as ISO 8601 strings
+    """
+    payload = {'pk': obj.pk}
+    dates = []
+    for path in fields:
+        value = obj
+        for name in path.split('.'):
+            value = getattr(value, name)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+            dates.append(path)
+        payload[path] = value
+    if dates:
+        payload[DATES] = dates
+    return payload
+
+
+def load(payload):
+    """
+    rebuild a snapshot received by a task
+
+    :param payload: dictionary built by dump
+    :return: the snapshot
+    """
+    dates = payload.get(DATES, [])
+    fields = {}
+    for path, value in payload.items():
+        if path == DATES:
+            continue
+        if path in dates:
+            value = parse_datetime(value)
+        names = path.split('.')
+        nested = fields
+        for name in names[:-1]:
+            nested = nested.setdefault(name, {})
+        nested[names[-1]] = value
+    return Snapshot(fields)
@@ -0,0 +1,79 @@
+"""
+module for forum's query layer
+
+functions in this module build the data needed by whole pages with a fixed number of queries, no matter how many
+boards, threads or posts are shown.
+"""
+from django.db import connection
+from .models import Board, Thread
+
+NEW_THREADS = 5
+
+BOARDS_PER_QUERY = 100
+"""
+maximum number of boards whose threads are selected by a single query (sqlite limits compound selects to 500 terms)
+"""
+
+
+def latest_threads(boards, num=NEW_THREADS):
+    """
+    get the most recently active threads of many boards at once
+
+    primary keys of the top num threads of each board are selected by a single query, made of one ORDER BY ... LIMIT
+    subquery per board joined by UNION ALL, so that each board only reads its num newest entries of the (board,
+    last_activity) index (forums with more than BOARDS_PER_QUERY boards need a query for each BOARDS_PER_QUERY
+    boards). selected threads are then loaded with their first post, last post and their authors by a
+    second query.
+
+    :param boards: list of boards
+    :param num: maximum number of threads to return for each board
+    :return: dictionary mapping boards' primary keys to lists of threads ordered by last activity
+    """
+    result = dict((board.pk, []) for board in boards)
+    if not boards:
+        return result
+    qn = connection.ops.quote_name
+    opts = Thread._meta
+    top = ('SELECT * FROM (SELECT {pk} FROM {table} WHERE {board} = %s AND {activity} IS NOT NULL '
+           'ORDER BY {activity} DESC, {pk} DESC LIMIT %s) {{alias}}').format(
+        pk=qn(opts.pk.column), table=qn(opts.db_table), board=qn(opts.get_field('board').column),
+        activity=qn(opts.get_field('last_activity').column))
+    pks = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(boards), BOARDS_PER_QUERY):
+            chunk = boards[start:start + BOARDS_PER_QUERY]
+            params = []
+            for board in chunk:
+                params += [board.pk, num]
+            cursor.execute(' UNION ALL '.join(top.format(alias=qn('top%d' % index)) for index in range(len(chunk))),
+                           params)
+            pks += [row[0] for row in cursor.fetchall()]
+    threads = Thread.objects.filter(pk__in=pks).select_related('first_post__author', 'latest_post', 'last_poster')
+    for thread in threads.order_by('board', '-last_activity', '-pk'):
+        result[thread.board_id].append(thread)
+    return result
+
+
+def index_context(user, num=NEW_THREADS):
+    """
+    build the context for forum's index
+
+    boards are returned with two extra attributes: new_threads, the list of their most recently active threads, and
+    modded, whether user moderates the board.
+
+    :param user: the user requesting the page
+    :param num: maximum number of threads to show for each board
+    :return: context dictionary
+    """
+    boards = list(Board.objects.all().order_by('name'))
+    threads = latest_threads(boards, num)
+    if user.is_authenticated():
+        modded = set(board.pk for board in user.modded_boards())
+        supermod = user.is_supermod()
+    else:
+        modded = set()
+        supermod = False
+    for board in boards:
+        board.new_threads = threads[board.pk]
+        board.modded = board.pk in modded
+    return {'boards': boards, 'supermod': supermod}
@@ -0,0 +1,146 @@
+"""
+module for users' roles cache
+
+moderator and supermoderator status change rarely, but they are checked on every forum page. each user's roles are
+stored in the cache (see CACHES in djangle.settings) as a compact bitmap: bit 0 is set for supermoderators, bit n is set
+if the user moderates the board having primary key n. names and codes of boards are cached in a single table shared by
+all users.
+
+all entries depend on a global generation counter (the 'roles' version, see forum.caching): any change to roles bumps
+it, so every worker sharing the cache backend will reload roles from the database on next check.
+"""
+import calendar
+from django.core.cache import cache
+from .caching import versioned_key, bump_version
+
+SUPERMOD = 1
+
+ADMIN_BADGE = 'admin'
+SUPERMOD_BADGE = 'supermod'
+MODERATOR_BADGE = 'moderator'
+USER_BADGE = 'user'
+
+
+def invalidate():
+    """
+    invalidate all cached roles
+
+    :return: nothing
+    """
+    bump_version('roles')
+
+
+def _mask_key(user):
+    # join date makes the key unique even if a primary key is recycled (e.g. after restoring a database)
+    joined = 0
+    if user.date_joined:
+        joined = calendar.timegm(user.date_joined.utctimetuple()) * 1000000 + user.date_joined.microsecond
+    return versioned_key('roles.%d.%d' % (user.pk, joined), 'roles')
+
+
+def compute_mask(user):
+    """
+    compute user's roles bitmap from the database
+
+    :param user: the user
+    :return: roles bitmap
+    """
+    from .models import Moderation
+    mask = SUPERMOD if user.groups.filter(name='supermod').exists() else 0
+    for board_pk in Moderation.objects.filter(user=user).values_list('board', flat=True):
+        mask |= 1 << board_pk
+    return mask
+
+
+def get_mask(user):
+    """
+    return user's roles bitmap
+
+    :param user: the user
+    :return: roles bitmap
+    """
+    key = _mask_key(user)
+    mask = cache.get(key)
+    if mask is None:
+        mask = compute_mask(user)
+        cache.set(key, mask)
+    return mask
+
+
+def get_masks(users):
+    """
+    return roles bitmaps of many users
+
+    cached bitmaps are read with a single cache request, missing ones are computed with two queries for all of them
+
+    :param users: iterable of users
+    :return: dictionary mapping users' primary keys to roles bitmaps
+    """
+    from .models import User, Moderation
+    keys = dict((user.pk, _mask_key(user)) for user in users)
+    cached = cache.get_many(list(keys.values()))
+    masks = dict((pk, cached[key]) for pk, key in keys.items() if key in cached)
+    missing = [pk for pk in keys if pk not in masks]
+    if missing:
+        computed = dict.fromkeys(missing, 0)
+        for pk in User.objects.filter(pk__in=missing, groups__name='supermod').values_list('pk', flat=True):
+            computed[pk] |= SUPERMOD
+        for pk, board_pk in Moderation.objects.filter(user__in=missing).values_list('user', 'board'):
+            computed[pk] |= 1 << board_pk
+        cache.set_many(dict((keys[pk], mask) for pk, mask in computed.items()))
+        masks.update(computed)
+    return masks
+
+
+def badges(users, board):
+    """
+    return the role shown next to each user's posts in a board
+
+    :param users: iterable of users
+    :param board: the board
+    :return: dictionary mapping users' primary keys to ADMIN_BADGE, SUPERMOD_BADGE, MODERATOR_BADGE or USER_BADGE
+    """
+    users = dict((user.pk, user) for user in users)
+    result = {}
+    for pk, mask in get_masks(users.values()).items():
+        if users[pk].is_superuser:
+            result[pk] = ADMIN_BADGE
+        elif mask & SUPERMOD:
+            result[pk] = SUPERMOD_BADGE
+        elif mask >> board.pk & 1:
+            result[pk] = MODERATOR_BADGE
+        else:
+            result[pk] = USER_BADGE
+    return result
+
+
+def board_table():
+    """
+    return name and code of each board
+
+    :return: dictionary mapping boards' primary keys to (name, code) couples
+    """
+    from .models import Board
+    key = versioned_key('boards', 'roles')
+    table = cache.get(key)
+    if table is None:
+        table = dict((pk, (name, code)) for pk, name, code in Board.objects.values_list('pk', 'name', 'code'))
+        cache.set(key, table)
+    return table
+
+
+def modded_boards(mask):
+    """
+    return boards whose bits are set in a roles bitmap
+
+    boards are built from the cached boards table, without querying the database
+
+    :param mask: roles bitmap
+    :return: list of boards ordered by name
+    """
+    from .models import Board
+    boards = []
+    for pk, (name, code) in board_table().items():
+        if mask >> pk & 1:
+            boards.append(Board(pk=pk, name=name, code=code))
+    return sorted(boards, key=lambda board: board.name)
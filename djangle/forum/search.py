@@ -0,0 +1,135 @@
+"""
+module for forum's full-text search
+
+threads are searched through an inverted index stored in the database (see forum.models.SearchTerm): each entry maps a
+lowercase term to the thread (and the post) containing it, together with the field it was found in and the number of
+occurrences. index is updated when threads and posts are created or edited in the admin interface, while deletion of
+threads and posts removes their entries by cascade.
+
+searches look up terms by prefix, which can be served by the index on term column, so their cost depends on the number
+of matching entries rather than on forum's size.
+"""
+import re
+from collections import Counter
+from django.db.models import Q, F, Sum, Max, Case, When, Value, IntegerField
+
+TERM_LENGTH = 50
+"""
+maximum length of indexed terms
+"""
+
+TITLE = 't'
+TAG = 'g'
+MESSAGE = 'm'
+AUTHOR = 'a'
+
+FIELD_WEIGHTS = {TITLE: 3, TAG: 2, MESSAGE: 1, AUTHOR: 1}
+"""
+relevance of a term occurrence according to the field it was found in
+"""
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    split text in lowercase terms
+
+    one character words are ignored
+
+    :param text: text to split
+    :return: list of terms
+    """
+    if not text:
+        return []
+    return [word[:TERM_LENGTH] for word in word_re.findall(text.lower()) if len(word) > 1]
+
+
+def _entries(thread, field, terms, post=None):
+    from .models import SearchTerm
+    return [SearchTerm(term=term, field=field, weight=count, thread=thread, post=post)
+            for term, count in Counter(terms).items()]
+
+
+def index_thread(thread):
+    """
+    index thread's title, tags and author
+
+    :param thread: the thread to index
+    :return: nothing
+    """
+    from .models import SearchTerm
+    entries = _entries(thread, TITLE, tokenize(thread.title))
+    for tag in thread.get_tags():
+        entries += _entries(thread, TAG, tokenize(tag))
+    if thread.first_post is not None:
+        entries += _entries(thread, AUTHOR, [thread.first_post.author.username.lower()[:TERM_LENGTH]])
+    SearchTerm.objects.bulk_create(entries)
+
+
+def index_post(post):
+    """
+    index post's message
+
+    :param post: the post to index
+    :return: nothing
+    """
+    from .models import SearchTerm
+    SearchTerm.objects.bulk_create(_entries(post.thread, MESSAGE, tokenize(post.message), post))
+
+
+def reindex_thread(thread):
+    """
+    replace the entries of thread's title, tags and author, after they were changed
+
+    :param thread: the thread to index
+    :return: nothing
+    """
+    from .models import SearchTerm
+    SearchTerm.objects.filter(thread=thread, post__isnull=True).delete()
+    index_thread(thread)
+
+
+def reindex_post(post):
+    """
+    replace the entries of post's message, after it was changed
+
+    :param post: the post to index
+    :return: nothing
+    """
+    from .models import SearchTerm
+    SearchTerm.objects.filter(post=post).delete()
+    index_post(post)
+
+
+def search_threads(title='', tag='', username=''):
+    """
+    search threads by words in title or messages, tags and author's username
+
+    each given word must prefix a term of the searched fields. results are ranked by the number of occurrences of the
+    words, weighted by field (see FIELD_WEIGHTS), then by threads' last activity. ranking and ordering are done by the
+    database, so the result can be paginated.
+
+    :param title: words to search in titles and messages
+    :param tag: words to search in tags
+    :param username: beginning of thread author's username
+    :return: queryset of dictionaries with keys thread (thread's primary key) and rank
+    """
+    from .models import SearchTerm
+    conditions = [Q(term__startswith=word, field__in=(TITLE, MESSAGE)) for word in tokenize(title)]
+    conditions += [Q(term__startswith=word, field=TAG) for word in tokenize(tag)]
+    if username:
+        conditions.append(Q(term__startswith=username.lower()[:TERM_LENGTH], field=AUTHOR))
+    if not conditions:
+        return SearchTerm.objects.none().values('thread')
+    matches = {}
+    any_condition = Q()
+    for number, condition in enumerate(conditions):
+        any_condition |= condition
+        matches['match%d' % number] = Max(Case(When(condition, then=Value(1)), default=Value(0),
+                                               output_field=IntegerField()))
+    rank = Sum(Case(*[When(field=field, then=F('weight') * weight) for field, weight in FIELD_WEIGHTS.items()],
+                    output_field=IntegerField()))
+    results = SearchTerm.objects.filter(any_condition).values('thread').annotate(rank=rank, **matches)
+    return results.filter(**dict((match, 1) for match in matches)).order_by('-rank', '-thread__last_activity',
+                                                                           '-thread')
@@ -1,14 +1,29 @@
 from __future__ import absolute_import
+from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
 from django.utils import timezone
-from .models import Subscription, User, Ban
+from .models import Subscription, Ban, Post
+from .mailer import queue_mail, queue_mass_mail, send_queued_mail
+from .payloads import load
+from .votes import fold_votes as fold_pending_votes
 from djangle.celery import app
-from django.core.mail import send_mail
 from djangle.settings import EMAIL_SUBJECT_PREFIX
 import os
 
 DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT = "%H:%M:%S"
+BAN_REMOVE_SUBJECT = 'account enabled'
+BAN_REMOVE_MESSAGE = 'your ban is expired: you can now log back into djangle'
 sep = str(os.linesep * 2)
+CHUNK_SIZE = 500
+"""
+maximum number of objects selected or updated by primary key in a single query
+"""
+SYNC_MAIL_CHUNK = 200
+"""
+number of subscribers notified by each sync_mail sub-task
+"""
 
 
 @app.task
@@ -16,9 +31,13 @@ def async_mail():
     """
     procedure for asynchronous mail service
 
-    for each active user with active subscriptions, iter through subscribed threads and compose a mail with all new
-    posts since last update, then call a deferred procedure to actually send the mail. mind that comment will not be
-    notified.
+    for each active user with due subscriptions, compose a mail with all new posts of subscribed threads since last
+    update, then queue the mail for delivery (see forum.mailer). mind that comment will not be notified.
+
+    due subscriptions are selected by a single query on their next due date, together with their users and threads:
+    next due date is set only while a thread has posts to notify, so subscriptions of quiet threads aren't read at all.
+    new posts are then read once for all the subscribers of their thread, with their authors, and subscriptions' last_sync
+    are updated in bulk, so the number of queries does not depend on the number of subscriptions.
 
     :return: nothing
     """
@@ -26,34 +45,45 @@ def async_mail():
     # execution time (they will be sent in next iteration)
     time = timezone.now()
 
-    # believe me or not, this iterates over users which have active subscriptions
-    users = (User.objects.get(pk=x['user']) for x in Subscription.objects.values('user').distinct())
-
-    # iterator over list of subscriptions grouped by user
-    user_subs = (x.subscription_set.filter(async=True, active=True) for x in users if x.is_active)
-
-    for subs in user_subs:
+    subs = Subscription.objects.filter(async=True, active=True, next_due__lt=time,
+                                       user__is_active=True).select_related('user', 'thread')
+    due = list(subs.order_by('user', 'pk'))
+    if not due:
+        return
+
+    # new posts of each thread, formatted once for all its subscribers
+    since = {}
+    for sub in due:
+        since[sub.thread_id] = min(sub.last_sync, since.get(sub.thread_id, sub.last_sync))
+    posts = defaultdict(list)
+    thread_pks = sorted(since)
+    for start in range(0, len(thread_pks), CHUNK_SIZE):
+        chunk = thread_pks[start:start + CHUNK_SIZE]
+        new_posts = Post.objects.filter(thread__in=chunk, pub_date__gt=min(since[pk] for pk in chunk),
+                                        pub_date__lte=time).select_related('author').order_by('thread', 'pub_date')
+        for post in new_posts.iterator():
+            if post.pub_date > since[post.thread_id]:
+                posts[post.thread_id].append((post.pub_date, 'on ' + post.pub_date.strftime(
+                    "%s %s" % (DATE_FORMAT, TIME_FORMAT)) + ' UTC ' + post.author.username + ' wrote :' +
+                    os.linesep + post.message))
+
+    messages = []
+    for user, user_subs in groupby(due, key=attrgetter('user')):
         message = ''
-        for sub in subs:
-            if sub.is_expired(time):
+        for sub in user_subs:
+            new_posts = [text for pub_date, text in posts[sub.thread_id] if pub_date > sub.last_sync]
+            if new_posts:
                 message += 'New messages on thread ' + sub.thread.title + ':' + sep
-                new_posts = sub.thread.post_set.filter(pub_date__range=(sub.last_sync, time)).order_by('pub_date')
-                post = ('on ' + post.pub_date.strftime("%s %s" % (DATE_FORMAT, TIME_FORMAT)) + ' UTC ' +
-                        post.author.username + ' wrote :' + os.linesep +
-                        post.message for post in new_posts)
-                message += sep.join(post)
+                message += sep.join(new_posts)
                 message += sep + 20 * '_' + sep
-                sub.last_sync = time
-                sub.save()
         if message is not '':
-            message = 'Hi ' + subs[0].user.username + ', you have some news from djangle:' + sep + 20 * '_' + sep + \
-                      message
-            mail.delay(EMAIL_SUBJECT_PREFIX + 'update from your subscriptions',
-                       message,
-                       None,
-                       [subs[0].user.email],
-                       fail_silently=False
-                       )
+            message = 'Hi ' + user.username + ', you have some news from djangle:' + sep + 20 * '_' + sep + message
+            messages.append((EMAIL_SUBJECT_PREFIX + 'update from your subscriptions', message, None, [user.email]))
+    queue_mass_mail(messages)
+
+    due_pks = [sub.pk for sub in due]
+    for start in range(0, len(due_pks), CHUNK_SIZE):
+        Subscription.set_synced(Subscription.objects.filter(pk__in=due_pks[start:start + CHUNK_SIZE]), time)
 
 
 @app.task
@@ -61,26 +91,50 @@ def sync_mail(post):
     """
     procedure for synchronous mail service
 
-    create a message for the update, then iter through users which have subscribed (with synchronous notification)
-    the thread containing the post and send a mail to each one through a deferred procedure
+    split users which have subscribed (with synchronous notification) the thread containing the post in chunks of
+    SYNC_MAIL_CHUNK consecutive subscriptions, then notify each chunk through a sub-task, so that threads with many
+    subscribers don't keep a single worker busy. if there is only one chunk it's notified directly.
 
-    :param post:
+    :param post: snapshot of the new post (see forum.payloads.POST)
     :return: nothing
     """
-    subs = (sub for sub in post.thread.subscription_set.filter(async=False, active=True))
+    thread = load(post).thread
+    pks = list(Subscription.objects.filter(thread=thread.pk, async=False, active=True).order_by('pk')
+               .values_list('pk', flat=True))
+    chunks = [(pks[start], pks[min(start + SYNC_MAIL_CHUNK, len(pks)) - 1])
+              for start in range(0, len(pks), SYNC_MAIL_CHUNK)]
+    if len(chunks) == 1:
+        sync_mail_chunk(post, *chunks[0])
+    else:
+        for first, last in chunks:
+            sync_mail_chunk.delay(post, first, last)
+
+
+@app.task
+def sync_mail_chunk(post, first, last):
+    """
+    notify a chunk of a thread's synchronous subscribers
+
+    create a message for the update once, then queue a mail for each subscriber with primary key between first and last
+    (see forum.mailer) and update their last_sync in bulk
+
+    :param post: snapshot of the new post (see forum.payloads.POST)
+    :param first: primary key of first subscription of the chunk
+    :param last: primary key of last subscription of the chunk
+    :return: nothing
+    """
+    post = load(post)
+    subs = Subscription.objects.filter(thread=post.thread.pk, async=False, active=True, pk__gte=first, pk__lte=last)
     message = 'New message on thread ' + post.thread.title + ':' + sep + \
               'on ' + post.pub_date.strftime("%s %s" % (DATE_FORMAT, TIME_FORMAT)) + ' UTC ' + \
               post.author.username + ' wrote :' + os.linesep + post.message
-    for sub in subs:
-        user_message = 'Hi ' + sub.user.username + ', you have some news from djangle:' + sep + 20 * '_' + sep + message
-        mail.delay(EMAIL_SUBJECT_PREFIX + 'update from thread ' + sub.thread.title,
-                   user_message,
-                   None,
-                   [sub.user.email],
-                   fail_silently=False
-                   )
-        sub.last_sync = post.pub_date
-        sub.save()
+    subject = EMAIL_SUBJECT_PREFIX + 'update from thread ' + post.thread.title
+    messages = []
+    for username, email in subs.values_list('user__username', 'user__email'):
+        user_message = 'Hi ' + username + ', you have some news from djangle:' + sep + 20 * '_' + sep + message
+        messages.append((subject, user_message, None, [email]))
+    queue_mass_mail(messages)
+    Subscription.set_synced(subs, post.pub_date)
 
 
 @app.task
@@ -88,15 +142,16 @@ def del_comment_mail(comment):
     """
     procedure to notify comment deletion
 
-    create a message for the deletion and send a notification mail through a deferred procedure
+    create a message for the deletion and queue a notification mail
 
-    :param comment: the deleted comment
+    :param comment: snapshot of the deleted comment (see forum.payloads.COMMENT)
     :return: nothing
     """
+    comment = load(comment)
     subject = EMAIL_SUBJECT_PREFIX + 'your comment was deleted'
     message = 'The comment:' + os.linesep + comment.message + os.linesep + 'in post: ' + comment.post.message +\
               os.linesep + 'was deleted'
-    mail.delay(subject=subject, message=message, sender=None, receiver=[comment.author.email], fail_silently=False)
+    queue_mail(subject, message, None, [comment.author.email])
 
 
 @app.task
@@ -104,13 +159,15 @@ def del_mail(post, thread=None):
     """
     procedure for post deletion notification
 
-    create a message for the deletion and send a notification mail through a deferred procedure
+    create a message for the deletion and queue a notification mail
 
-    :param post: the deleted post (first_post if deleting thread)
-    :param thread: the deleted thread (only if deleting thread)
+    :param post: snapshot of the deleted post (first_post if deleting thread, see forum.payloads.POST)
+    :param thread: snapshot of the deleted thread (only if deleting thread, see forum.payloads.THREAD)
     :return: nothing
     """
+    post = load(post)
     if thread is not None:
+        thread = load(thread)
         subject = EMAIL_SUBJECT_PREFIX + 'your thread was deleted'
         message = 'Thread: ' + thread.title + os.linesep + 'in board: ' + thread.board.name + os.linesep + \
                   'was deleted'
@@ -119,7 +176,7 @@ def del_mail(post, thread=None):
         message = 'The post:' + os.linesep + post.message + os.linesep + 'in thread: ' + post.thread.title + os.linesep + \
                   'was deleted'
 
-    mail.delay(subject=subject, message=message, sender=None, receiver=[post.author.email], fail_silently=False)
+    queue_mail(subject, message, None, [post.author.email])
 
 
 @app.task
@@ -127,15 +184,13 @@ def ban_remove_mail(user):
     """
     procedure for ban deletion mail
 
-    create a message for the ban deletion and send a notification mail through a deferred procedure
+    create a message for the ban deletion and queue a notification mail
 
-    :param user: the user to redeem
+    :param user: snapshot of the user to redeem (see forum.payloads.USER)
     :return: nothing
     """
-    subject = 'account enabled'
-    message = 'your ban is expired: you can now log back into djangle'
-    receiver = [user.email]
-    mail.delay(subject=subject, message=message, sender=None, receiver=receiver)
+    user = load(user)
+    queue_mail(BAN_REMOVE_SUBJECT, BAN_REMOVE_MESSAGE, None, [user.email])
 
 
 @app.task
@@ -143,15 +198,16 @@ def ban_create_mail(ban):
     """
     procedure for ban creation mail
 
-    create a message for ban creation and send a notification mail through a deferred procedure
+    create a message for ban creation and queue a notification mail
 
-    :param ban: the created ban object
+    :param ban: snapshot of the created ban object (see forum.payloads.BAN)
     :return: nothing
     """
+    ban = load(ban)
     subject = 'account disabled'
     message = 'you have been banned by ' + ban.banner.username + ' for this reason: ' + ban.reason + os.linesep + \
               'we hope you will take your time to think about your behaviour'
-    mail.delay(subject=subject, message=message, sender=None, receiver=[ban.user.email])
+    queue_mail(subject, message, None, [ban.user.email])
 
 
 @app.task
@@ -159,14 +215,40 @@ def check_ban():
     """
     check which ban has expired
 
-    asynchronously check in ban list which ban has expired, remove them and send notification mail to users
+    asynchronously remove expired bans (see forum.models.Ban.remove_expired) and queue notification mails to users
 
     :return: nothing
     """
-    for ban in Ban.objects.all():
-        if not ban.is_active():
-            ban.remove()
-            ban_remove_mail.delay(ban.user)
+    users = Ban.remove_expired()
+    queue_mass_mail((BAN_REMOVE_SUBJECT, BAN_REMOVE_MESSAGE, None, [user.email]) for user in users)
+
+
+@app.task
+def expire_ban(ban_pk):
+    """
+    remove a ban when it expires
+
+    scheduled at ban creation to run at ban's expiration date when BAN_EXPIRY_ETA is set (see djangle.settings). if the
+    ban was replaced or removed in the meantime nothing happens.
+
+    :param ban_pk: primary key of the ban
+    :return: nothing
+    """
+    users = Ban.remove_expired(pks=[ban_pk])
+    queue_mass_mail((BAN_REMOVE_SUBJECT, BAN_REMOVE_MESSAGE, None, [user.email]) for user in users)
+
+
+@app.task
+def fold_votes():
+    """
+    add pending votes to counters
+
+    when votes are counted asynchronously, periodically add the votes log to posts' counters and users' reputation
+    (see forum.votes)
+
+    :return: nothing
+    """
+    fold_pending_votes()
 
 
 @app.task
@@ -174,14 +256,29 @@ def mail(subject, message, sender, receiver, fail_silently=False):
     """
     task for sending mail
 
-    this function does nothing different from django.core.mail.send_mail, but is useful for sending deferred emails
-    avoiding responsiveness drop
+    the mail is queued and will be sent with the next batch by flush_mail (see forum.mailer)
 
     :param subject: email object
     :param message: email message
     :param sender: email from
     :param receiver: email to
-    :param fail_silently: flag for errors
+    :param fail_silently: unused, delivery errors are retried by flush_mail
+    :return: nothing
+    """
+    queue_mail(subject, message, sender, receiver)
+
+
+@app.task
+def flush_mail():
+    """
+    send queued mails
+
+    send due messages in batches over a single connection, until the queue is empty or a batch has failures (which will
+    be retried later)
+
     :return: nothing
     """
-    send_mail(subject, message, sender, receiver, fail_silently=fail_silently)
+    while True:
+        sent, failed = send_queued_mail()
+        if failed or not sent:
+            break
@@ -3,28 +3,109 @@ module for custom templates' tags
 """
 
 
-import os
-from djangle.settings import MEDIA_ROOT, MEDIA_URL
 from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
+from forum import avatars, pagecache
 
 register = template.Library()
 
 
-@register.filter(name='file_exists')
-def file_exists(filepath):
+@register.simple_tag
+def avatar_img(user, variant, **attrs):
     """
-    check if profile picture exists and return profile picture path
-    :param filepath: path to check
-    :return: return filepath if exists, else return default profile picture's path
+    render user's profile picture, without accessing the filesystem (see forum.avatars)
+
+    the variant resized for the size the picture is shown at is used, in WebP format for browsers supporting it and in
+    JPEG for the others. users without variants get their original picture or the default one
+    :param user: the user
+    :param variant: name of the variant (see forum.avatars.VARIANTS)
+    :param attrs: attributes of the img element (e.g. class)
+    :return: html of the picture
     """
-    try:
-        path = os.path.join(MEDIA_ROOT, filepath[len(MEDIA_URL):])
-        open(path)
-        return filepath
-    except Exception:
-        return os.path.join(MEDIA_URL, 'prof_pic', 'Djangle_user_default.png')
+    jpeg, webp = avatars.variant_urls(user, variant)
+    img = format_html('<img src="{}"{}>', jpeg or avatars.url(user), flatatt(attrs))
+    if webp is None:
+        return img
+    return format_html('<picture><source srcset="{}" type="image/webp">{}</picture>', webp, img)
 
 
 @register.filter
 def get_item(dictionary, key):
     return dictionary.get(key)
+
+
+@register.filter
+def moderates(user, board_pk):
+    """
+    check if user moderates a board, as moderator or supermoderator
+    :param user: the user
+    :param board_pk: primary key of the board
+    :return: True if user moderates the board, else False
+    """
+    return user.is_supermod() or int(board_pk) in [board.pk for board in user.modded_boards()]
+
+
+@register.filter
+def subscribes(user, thread_pk):
+    """
+    check if user subscribed a thread
+    :param user: the user
+    :param thread_pk: primary key of the thread
+    :return: True if user subscribed the thread, else False
+    """
+    return int(thread_pk) in [thread.pk for thread in user.subscribed_threads()]
+
+
+@register.simple_tag(takes_context=True)
+def esi(context, name, **params):
+    """
+    render a part of page depending on the viewer
+
+    usage: {% esi name param=value ... %}. the part is rendered by template forum/esi/<name>.html, which receives the
+    request and the parameters converted to strings. when the page is rendered for the page cache (see
+    forum.pagecache), an include marker is returned instead, and the part is rendered for each viewer when the page is
+    served.
+    """
+    params = dict((key, '' if value is None else str(value)) for key, value in params.items())
+    request = context.get('request')
+    if getattr(request, 'page_cache', False):
+        return mark_safe(pagecache.include_marker(name, params))
+    return mark_safe(pagecache.render_include(request, name, urlencode(params)))
+
+
+class FragmentNode(template.Node):
+    def __init__(self, nodelist, kind, pk):
+        self.nodelist = nodelist
+        self.kind = kind
+        self.pk = pk
+
+    def render(self, context):
+        fragments = context.get('fragments')
+        if fragments is None:
+            return self.nodelist.render(context)
+        key, content = fragments.get(self.kind.resolve(context), self.pk.resolve(context))
+        if content is None:
+            content = self.nodelist.render(context)
+            if key is not None:
+                fragments.set(key, content)
+        return content
+
+
+@register.tag
+def fragment(parser, token):
+    """
+    render a cached fragment of page
+
+    usage: {% fragment kind pk %} ... {% endfragment %}. content is read from the 'fragments' variable of the context
+    (see forum.fragments), or rendered and stored there if it isn't cached. without 'fragments' variable, content is
+    always rendered. content must not depend on the viewer.
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("'%s' tag requires kind and primary key" % bits[0])
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]))
@@ -0,0 +1,279 @@
+"""
+module for views' query budgets
+
+each forum view is requested through the test client while counting queries. views listing objects are requested
+before and after the database grows, and must issue the same number of queries: a query run for each listed object
+(e.g. a lazy foreign key read by the template) makes the second count bigger and fails the test. every count must also
+stay within the view's budget, so that new queries added to a page are noticed.
+"""
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from forum.models import Board, Thread, User, Moderation, Post, Comment, Vote, Subscription, Ban
+from djangle.settings import ELEM_PER_PAGE
+
+MANY = ELEM_PER_PAGE + 10
+"""
+number of objects created to grow the database: more than a page, so that paginated views show full pages
+"""
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    base class for query budgets' tests
+
+    requests are made by a logged in superuser, who is supermoderator too, so that every view is allowed
+    """
+    def setUp(self):
+        cache.clear()
+        self.board = Board.create('board name', 'bcode')
+        self.admin = User.objects.create(username='admin_user', email='admin@example.com', is_superuser=True,
+                                         is_staff=True)
+        self.admin.set_password('password')
+        self.admin.save()
+        self.admin.set_supermod()
+        self.client.login(username='admin_user', password='password')
+        self.users = 0
+        self.threads = 0
+
+    def make_user(self, prefix='user'):
+        self.users += 1
+        return User.objects.create(username='%s%d' % (prefix, self.users), email='user%d@example.com' % self.users)
+
+    def make_threads(self, count, board=None, author=None, title='thread', tag=None):
+        threads = []
+        for _ in range(count):
+            self.threads += 1
+            threads.append(Thread.create(title='%s %d' % (title, self.threads), message='first message',
+                                         board=board or self.board, author=author or self.make_user(), tag1=tag))
+        return threads
+
+    def count_queries(self, url, data=None, status=200):
+        """
+        request a page and count queries
+
+        caches are cleared first, so that cached values are not loaded by a previous request
+
+        :param url: page's url
+        :param data: data to post (optional, default a get request is made)
+        :param status: expected status code of the response
+        :return: number of queries
+        """
+        cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(url, data) if data is not None else self.client.get(url)
+        self.assertEqual(response.status_code, status)
+        return len(captured)
+
+    def assertBudget(self, url, budget, data=None, status=200):
+        """
+        assert that a request issues at most budget queries
+        """
+        count = self.count_queries(url, data, status)
+        self.assertLessEqual(count, budget, '%s issued %d queries, budget is %d' % (url, count, budget))
+
+    def assertConstant(self, url, grow, budget, data=None, status=200):
+        """
+        assert that a request issues the same number of queries before and after calling grow, and at most budget
+
+        :param url: page's url, or function returning it (called after grow too)
+        :param grow: function adding objects shown by the page
+        :param budget: maximum number of queries
+        """
+        get_url = url if callable(url) else lambda: url
+        small = self.count_queries(get_url(), data, status)
+        grow()
+        large = self.count_queries(get_url(), data, status)
+        self.assertEqual(small, large, '%s issued %d queries, then %d with more data' % (get_url(), small, large))
+        self.assertLessEqual(large, budget, '%s issued %d queries, budget is %d' % (get_url(), large, budget))
+
+
+class ListViewsQueryTest(QueryBudgetTestCase):
+    def test_index(self):
+        self.make_threads(2)
+
+        def grow():
+            for num in range(10):
+                self.make_threads(3, board=Board.create('board %d' % num, 'b%d' % num))
+        self.assertConstant(reverse('forum:index'), grow, 8)
+
+    def test_board_view(self):
+        self.make_threads(2)
+
+        def grow():
+            threads = self.make_threads(MANY)
+            threads[0].sticky = True
+            threads[0].save()
+            for thread in threads[1:]:
+                Post.create(message='reply', thread=thread, author=self.make_user())
+        self.assertConstant(reverse('forum:board', kwargs={'board_code': 'bcode', 'page': ''}), grow, 8)
+
+    def test_board_view_cursor(self):
+        self.make_threads(MANY)
+        response = self.client.get(reverse('forum:board', kwargs={'board_code': 'bcode', 'page': ''}))
+        cursor = response.context['thread_set'].next_cursor
+        self.assertBudget(reverse('forum:board_after', kwargs={'board_code': 'bcode', 'after': cursor}), 8)
+
+    def test_thread_view(self):
+        thread = self.make_threads(1)[0]
+        Post.create(message='reply', thread=thread, author=self.make_user())
+
+        def grow():
+            for _ in range(MANY):
+                post = Post.create(message='reply', thread=thread, author=self.make_user())
+                Comment.create(message='comment', post=post, author=self.make_user())
+                Vote.vote(post=post, user=self.make_user(), value=True)
+        self.assertConstant(reverse('forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}), grow, 12)
+
+    def test_profile(self):
+        user = self.make_user()
+        for thread in self.make_threads(2, author=user):
+            Post.create(message='reply', thread=thread, author=user)
+
+        def grow():
+            for thread in self.make_threads(MANY, author=user):
+                Post.create(message='reply', thread=thread, author=user)
+        self.assertConstant(reverse('forum:profile', kwargs={'username': user.username}), grow, 11)
+
+    def test_tag_view(self):
+        self.make_threads(2, tag='django')
+        self.assertConstant(reverse('forum:tag', kwargs={'tag': 'django', 'page': ''}),
+                            lambda: self.make_threads(MANY, tag='django'), 7)
+
+    def test_search_threads(self):
+        self.make_threads(2, title='django')
+        self.assertConstant(reverse('forum:search', kwargs={'page': ''}),
+                            lambda: self.make_threads(MANY, title='django'), 11,
+                            data={'search_item': 'thread', 'title': 'django'})
+
+    def test_search_users(self):
+        self.make_user('bench')
+        self.assertConstant(reverse('forum:search', kwargs={'page': ''}),
+                            lambda: [self.make_user('bench') for _ in range(MANY)], 10,
+                            data={'search_item': 'user', 'username': 'bench'})
+
+
+class AdminViewsQueryTest(QueryBudgetTestCase):
+    def make_boards(self, count):
+        boards = []
+        for _ in range(count):
+            self.threads += 1
+            boards.append(Board.create('board %d' % self.threads, 'b%d' % self.threads))
+        return boards
+
+    def test_manage_supermods(self):
+        self.make_user().set_supermod()
+
+        def grow():
+            for _ in range(10):
+                self.make_user().set_supermod()
+                self.make_user()
+        self.assertConstant(reverse('forum:supermods'), grow, 6)
+
+    def test_moderators_view(self):
+        Moderation.objects.create(user=self.make_user(), board=self.board)
+
+        def grow():
+            for board in self.make_boards(10):
+                for _ in range(2):
+                    Moderation.objects.create(user=self.make_user(), board=board)
+        self.assertConstant(reverse('forum:moderators'), grow, 8)
+
+    def test_manage_user_mod(self):
+        user = self.make_user()
+        Moderation.objects.create(user=user, board=self.board)
+
+        def grow():
+            for board in self.make_boards(10):
+                Moderation.objects.create(user=user, board=board)
+        self.assertConstant(reverse('forum:edit_mod', kwargs={'user_pk': user.pk}), grow, 8)
+
+    def test_manage_board_mod(self):
+        Moderation.objects.create(user=self.make_user(), board=self.board)
+
+        def grow():
+            for _ in range(10):
+                Moderation.objects.create(user=self.make_user(), board=self.board)
+                self.make_user()
+        self.assertConstant(reverse('forum:board_mod', kwargs={'board_code': 'bcode'}), grow, 8)
+
+    def test_create_board(self):
+        self.assertBudget(reverse('forum:create_board'), 5)
+        self.assertBudget(reverse('forum:create_board'), 8, data={'name': 'new board', 'code': 'new'}, status=302)
+
+
+class ActionViewsQueryTest(QueryBudgetTestCase):
+    def setUp(self):
+        super(ActionViewsQueryTest, self).setUp()
+        self.thread = self.make_threads(1)[0]
+        self.post = Post.create(message='reply', thread=self.thread, author=self.make_user())
+
+    def test_create_thread(self):
+        self.assertBudget(reverse('forum:create_thread'), 6)
+        self.assertBudget(reverse('forum:create_thread'), 28, status=302,
+                          data={'title': 'new thread', 'board': self.board.pk, 'message': 'message', 'tag1': 'django'})
+
+    def test_reply(self):
+        self.assertBudget(reverse('forum:thread', kwargs={'thread_pk': self.thread.pk, 'page': ''}), 22,
+                          data={'message': 'new reply'}, status=302)
+
+    def test_vote(self):
+        self.assertBudget(reverse('forum:pos_vote', kwargs={'post_pk': self.post.pk, 'vote': 'up'}), 14,
+                          status=302)
+        self.assertBudget(reverse('forum:neg_vote', kwargs={'post_pk': self.post.pk, 'vote': 'down'}), 12,
+                          status=302)
+
+    def test_comment(self):
+        self.assertBudget(reverse('forum:comment', kwargs={'post_pk': self.post.pk}), 10,
+                          data={'message': 'new comment'}, status=302)
+
+    def test_del_comment(self):
+        comment = Comment.create(message='comment', post=self.post, author=self.make_user())
+        self.assertBudget(reverse('forum:del_comment', kwargs={'comment_pk': comment.pk}), 20, status=302)
+
+    def test_del_post(self):
+        self.assertBudget(reverse('forum:del_post', kwargs={'post_pk': self.post.pk}), 31, status=302)
+
+    def test_del_thread(self):
+        self.assertBudget(reverse('forum:del_post', kwargs={'post_pk': self.thread.first_post.pk}), 38, status=302)
+
+    def test_edit_profile(self):
+        self.assertBudget(reverse('forum:edit_profile'), 6)
+        self.assertBudget(reverse('forum:edit_profile'), 7, data={'first_name': 'first'})
+        self.assertBudget(reverse('forum:reset_first_name', kwargs={'field': 'first_name'}), 6, status=302)
+
+    def test_subscriptions(self):
+        self.assertBudget(reverse('forum:subscribe', kwargs={'thread_pk': self.thread.pk}), 6)
+        self.assertBudget(reverse('forum:subscribe', kwargs={'thread_pk': self.thread.pk}), 9,
+                          data={'async': 'on', 'interval': '900.0'}, status=302)
+        self.assertEqual(Subscription.objects.filter(user=self.admin).count(), 1)
+        self.assertBudget(reverse('forum:unsubscribe', kwargs={'thread_pk': self.thread.pk}), 10, status=302)
+
+    def test_thread_toggles(self):
+        self.assertBudget(reverse('forum:toggle_close_thread', kwargs={'thread_pk': self.thread.pk}), 10,
+                          status=302)
+        self.assertBudget(reverse('forum:stick_thread', kwargs={'thread_pk': self.thread.pk}), 7, status=302)
+
+    def test_bans(self):
+        user = self.make_user()
+        self.assertBudget(reverse('forum:ban_user', kwargs={'user_pk': user.pk}), 6)
+        self.assertBudget(reverse('forum:ban_user', kwargs={'user_pk': user.pk}), 17, status=302,
+                          data={'duration': '86400.0', 'reason': 'spam'})
+        self.assertEqual(Ban.objects.filter(user=user).count(), 1)
+        self.assertBudget(reverse('forum:unban_user', kwargs={'user_pk': user.pk}), 12, status=302)
+
+    def test_moderation_changes(self):
+        user = self.make_user()
+        Moderation.objects.create(user=user, board=self.board)
+        self.assertBudget(reverse('forum:remove_mod', kwargs={'user_pk': user.pk, 'board_code': 'bcode'}), 10,
+                          status=302)
+        self.assertBudget(reverse('forum:supermod_toggle', kwargs={'user_pk': user.pk}), 13, status=302)
+        self.assertTrue(Group.objects.get(name='supermod').user_set.filter(pk=user.pk).exists())
+
+    def test_new_search(self):
+        self.assertBudget(reverse('forum:new_search'), 5)
+        self.assertBudget(reverse('forum:new_search'), 8, data={'search_item': 'thread', 'title': 'django'},
+                          status=302)
@@ -1,12 +1,41 @@
 import datetime
+import json
+import pickle
+import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from unittest.mock import patch
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.template import Context, Template
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from django.utils.http import urlquote
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
-from forum.models import Board, Thread, User, Moderation
+from forum.models import Board, Thread, User, Moderation, GenericPost, Post, Comment, Subscription, Tag, Vote, \
+    VoteDelta, QueuedMail, Ban
 from forum.forms import BoardForm
+from forum.pagination import KeysetPaginator
+from forum.queries import latest_threads
+from forum.search import search_threads
+from forum.votes import add_to_counters, fold_votes, reconcile_votes
+from forum.instrumentation import Histogram, read_histograms
+from forum.tasks import async_mail, sync_mail, flush_mail, check_ban, expire_ban
+from forum.mailer import queue_mail, send_queued_mail
+from forum import avatars, pagecache, payloads, roles
+from forum.caching import get_versions
 from djangle import settings
+from PIL import Image, ImageOps
 
 
 # Create your tests here.
@@ -54,6 +83,950 @@ class BoardTest(TestCase):
         self.assertEqual(threads3, thread_list)
 
 
+class ThreadActivityTest(TestCase):
+    def setUp(self):
+        self.board = Board.create('board name', 'bcode')
+        self.user = User.objects.create(username='pippo', email='pippo@pluto.com')
+        self.other = User.objects.create(username='pluto', email='pluto@pippo.com')
+
+    def test_activity_after_creation(self):
+        thread = Thread.create('title', 'message', self.board, self.user)
+        post = Post.create('reply', thread, self.other)
+        thread = Thread.objects.get(pk=thread.pk)
+        self.assertEqual(thread.post_count, 2)
+        self.assertEqual(thread.latest_post, post)
+        self.assertEqual(thread.last_poster, self.other)
+        self.assertEqual(thread.last_activity, post.pub_date)
+        self.assertEqual(thread.last_post(), post)
+
+    def test_activity_after_removal(self):
+        thread = Thread.create('title', 'message', self.board, self.user)
+        Post.create('reply', thread, self.other).remove()
+        thread = Thread.objects.get(pk=thread.pk)
+        self.assertEqual(thread.post_count, 1)
+        self.assertEqual(thread.latest_post, thread.first_post)
+        self.assertEqual(thread.last_poster, self.user)
+
+    def test_thread_removal_updates_authors(self):
+        thread = Thread.create('title', 'message', self.board, self.user)
+        Post.create('reply', thread, self.other)
+        Post.create('reply', thread, self.other)
+        thread.remove()
+        self.assertEqual(User.objects.get(pk=self.user.pk).posts, 0)
+        self.assertEqual(User.objects.get(pk=self.other.pk).posts, 0)
+        self.assertFalse(Post.objects.exists())
+
+    def test_post_ordinals(self):
+        thread = Thread.create('title', 'message', self.board, self.user)
+        posts = [thread.first_post] + [Post.create(str(i), thread, self.other) for i in range(3)]
+        self.assertEqual([post.ordinal for post in posts], [1, 2, 3, 4])
+        posts[1].remove()
+        ordinals = Post.objects.filter(thread=thread).order_by('pub_date').values_list('ordinal', flat=True)
+        self.assertEqual(list(ordinals), [1, 2, 3])
+
+    def test_get_pages(self):
+        thread = Thread.create('title', 'message', self.board, self.user)
+        posts = [Post.create(str(i), thread, self.other) for i in range(settings.ELEM_PER_PAGE)]
+        self.assertEqual(posts[-1].get_page(), 2)
+        self.assertEqual(Post.get_pages([posts[0].pk, posts[-1]]), {posts[0].pk: 1, posts[-1].pk: 2})
+
+    def test_sticky_threads_first(self):
+        sticky = Thread.create('sticky', 'message', self.board, self.user)
+        sticky.sticky = True
+        sticky.save()
+        thread = Thread.create('thread', 'message', self.board, self.user)
+        self.assertEqual(list(self.board.get_threads()), [sticky, thread])
+
+
+class KeysetPaginatorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        board = Board.create('board name', 'bcode')
+        user = User.objects.create(username='pippo', email='pippo@pluto.com')
+        self.thread = Thread.create('title', 'message', board, user)
+        for i in range(44):
+            Post.create(str(i), self.thread, user)
+        self.posts = list(self.thread.post_set.order_by('pub_date', 'pk'))
+
+    def get_paginator(self):
+        return KeysetPaginator(self.thread.post_set.all(), (('pub_date', False), ('pk', False)), 20,
+                               'thread:%d' % self.thread.pk)
+
+    def test_numbered_pages(self):
+        paginator = self.get_paginator()
+        self.assertEqual(paginator.num_pages, 3)
+        self.assertEqual(list(paginator.page(2)), self.posts[20:40])
+        self.assertEqual(list(paginator.page('pippo')), self.posts[:20])
+        self.assertEqual(list(paginator.page(10)), self.posts[40:])
+
+    def test_cursor_pages(self):
+        paginator = self.get_paginator()
+        first = paginator.page(1)
+        second = paginator.page_after(first.next_cursor)
+        self.assertEqual(list(second), self.posts[20:40])
+        self.assertEqual(second.number, 2)
+        self.assertTrue(second.has_previous() and second.has_next())
+        self.assertEqual(list(paginator.page_before(second.previous_cursor)), self.posts[:20])
+        self.assertFalse(paginator.page_after(second.next_cursor).has_next())
+
+    def test_boundaries_follow_new_posts(self):
+        self.assertEqual(self.get_paginator().num_pages, 3)
+        for i in range(15):
+            Post.create(str(i), self.thread, self.thread.first_post.author)
+        self.assertEqual(self.get_paginator().num_pages, 3)
+        Post.create('new page', self.thread, self.thread.first_post.author)
+        self.assertEqual(self.get_paginator().num_pages, 4)
+
+    def test_position_pages(self):
+        self.thread.refresh_from_db()
+        paginator = KeysetPaginator(self.thread.post_set.all(), (('pub_date', False), ('pk', False)), 20,
+                                    position='ordinal', count=self.thread.post_count)
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.num_pages, 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(paginator.page(2)), self.posts[20:40])
+        self.assertEqual(list(paginator.page(10)), self.posts[40:])
+        second = paginator.page_after(paginator.page(1).next_cursor)
+        self.assertEqual(second.number, 2)
+        self.posts[5].remove()
+        self.thread.refresh_from_db()
+        paginator = KeysetPaginator(self.thread.post_set.all(), (('pub_date', False), ('pk', False)), 20,
+                                    position='ordinal', count=self.thread.post_count)
+        self.assertEqual(list(paginator.page(1)), self.posts[:5] + self.posts[6:21])
+
+    def test_board_boundaries_ignore_comments(self):
+        board = self.thread.board
+        threads = board.get_threads()
+
+        def get_paginator():
+            return KeysetPaginator(threads, (('sticky', True), ('last_activity', True), ('pk', True)), 20,
+                                   'listing:board:%d' % board.pk)
+        self.assertEqual(get_paginator().num_pages, 1)
+        Comment.create('comment', self.posts[1], self.thread.first_post.author)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_paginator().num_pages, 1)
+        for i in range(20):
+            Thread.create('thread %d' % i, 'message', board, self.thread.first_post.author)
+        self.assertEqual(get_paginator().num_pages, 2)
+
+
+class IndexViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='usertest', password='password', email='test@email.com')
+
+    def create_boards(self, num):
+        for i in range(Board.objects.count(), Board.objects.count() + num):
+            board = Board.create('board' + str(i), 'b' + str(i))
+            for j in range(7):
+                Thread.create('thread' + str(j), 'message', board, self.user)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('forum:index'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_latest_threads(self):
+        self.create_boards(2)
+        boards = list(Board.objects.all())
+        threads = latest_threads(boards, 5)
+        for board in boards:
+            self.assertEqual(threads[board.pk], board.get_latest(5))
+
+    def test_constant_queries(self):
+        self.client.login(username='usertest', password='password')
+        self.create_boards(1)
+        queries = self.count_queries()
+        self.create_boards(3)
+        self.assertEqual(self.count_queries(), queries)
+
+
+class UserRolesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='usertest', password='password', email='test@email.com')
+        self.board = Board.create('board', 'b')
+
+    def test_memoized_roles(self):
+        self.user.load_roles()
+        self.user.subscribed_threads()
+        with self.assertNumQueries(0):
+            self.assertFalse(self.user.is_supermod())
+            self.assertFalse(self.user.is_mod())
+            self.assertEqual(self.user.modded_boards(), [])
+            self.assertEqual(self.user.subscribed_threads(), [])
+
+    def test_shared_roles_cache(self):
+        Moderation.objects.create(user=self.user, board=self.board)
+        User.objects.get(pk=self.user.pk).load_roles()
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.modded_boards(), [self.board])
+            self.assertEqual(user.modded_boards()[0].code, self.board.code)
+            self.assertFalse(user.is_supermod())
+        self.user.set_supermod(True)
+        self.assertTrue(User.objects.get(pk=self.user.pk).is_supermod())
+
+    def test_invalidation(self):
+        self.assertFalse(self.user.is_supermod())
+        self.user.set_supermod(True)
+        self.assertTrue(self.user.is_supermod())
+        mod = Moderation.objects.create(user=self.user, board=self.board)
+        self.assertEqual(self.user.modded_boards(), [self.board])
+        mod.delete()
+        self.assertEqual(self.user.modded_boards(), [])
+        thread = Thread.create('title', 'message', self.board, self.user)
+        Subscription.create(thread, self.user, False)
+        self.assertEqual(self.user.subscribed_threads(), [thread])
+
+    def test_badges(self):
+        cache.clear()
+        other = Board.create('other', 'o')
+        moderator = User.objects.create(username='moderator', email='moderator@email.com')
+        Moderation.objects.create(user=moderator, board=self.board)
+        supermod = User.objects.create(username='supermod', email='supermod@email.com')
+        supermod.set_supermod(True)
+        admin = User.objects.create(username='superuser', email='superuser@email.com', is_superuser=True)
+        users = [self.user, moderator, supermod, admin]
+        with self.assertNumQueries(2):
+            badges = roles.badges(users, self.board)
+        self.assertEqual(badges, {self.user.pk: roles.USER_BADGE, moderator.pk: roles.MODERATOR_BADGE,
+                                  supermod.pk: roles.SUPERMOD_BADGE, admin.pk: roles.ADMIN_BADGE})
+        with self.assertNumQueries(0):
+            badges = roles.badges(users, other)
+        self.assertEqual(badges[moderator.pk], roles.USER_BADGE)
+        self.assertEqual(roles.get_masks(users)[moderator.pk], roles.get_mask(moderator))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        board = Board.create('board name', 'bcode')
+        self.user = User.objects.create(username='pippo', email='pippo@pluto.com')
+        other = User.objects.create(username='pluto', email='pluto@pippo.com')
+        self.first = Thread.create('Django forms', 'how to validate forms', board, self.user, tag1='django')
+        self.second = Thread.create('Celery tasks', 'about django celery', board, other, tag1='celery')
+        self.post = Post.create('unique words here', self.second, self.user)
+
+    def results(self, **kwargs):
+        return [result['thread'] for result in search_threads(**kwargs)]
+
+    def test_search_by_title(self):
+        self.assertEqual(self.results(title='djan'), [self.first.pk, self.second.pk])
+        self.assertEqual(self.results(title='django celery'), [self.second.pk])
+        self.assertEqual(self.results(title='nothing'), [])
+
+    def test_search_by_tag_and_author(self):
+        self.assertEqual(self.results(tag='celery'), [self.second.pk])
+        self.assertEqual(self.results(username='pip'), [self.first.pk])
+        self.assertEqual(self.results(title='forms', username='plu'), [])
+
+    def test_deleted_posts_are_not_found(self):
+        self.assertEqual(self.results(title='unique'), [self.second.pk])
+        self.post.remove()
+        self.assertEqual(self.results(title='unique'), [])
+        self.second.remove()
+        self.assertEqual(self.results(tag='celery'), [])
+
+    def test_admin_edits_are_indexed(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@pluto.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.post(reverse('admin:forum_thread_change', args=(self.first.pk,)), {
+            'title': 'Templates rendering', 'first_post': self.first.first_post_id, 'board': self.first.board_id,
+            'tag1': 'jinja', 'tag2': '', 'tag3': '', 'close_date_0': '', 'close_date_1': '', 'closer': ''})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.results(title='templates'), [self.first.pk])
+        self.assertEqual(self.results(title='forms'), [self.first.pk])
+        self.assertEqual(self.results(tag='jinja'), [self.first.pk])
+        self.assertEqual(self.results(tag='django'), [])
+        self.assertEqual(self.results(username='pip'), [self.first.pk])
+        response = self.client.post(reverse('admin:forum_post_change', args=(self.post.pk,)), {
+            'thread': self.second.pk, 'message': 'different text', 'author': admin_user.pk,
+            'pub_date_0': '2016-01-01', 'pub_date_1': '10:00:00'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.results(title='unique'), [])
+        self.assertEqual(self.results(title='different'), [self.second.pk])
+
+    def test_search_view(self):
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username='pippo', password='password')
+        response = self.client.post(reverse('forum:search', kwargs={'page': ''}), {'query_title': 'django'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['threads']), [self.first, self.second])
+
+
+class TagTest(TestCase):
+    def setUp(self):
+        self.board = Board.create('board name', 'bcode')
+        self.user = User.objects.create(username='pippo', email='pippo@pluto.com')
+
+    def test_thread_count(self):
+        first = Thread.create('first', 'message', self.board, self.user, tag1='django', tag2='celery')
+        Thread.create('second', 'message', self.board, self.user, tag1='django')
+        self.assertEqual(Tag.objects.get(name='django').thread_count, 2)
+        self.assertEqual(Tag.objects.get(name='celery').thread_count, 1)
+        first.tag2 = 'python'
+        first.save()
+        first.update_tags()
+        self.assertEqual(Tag.objects.get(name='celery').thread_count, 0)
+        self.assertEqual(Tag.objects.get(name='python').thread_count, 1)
+        first.remove()
+        self.assertEqual(Tag.objects.get(name='django').thread_count, 1)
+        self.assertEqual(Tag.objects.get(name='python').thread_count, 0)
+
+    def test_tag_view(self):
+        first = Thread.create('first', 'message', self.board, self.user, tag1='django')
+        second = Thread.create('second', 'message', self.board, self.user, tag2='django')
+        Thread.create('third', 'message', self.board, self.user, tag1='celery')
+        Post.create('reply', first, self.user)
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username='pippo', password='password')
+        response = self.client.get(reverse('forum:tag', kwargs={'tag': 'django', 'page': ''}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['threads']), [first, second])
+        response = self.client.get(reverse('forum:tag', kwargs={'tag': 'unknown', 'page': ''}))
+        self.assertEqual(list(response.context['threads']), [])
+
+
+class VoteTest(TestCase):
+    def setUp(self):
+        board = Board.create('board name', 'bcode')
+        self.author = User.objects.create(username='pippo', email='pippo@pluto.com')
+        self.voter = User.objects.create(username='pluto', email='pluto@pippo.com')
+        self.post = Thread.create('title', 'message', board, self.author).first_post
+
+    def assertCounters(self, pos, neg):
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual((post.pos_votes, post.neg_votes), (pos, neg))
+        self.assertEqual((self.post.pos_votes, self.post.neg_votes), (pos, neg))
+        self.assertEqual(User.objects.get(pk=self.author.pk).rep, pos - neg)
+
+    def test_vote_change_and_withdrawal(self):
+        self.assertIsInstance(Vote.vote(self.post, self.voter, True), Vote)
+        self.assertCounters(1, 0)
+        Vote.vote(self.post, self.voter, False)
+        self.assertCounters(0, 1)
+        self.assertIsNone(Vote.vote(self.post, self.voter, False))
+        self.assertCounters(0, 0)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_author_cannot_vote(self):
+        self.assertIsNone(Vote.vote(self.post, self.author, True))
+        self.assertCounters(0, 0)
+
+    @override_settings(ASYNC_VOTES=True)
+    def test_async_votes(self):
+        other = User.objects.create(username='paperino', email='paperino@pluto.com')
+        Vote.vote(self.post, self.voter, True)
+        Vote.vote(self.post, other, True)
+        Vote.vote(self.post, other, False)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).pos_votes, 0)
+        self.assertEqual(fold_votes(), 3)
+        self.assertFalse(VoteDelta.objects.exists())
+        self.post = Post.objects.get(pk=self.post.pk)
+        self.assertCounters(1, 1)
+        self.assertEqual(fold_votes(), 0)
+
+    def test_late_deltas_are_not_lost(self):
+        gap = VoteDelta.objects.create(post_id=self.post.pk, author_id=self.author.pk, pos=1, neg=0)
+        VoteDelta.objects.create(post_id=self.post.pk, author_id=self.author.pk, pos=1, neg=0)
+        VoteDelta.objects.create(post_id=self.post.pk, author_id=self.author.pk, pos=1, neg=0)
+        gap_pk = gap.pk
+        gap.delete()
+
+        def late_delta(model, deltas):
+            # a delta having a smaller primary key commits while the others are folded
+            if not VoteDelta.objects.filter(pk=gap_pk).exists():
+                VoteDelta.objects.create(pk=gap_pk, post_id=self.post.pk, author_id=self.author.pk, pos=1, neg=0)
+            add_to_counters(model, deltas)
+        with patch('forum.votes.add_to_counters', late_delta):
+            self.assertEqual(fold_votes(), 2)
+        self.assertEqual(list(VoteDelta.objects.values_list('pk', flat=True)), [gap_pk])
+        self.assertEqual(fold_votes(), 1)
+        self.post = Post.objects.get(pk=self.post.pk)
+        self.assertCounters(3, 0)
+
+    def test_reconcile_votes(self):
+        Vote.vote(self.post, self.voter, True)
+        Post.objects.filter(pk=self.post.pk).update(pos_votes=5, neg_votes=2)
+        User.objects.filter(pk=self.author.pk).update(rep=7)
+        self.assertEqual(reconcile_votes(), (1, 1))
+        self.assertCounters(1, 0)
+
+
+class VoteConcurrencyTest(TransactionTestCase):
+    def test_interleaved_votes(self):
+        board = Board.create('board name', 'bcode')
+        author = User.objects.create(username='author', email='author@pluto.com')
+        pk = Thread.create('title', 'message', board, author).first_post.pk
+        voters = [User.objects.create(username='voter%d' % num, email='voter%d@pluto.com' % num) for num in range(2)]
+        # both requests load the post before any vote is counted
+        first, second = Post.objects.get(pk=pk), Post.objects.get(pk=pk)
+        update = QuerySet.update
+        interleaved = []
+
+        def interleave(queryset, **kwargs):
+            # second vote is fully counted between first vote's read and its counters' update
+            if 'pos_votes' in kwargs and not interleaved:
+                interleaved.append(True)
+                Vote.vote(second, voters[1], True)
+            return update(queryset, **kwargs)
+        with patch.object(QuerySet, 'update', interleave):
+            Vote.vote(first, voters[0], True)
+        self.assertTrue(interleaved)
+        self.assertEqual(Post.objects.get(pk=pk).pos_votes, 2)
+        self.assertEqual(User.objects.get(pk=author.pk).rep, 2)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_parallel_votes(self):
+        """
+        run votes in parallel threads, only on databases with row locks (e.g. PostgreSQL or MySQL): sqlite serializes
+        writers, see test_interleaved_votes for a check running on every database
+        """
+        board = Board.create('board name', 'bcode')
+        author = User.objects.create(username='author', email='author@pluto.com')
+        post = Thread.create('title', 'message', board, author).first_post
+        voters = [User.objects.create(username='voter%d' % num, email='voter%d@pluto.com' % num)
+                  for num in range(20)]
+        errors = []
+
+        def vote(voter, value):
+            try:
+                Vote.vote(Post.objects.get(pk=post.pk), voter, value)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        # every other voter votes twice in parallel: the second vote changes or withdraws the first one
+        workers = [threading.Thread(target=vote, args=(voter, num % 3 != 0)) for num, voter in enumerate(voters)]
+        workers += [threading.Thread(target=vote, args=(voter, False)) for voter in voters[1::2]]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        post = Post.objects.get(pk=post.pk)
+        votes = Vote.objects.filter(post=post)
+        self.assertEqual(post.pos_votes, votes.filter(value=True).count())
+        self.assertEqual(post.neg_votes, votes.filter(value=False).count())
+        self.assertEqual(User.objects.get(pk=author.pk).rep, post.pos_votes - post.neg_votes)
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class AsyncMailTest(TestCase):
+    def setUp(self):
+        self.board = Board.create('board name', 'bcode')
+        self.author = User.objects.create(username='pippo', email='pippo@pluto.com')
+
+    def subscribe(self, num):
+        past = timezone.now() - datetime.timedelta(hours=1)
+        for thread in Thread.objects.all():
+            for index in range(num):
+                user, created = User.objects.get_or_create(username='user%d' % index,
+                                                           defaults={'email': 'user%d@pluto.com' % index})
+                subscription = Subscription.create(thread, user, True, datetime.timedelta(minutes=15))[0]
+                subscription.last_sync = past
+                subscription.save()
+
+    def test_digest(self):
+        first = Thread.create('first', 'first message', self.board, self.author)
+        second = Thread.create('second', 'second message', self.board, self.author)
+        self.subscribe(2)
+        Post.create('reply', first, self.author)
+        async_mail()
+        flush_mail()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('first message', mail.outbox[0].body)
+        self.assertIn('reply', mail.outbox[0].body)
+        self.assertIn('second message', mail.outbox[0].body)
+        self.assertFalse(Subscription.objects.filter(last_sync__lt=timezone.now() - datetime.timedelta(minutes=1)))
+        mail.outbox = []
+        async_mail()
+        flush_mail()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_next_due(self):
+        thread = Thread.create('first', 'first message', self.board, self.author)
+        subscription = Subscription.create(thread, self.author, True, datetime.timedelta(minutes=15))[0]
+        self.assertIsNone(subscription.next_due)
+        self.assertFalse(subscription.is_expired())
+        self.subscribe(1)
+        subscription = Subscription.objects.get(user__username='user0')
+        self.assertEqual(subscription.next_due, subscription.last_sync + datetime.timedelta(minutes=15))
+        self.assertTrue(subscription.is_expired())
+        async_mail()
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertIsNone(subscription.next_due)
+        self.assertFalse(subscription.is_expired(timezone.now() + datetime.timedelta(days=1)))
+        Post.create('reply', thread, self.author)
+        for subscription in Subscription.objects.all():
+            self.assertEqual(subscription.next_due, subscription.last_sync + datetime.timedelta(minutes=15))
+        Subscription.objects.update(next_due=None)
+        call_command('refresh_subscriptions', stdout=StringIO())
+        for subscription in Subscription.objects.all():
+            self.assertEqual(subscription.next_due, subscription.last_sync + datetime.timedelta(minutes=15))
+
+    def test_quiet_threads_are_not_due(self):
+        first = Thread.create('first', 'first message', self.board, self.author)
+        Thread.create('second', 'second message', self.board, self.author)
+        self.subscribe(1)
+        async_mail()
+        Post.create('reply', first, self.author)
+        due = Subscription.objects.filter(next_due__isnull=False)
+        self.assertEqual([subscription.thread_id for subscription in due], [first.pk])
+        with CaptureQueriesContext(connection) as queries:
+            Post.create('another reply', first, self.author)
+        self.assertEqual(len([query for query in queries if 'next_due' in query['sql']]), 1)
+        self.assertEqual(Subscription.objects.get(thread=first).next_due, due[0].next_due)
+
+    def test_constant_number_of_queries(self):
+        for num in range(3):
+            Thread.create('thread %d' % num, 'message', self.board, self.author)
+        self.subscribe(5)
+        with CaptureQueriesContext(connection) as queries:
+            async_mail()
+        self.assertEqual(QueuedMail.objects.count(), 5)
+        self.assertEqual(len(queries), 5)
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class PayloadTest(TestCase):
+    def setUp(self):
+        board = Board.create('board name', 'bcode')
+        self.user = User.objects.create(username='pippo', email='pippo@pluto.com')
+        self.thread = Thread.create('title', 'message', board, self.user)
+        self.post = Post.create('reply', self.thread, self.user)
+
+    def test_snapshot(self):
+        payload = payloads.dump(self.post, *payloads.POST)
+        data = json.dumps(payload)
+        self.assertLess(len(data), len(pickle.dumps(self.post)))
+        post = payloads.load(json.loads(data))
+        self.assertEqual(post.pk, self.post.pk)
+        self.assertEqual(post.pub_date, self.post.pub_date)
+        self.assertEqual(post.author.email, 'pippo@pluto.com')
+        self.assertEqual(post.thread.title, 'title')
+
+    def test_sync_mail(self):
+        other = User.objects.create(username='pluto', email='pluto@pippo.com')
+        Subscription.create(self.thread, other, False)
+        sync_mail(json.loads(json.dumps(payloads.dump(self.post, *payloads.POST))))
+        flush_mail()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('reply', mail.outbox[0].body)
+        self.assertEqual(Subscription.objects.get(user=other).last_sync, self.post.pub_date)
+
+    def test_sync_mail_chunks(self):
+        users = [User.objects.create(username='user%d' % num, email='user%d@pluto.com' % num) for num in range(5)]
+        for user in users:
+            Subscription.create(self.thread, user, False)
+        with patch('forum.tasks.SYNC_MAIL_CHUNK', 2):
+            sync_mail(payloads.dump(self.post, *payloads.POST))
+        flush_mail()
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), sorted(user.email for user in users))
+        self.assertEqual(Subscription.objects.filter(last_sync=self.post.pub_date).count(), 5)
+
+    def test_deletion_mail(self):
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username='pippo', password='password')
+        self.client.get(reverse('forum:del_post', kwargs={'post_pk': self.post.pk}))
+        self.assertFalse(Post.objects.filter(pk=self.post.pk).exists())
+        flush_mail()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('reply', mail.outbox[0].body)
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    """
+    in-memory email backend failing for recipients at example.com, counting opened connections
+    """
+    opened = 0
+
+    def open(self):
+        FailingEmailBackend.opened += 1
+        return super(FailingEmailBackend, self).open()
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any(recipient.endswith('@example.com') for recipient in message.to):
+                raise IOError('recipient refused')
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='forum.tests.FailingEmailBackend', MAIL_BATCH_SIZE=3)
+class MailerTest(TestCase):
+    def test_batches(self):
+        FailingEmailBackend.opened = 0
+        for num in range(5):
+            queue_mail('subject %d' % num, 'message', None, ['user%d@pluto.com' % num])
+        self.assertEqual(send_queued_mail(), (3, 0))
+        self.assertEqual(FailingEmailBackend.opened, 1)
+        flush_mail()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(QueuedMail.objects.exists())
+
+    def test_claimed_messages_are_skipped(self):
+        queue_mail('subject', 'message', None, ['user@pluto.com'])
+        concurrent = []
+        send_messages = FailingEmailBackend.send_messages
+
+        def send_while_sending(backend, messages):
+            # another worker flushes the queue while this one talks to the mail server
+            concurrent.append(send_queued_mail())
+            return send_messages(backend, messages)
+        with patch.object(FailingEmailBackend, 'send_messages', send_while_sending):
+            self.assertEqual(send_queued_mail(), (1, 0))
+        self.assertEqual(concurrent, [(0, 0)])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(QueuedMail.objects.exists())
+
+    def test_retry_with_backoff(self):
+        queue_mail('subject', 'message', None, ['user@example.com'])
+        queue_mail('subject', 'message', None, ['user@pluto.com'])
+        self.assertEqual(send_queued_mail(), (1, 1))
+        queued = QueuedMail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertGreater(queued.next_try, timezone.now() + datetime.timedelta(seconds=settings.MAIL_RETRY_DELAY - 5))
+        self.assertEqual(send_queued_mail(), (0, 0))
+        for attempt in range(2, settings.MAIL_MAX_ATTEMPTS + 1):
+            QueuedMail.objects.update(next_try=timezone.now())
+            send_queued_mail()
+        queued = QueuedMail.objects.get()
+        self.assertEqual(queued.attempts, settings.MAIL_MAX_ATTEMPTS)
+        self.assertIsNone(queued.next_try)
+
+
+class BanExpiryTest(TestCase):
+    def setUp(self):
+        self.banner = User.objects.create(username='banner', email='banner@pluto.com')
+
+    def ban(self, username, days_ago, days):
+        user, created = User.objects.get_or_create(username=username, defaults={'email': username + '@pluto.com'})
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        duration = None if days is None else datetime.timedelta(days=days)
+        return Ban.objects.create(user=user, start=timezone.now() - datetime.timedelta(days=days_ago),
+                                  duration=duration, banner=self.banner, reason='reason')
+
+    def test_expires_at(self):
+        ban = self.ban('pippo', 2, 1)
+        self.assertEqual(ban.expires_at, ban.start + datetime.timedelta(days=1))
+        self.assertIsNone(self.ban('pluto', 2, None).expires_at)
+        Ban.objects.update(expires_at=None)
+        call_command('refresh_bans', stdout=StringIO())
+        self.assertEqual(Ban.objects.get(pk=ban.pk).expires_at, ban.expires_at)
+
+    def test_check_ban(self):
+        self.ban('expired', 2, 1)
+        self.ban('active', 2, 7)
+        self.ban('permanent', 2, None)
+        self.ban('twice', 3, 1)
+        self.ban('twice', 1, 7)
+        with CaptureQueriesContext(connection) as queries:
+            check_ban()
+        self.assertLessEqual(len(queries), 8)
+        self.assertEqual(list(Ban.objects.order_by('user__username').values_list('user__username', flat=True)),
+                         ['active', 'permanent', 'twice'])
+        self.assertEqual(list(User.objects.filter(is_active=True).exclude(pk=self.banner.pk)
+                              .values_list('username', flat=True)), ['expired'])
+        self.assertEqual(list(QueuedMail.objects.values_list('recipients', flat=True)), ['expired@pluto.com'])
+
+    def test_is_banned(self):
+        cache.clear()
+        user = User.objects.create(username='pippo', email='pippo@pluto.com')
+        self.assertFalse(user.is_banned())
+        ban = self.ban('pippo', 0, 1)
+        self.assertTrue(User.objects.get(pk=user.pk).is_banned())
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.is_banned())
+        self.assertTrue(Ban.active().filter(user=user).exists())
+        ban.remove()
+        self.assertFalse(User.objects.get(pk=user.pk).is_banned())
+        self.ban('pippo', 2, 1)
+        self.assertFalse(User.objects.get(pk=user.pk).is_banned())
+
+    def test_expire_ban(self):
+        ban = self.ban('pippo', 2, 1)
+        other = self.ban('pluto', 2, 1)
+        expire_ban(ban.pk)
+        self.assertEqual(list(Ban.objects.all()), [other])
+        self.assertTrue(User.objects.get(username='pippo').is_active)
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.mean(), 50.5)
+        self.assertTrue(50 <= histogram.percentile(50) <= 50 * 2 ** 0.5)
+        self.assertTrue(99 <= histogram.percentile(99) <= 99 * 2 ** 0.5)
+        copy = Histogram.load(histogram.dump_buckets(), histogram.count, histogram.total)
+        copy.merge(histogram)
+        self.assertEqual(copy.count, 200)
+        self.assertEqual(copy.percentile(50), histogram.percentile(50))
+
+    def test_middleware(self):
+        Board.create('board name', 'bcode')
+        with self.settings(INSTRUMENTATION=True, INSTRUMENTATION_CSV=self.path, INSTRUMENTATION_FLUSH_INTERVAL=0):
+            self.client.get(reverse('forum:index'))
+            self.client.get(reverse('forum:index'))
+        histograms = read_histograms(self.path)
+        self.assertEqual(histograms[('forum:index', 'queries')].count, 2)
+        self.assertGreater(histograms[('forum:index', 'bytes')].total, 0)
+        self.assertGreater(histograms[('forum:index', 'template_ms')].total, 0)
+        output = StringIO()
+        call_command('view_stats', csv=self.path, stdout=output)
+        self.assertIn('forum:index', output.getvalue())
+
+
+class BenchmarkTest(TestCase):
+    def test_generate_and_benchmark(self):
+        call_command('generate_forum', boards=2, users=10, threads=3, posts=5, bans=1, stdout=StringIO())
+        self.assertEqual(Thread.objects.filter(board__code__startswith='bench').count(), 6)
+        for thread in Thread.objects.all():
+            self.assertEqual(thread.post_count, thread.post_set.count())
+            self.assertEqual(thread.first_post, thread.post_set.get(ordinal=1))
+            self.assertEqual(thread.latest_post, thread.post_set.get(ordinal=thread.post_count))
+        output = StringIO()
+        call_command('benchmark', 'index', 'thread_view', 'task_async_mail', repeat=1, stdout=output)
+        self.assertIn('thread_view', output.getvalue())
+        self.assertIn('task_async_mail', output.getvalue())
+
+
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.board = Board.create('board name', 'bcode')
+        self.author = User.objects.create_user(username='author', password='password', email='author@email.com')
+        self.viewer = User.objects.create_user(username='viewer', password='password', email='viewer@email.com')
+        self.thread = Thread.create('title', 'first message', self.board, self.author)
+        self.post = Post.create('reply message', self.thread, self.author)
+        self.comment = Comment.create('comment message', self.post, self.viewer)
+        self.url = reverse('forum:thread', kwargs={'thread_pk': self.thread.pk, 'page': ''})
+
+    def get_page(self, username):
+        self.client.login(username=username, password='password')
+        return self.client.get(self.url).content.decode()
+
+    def test_fragments_are_cached(self):
+        self.get_page('viewer')
+        # changes made without saving models are not seen until fragments are invalidated
+        GenericPost.objects.filter(pk=self.post.pk).update(message='changed message')
+        GenericPost.objects.filter(pk=self.comment.pk).update(message='changed comment')
+        content = self.get_page('viewer')
+        self.assertIn('reply message', content)
+        self.assertIn('comment message', content)
+        self.post.refresh_from_db()
+        self.post.save()
+        content = self.get_page('viewer')
+        self.assertIn('changed message', content)
+        self.assertIn('comment message', content)
+
+    def test_votes_update_author(self):
+        self.get_page('viewer')
+        Vote.vote(self.post, self.viewer, True)
+        content = self.get_page('viewer')
+        self.assertIn('<span class="glyphicon glyphicon-star"></span> 1</a>', content)
+
+    def test_viewer_controls_are_not_cached(self):
+        delete_url = reverse('forum:del_post', kwargs={'post_pk': self.post.pk})
+        self.assertNotIn(delete_url, self.get_page('viewer'))
+        self.assertIn(delete_url, self.get_page('author'))
+        self.assertNotIn(delete_url, self.get_page('viewer'))
+
+    def test_roles_update_badges(self):
+        self.assertNotIn('</span> moderator<br/>', self.get_page('viewer'))
+        Moderation.objects.create(user=self.author, board=self.board)
+        self.assertIn('</span> moderator<br/>', self.get_page('viewer'))
+
+
+@override_settings(PAGE_CACHE=True)
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.board = Board.create('board name', 'bcode')
+        self.author = User.objects.create_user(username='author', password='password', email='author@email.com')
+        self.viewer = User.objects.create_user(username='viewer', password='password', email='viewer@email.com')
+        self.thread = Thread.create('title', 'first message', self.board, self.author)
+        self.post = Post.create('reply message', self.thread, self.author)
+        self.thread_url = reverse('forum:thread', kwargs={'thread_pk': self.thread.pk, 'page': ''})
+        self.board_url = reverse('forum:board', kwargs={'board_code': 'bcode', 'page': ''})
+
+    def get_page(self, username, url):
+        self.client.login(username=username, password='password')
+        with CaptureQueriesContext(connection) as queries:
+            content = self.client.get(url).content.decode()
+        return content, len(queries)
+
+    def test_viewer_parts_are_stitched(self):
+        content, misses = self.get_page('author', self.thread_url)
+        self.assertIn('>author</a> | <a', content)
+        self.assertIn('Delete Thread', content)
+        self.assertNotIn('<esi:include', content)
+        content, hits = self.get_page('viewer', self.thread_url)
+        self.assertLess(hits, misses)
+        self.assertIn('>viewer</a> | <a', content)
+        self.assertNotIn('>author</a> | <a', content)
+        self.assertNotIn('Delete Thread', content)
+        self.assertIn("name='csrfmiddlewaretoken'", content)
+        self.assertNotIn('<esi:include', content)
+
+    def test_pages_are_purged(self):
+        self.get_page('viewer', self.board_url)
+        self.get_page('viewer', self.thread_url)
+        other = Thread.create('other thread', 'message', self.board, self.author)
+        self.assertIn('other thread', self.get_page('viewer', self.board_url)[0])
+        Post.create('new reply', self.thread, self.author)
+        self.assertIn('new reply', self.get_page('viewer', self.thread_url)[0])
+        Comment.create('new comment', self.post, self.viewer)
+        self.assertIn('new comment', self.get_page('viewer', self.thread_url)[0])
+        Vote.vote(self.thread.first_post, self.viewer, True)
+        self.assertIn('<span class="glyphicon glyphicon-triangle-top"></span> 1',
+                      self.get_page('viewer', self.board_url)[0])
+        other.remove()
+        self.assertNotIn('other thread', self.get_page('viewer', self.board_url)[0])
+
+    def test_votes_purge_without_queries(self):
+        comment = Comment.create('comment', self.post, self.viewer)
+        posts = GenericPost.objects.select_related('post__thread', 'comment__post__thread')
+        keys = ['thread:%d' % self.thread.pk, 'board:%d' % self.board.pk]
+        for pk, purged in ((self.thread.first_post_id, keys), (self.post.pk, keys[:1]), (comment.pk, keys[:1])):
+            voted = posts.get(pk=pk)
+            before = get_versions(keys)
+            with self.assertNumQueries(0):
+                pagecache.purge_votes(voted)
+            after = get_versions(keys)
+            self.assertEqual([key for key in keys if after[key] != before[key]], purged)
+        before = get_versions(keys)
+        pagecache.purge_posts([self.thread.first_post_id, comment.pk])
+        after = get_versions(keys)
+        self.assertTrue(all(after[key] != before[key] for key in keys))
+
+    def test_moderators_bypass_cache(self):
+        self.get_page('viewer', self.thread_url)
+        Moderation.objects.create(user=self.viewer, board=self.board)
+        content, queries = self.get_page('viewer', self.thread_url)
+        self.assertIn('Delete Thread', content)
+        self.assertIn('title="stick"', content)
+
+
+class AvatarTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password', email='user@email.com')
+        self.user.avatar = os.path.join('prof_pic', 'user.png')
+        self.user.save()
+        self.default_url = settings.MEDIA_URL + avatars.DEFAULT_AVATAR
+
+    def test_url(self):
+        self.assertEqual(avatars.url(self.user), self.default_url)
+        self.user.has_avatar = True
+        self.assertEqual(avatars.url(self.user), settings.MEDIA_URL + 'prof_pic/user.png')
+        self.user.reset_avatar()
+        self.assertFalse(self.user.has_avatar)
+        self.assertEqual(avatars.url(self.user), self.default_url)
+
+    def test_record_avatar(self):
+        with patch('forum.avatars.default_storage.exists', return_value=True):
+            call_command('refresh_avatars', stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.has_avatar)
+        with patch('forum.avatars.default_storage.exists', return_value=False):
+            call_command('refresh_avatars', stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.has_avatar)
+
+    def make_storage(self, image, image_format='PNG', **options):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = FileSystemStorage(location=directory, base_url=settings.MEDIA_URL)
+        output = BytesIO()
+        image.save(output, image_format, **options)
+        storage.save(self.user.avatar.name, ContentFile(output.getvalue()))
+        return storage
+
+    def test_variants(self):
+        storage = self.make_storage(Image.new('RGBA', (300, 150), (255, 0, 0, 128)))
+        template = Template("{% load forum_extra %}{% avatar_img user 'small' class='img-circle' %}")
+        with patch('forum.avatars.default_storage', storage):
+            self.user.record_avatar()
+            self.user.save()
+            self.assertTrue(self.user.has_avatar)
+            small = avatars.variant_name(self.user.avatar.name, self.user.avatar_hash, 'small', 'jpg')
+            profile = avatars.variant_name(self.user.avatar.name, self.user.avatar_hash, 'profile', 'jpg')
+            with Image.open(storage.path(small)) as image:
+                self.assertEqual((image.format, image.size), ('JPEG', (60, 60)))
+            with Image.open(storage.path(profile)) as image:
+                self.assertEqual(image.size, (300, 150))
+            html = template.render(Context({'user': self.user}))
+            self.assertIn('src="%s%s"' % (settings.MEDIA_URL, small), html)
+            self.assertIn('class="img-circle"', html)
+            with patch('forum.avatars.webp_supported', return_value=True):
+                html = template.render(Context({'user': self.user}))
+            self.assertIn('<source srcset="%s%s" type="image/webp">' % (settings.MEDIA_URL, small[:-3] + 'webp'), html)
+            self.user.reset_avatar()
+            self.assertFalse(storage.exists(small))
+            self.assertEqual(self.user.avatar_hash, '')
+
+    def test_variants_are_upright(self):
+        exif = Image.Exif()
+        exif[avatars.ORIENTATION] = 6
+        storage = self.make_storage(Image.new('RGB', (3000, 1500), (255, 0, 0)), 'JPEG', exif=exif.tobytes())
+        with patch('forum.avatars.default_storage', storage):
+            self.user.record_avatar()
+        profile = avatars.variant_name(self.user.avatar.name, self.user.avatar_hash, 'profile', 'jpg')
+        with Image.open(storage.path(profile)) as image:
+            self.assertEqual(image.size, (200, 400))
+            self.assertNotIn('exif', image.info)
+
+    def test_transpositions(self):
+        image = Image.new('RGB', (4, 3))
+        image.putdata([(num * 20, 0, 0) for num in range(12)])
+        for orientation, methods in avatars.TRANSPOSITIONS.items():
+            exif = Image.Exif()
+            exif[avatars.ORIENTATION] = orientation
+            expected = image.copy()
+            expected.info['exif'] = exif.tobytes()
+            expected = ImageOps.exif_transpose(expected)
+            transposed = image
+            for method in methods:
+                transposed = transposed.transpose(method)
+            self.assertEqual(list(transposed.getdata()), list(expected.getdata()), orientation)
+
+    def test_huge_avatars_are_not_resized(self):
+        storage = self.make_storage(Image.new('P', (300, 300)))
+        with patch('forum.avatars.default_storage', storage), patch('forum.avatars.MAX_PIXELS', 300 * 299):
+            self.user.record_avatar()
+        self.assertTrue(self.user.has_avatar)
+        self.assertEqual(self.user.avatar_hash, '')
+        with patch('forum.avatars.default_storage', storage):
+            self.user.record_avatar()
+        self.assertNotEqual(self.user.avatar_hash, '')
+
+    def test_pages_do_not_check_files(self):
+        board = Board.create('board name', 'bcode')
+        thread = Thread.create('title', 'first message', board, self.user)
+        Comment.create('comment message', thread.first_post, self.user)
+        self.user.has_avatar = True
+        self.user.save()
+        self.client.login(username='user', password='password')
+        with patch('forum.avatars.default_storage.exists', side_effect=AssertionError('file checked')):
+            content = self.client.get(reverse('forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}))
+        self.assertContains(content, 'src="%sprof_pic/user.png"' % settings.MEDIA_URL)
+
+
 class CreateBoardTest(TestCase):
     def test_view_with_anonymous_user(self):
         response = self.client.get(reverse('forum:create_board'), follow=True)
@@ -131,3 +1104,12 @@ class ThreadViewTest(TestCase):
         thread = Thread.create('thread title', 'thread message', board, author)
         response = self.client.get(reverse('forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}), follow=True)
         self.assertEqual(response.status_code, 200)
+
+    def test_thread_view_with_cursor(self):
+        board = Board.create('boardname', 'bc')
+        author = User.objects.create_user(username='user', password='pass', email='test@email.com')
+        thread = Thread.create('thread title', 'thread message', board, author)
+        self.client.login(username='user', password='pass')
+        response = self.client.get(reverse('forum:thread_after', kwargs={'thread_pk': thread.pk, 'after': '0-0'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['posts']), [thread.first_post])
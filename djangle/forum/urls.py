@@ -12,7 +12,11 @@ urlpatterns = [
     url(r'^create/boardmoderation/(?P<board_code>\w+)/?$', views.manage_board_mod, name='board_mod'),
     url(r'^create/thread/$', views.create_thread, name='create_thread'),
     url(r'^board/(?P<board_code>\w+)/(?P<page>\d*)/?$', views.board_view, name='board'),
+    url(r'^board/(?P<board_code>\w+)/after/(?P<after>[\d\-]+)/$', views.board_view, name='board_after'),
+    url(r'^board/(?P<board_code>\w+)/before/(?P<before>[\d\-]+)/$', views.board_view, name='board_before'),
     url(r'^thread/(?P<thread_pk>\d+)/(?P<page>\d*)/?$', views.thread_view, name='thread'),
+    url(r'^thread/(?P<thread_pk>\d+)/after/(?P<after>[\d\-]+)/$', views.thread_view, name='thread_after'),
+    url(r'^thread/(?P<thread_pk>\d+)/before/(?P<before>[\d\-]+)/$', views.thread_view, name='thread_before'),
     url(r'^post/(?P<post_pk>\d+)/(?P<vote>up)/?$', views.vote_view, name='pos_vote'),
     url(r'^post/(?P<post_pk>\d+)/(?P<vote>down)/?$', views.vote_view, name='neg_vote'),
     url(r'^profile/(?P<username>[\w\+\-@_\.]+)/$', views.profile, name='profile'),
@@ -5,23 +5,28 @@ import operator
 
 import os
 import datetime
-from operator import itemgetter, attrgetter
+from operator import itemgetter
 
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
-from django.db.models import Q
 from django.http import HttpResponseRedirect
 from django.shortcuts import render, get_object_or_404
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Q, Prefetch
 from django.utils import timezone
 
+from . import avatars, fragments, pagecache, payloads, roles
+from .caching import bump_version
 from .decorators import user_passes_test_with_403
-from .models import Board, Thread, Post, Vote, User, Subscription, Moderation, Ban, Comment, GenericPost
-from .tasks import sync_mail, del_mail, ban_create_mail, ban_remove_mail, del_comment_mail
+from .models import Board, Thread, Post, Vote, User, Subscription, Moderation, Ban, Comment, GenericPost, ThreadTag
+from .tasks import sync_mail, del_mail, ban_create_mail, ban_remove_mail, del_comment_mail, expire_ban
 from .forms import PostForm, BoardForm, ThreadForm, UserEditForm, SubscribeForm, AddModeratorForm, AddBanForm, \
     BoardModForm, SearchForm, CommentForm
+from .pagination import KeysetPaginator
+from .queries import index_context
+from .search import search_threads
 
-from djangle.settings import ELEM_PER_PAGE
+from djangle.settings import ELEM_PER_PAGE, BAN_EXPIRY_ETA
 
 
 # Create your views here.
@@ -31,72 +36,72 @@ def index(request):
     """
     view for forum index
 
-    return a list of recently commented threads grouped by board. you can set maximum number of posts to show
-    for each board in function forum.models.get_new
+    return a list of recently commented threads grouped by board. you can set maximum number of threads to show
+    for each board in forum.queries.NEW_THREADS
 
     :param request: the user's request
     :return: render the list of threads
     """
-    board_list = Board.objects.all().order_by('name')
-    return render(request, 'forum/index.html', {'boards': board_list})
+    return render(request, 'forum/index.html', index_context(request.user))
 
 
 @login_required
-def board_view(request, board_code, page):
+@pagecache.cache_page(pagecache.board_keys)
+def board_view(request, board_code, page=None, after=None, before=None):
     """
     view for board
 
     render the threads' list associated with the board. first threads shown are sticky ones, then recently commented
     follow. if threads' number exceeds ELEM_PER_PAGE (set in djangle.settings) they will be paginated as appropriate.
+    pages can be selected by number or by cursor (see forum.pagination).
 
     :param request: the user's request
     :param board_code: code of the board
     :param page: page of threads' list to show
+    :param after: cursor of the thread preceding the page to show
+    :param before: cursor of the thread following the page to show
     :return: render the list of threads in selected page
     """
     board = get_object_or_404(Board, code=board_code)
-    thread_set = board.get_latest()
-    st_threads = []
-    threads = []
-    for thread in thread_set:
-        if thread.sticky:
-            st_threads.append(thread)
-        else:
-            threads.append(thread)
-    thread_set = st_threads + threads
-    paginator = Paginator(thread_set, ELEM_PER_PAGE)
-    try:
-        thread_set = paginator.page(page)
-    except PageNotAnInteger:
-        thread_set = paginator.page(1)
-    except EmptyPage:
-        thread_set = paginator.page(paginator.num_pages)
+    thread_set = board.get_threads().select_related('first_post__author', 'latest_post', 'last_poster')
+    paginator = KeysetPaginator(thread_set, (('sticky', True), ('last_activity', True), ('pk', True)),
+                                ELEM_PER_PAGE, 'listing:board:%d' % board.pk)
+    thread_set = paginator.get_page(page=page, after=after, before=before)
     return render(request, 'forum/board.html', {'board': board, 'thread_set': thread_set})
 
 
 @login_required
-def thread_view(request, thread_pk, page):
+@pagecache.cache_page(pagecache.thread_keys)
+def thread_view(request, thread_pk, page=None, after=None, before=None):
     """
     view for thread
 
     render the post's list in selected thread, ordered from older to newer. if posts' number exceeds ELEM_PER_PAGE
-    (set in djangle.settings) they will be paginated as appropriate.
+    (set in djangle.settings) they will be paginated as appropriate. pages can be selected by number or by cursor (see
+    forum.pagination). posts' authors, comments with their authors and authors' roles are loaded in bulk, so the number
+    of queries doesn't depend on the page's content. parts of the page which don't depend on the viewer are rendered
+    from the cache (see forum.fragments).
 
     :param request: the user's request
     :param thread_pk: primary key of thread
     :param page: page of posts' list to show
+    :param after: cursor of the post preceding the page to show
+    :param before: cursor of the post following the page to show
     :return: render the list of posts in selected page
     """
     errors = []
-    thread = get_object_or_404(Thread, pk=thread_pk)
-    posts = thread.post_set.order_by('pub_date')
-    paginator = Paginator(posts, ELEM_PER_PAGE)
+    thread = get_object_or_404(Thread.objects.select_related('board', 'first_post', 'closer'), pk=thread_pk)
+    post_set = thread.post_set.select_related('author').prefetch_related(
+        Prefetch('reply', queryset=Comment.objects.select_related('author').order_by('pub_date', 'pk')))
+    # posts' ordinals give page numbers directly, so no boundaries table is built for threads
+    paginator = KeysetPaginator(post_set, (('pub_date', False), ('pk', False)), ELEM_PER_PAGE, position='ordinal',
+                                count=thread.post_count)
     if request.method == 'POST':
         form = PostForm(request.POST)
         if form.is_valid():
             try:
                 post = Post.create(message=form.cleaned_data['message'], thread=thread, author=request.user)
-                sync_mail.delay(post)
+                sync_mail.delay(payloads.dump(post, *payloads.POST))
             except (TypeError, ValueError) as error:
                 errors.append(str(error))
                 return render(request, 'errors.html', {'errors': errors})
@@ -105,14 +110,11 @@ def thread_view(request, thread_pk, page):
                                         '#bottom')
     else:
         form = PostForm()
-    try:
-        post_list = paginator.page(page)
-    except PageNotAnInteger:
-        post_list = paginator.page(1)
-    except EmptyPage:
-        post_list = paginator.page(paginator.num_pages)
+    post_list = paginator.get_page(page=page, after=after, before=before)
+    badges = roles.badges([post.author for post in post_list], thread.board)
     comment_form = CommentForm()
-    return render(request, 'forum/thread.html', {'thread': thread, 'posts': post_list,
+    return render(request, 'forum/thread.html', {'thread': thread, 'posts': post_list, 'badges': badges,
+                                                 'fragments': fragments.thread_fragments(post_list, thread.board),
                                                  'form': form, 'comment_form': comment_form})
 
 
@@ -154,7 +156,8 @@ def vote_view(request, post_pk, vote):
     :return: redirect to updated post.
     """
     redirect_to = request.REQUEST.get('next', '')
-    post = get_object_or_404(GenericPost, pk=post_pk)
+    # thread is loaded with the post, so that its cached pages are purged without queries
+    post = get_object_or_404(GenericPost.objects.select_related('post__thread', 'comment__post__thread'), pk=post_pk)
     if vote == 'up':
         Vote.vote(post=post, user=request.user, value=True)
     elif vote == 'down':
@@ -214,13 +217,15 @@ def profile(request, username):
     top_threads = []
     posts = []
     top_posts = []
-    if Post.objects.filter(author=user).exists():
-        for post in Post.objects.filter(author=user):
+    user_posts = list(Post.objects.filter(author=user).select_related('thread__first_post'))
+    if user_posts:
+        pages = Post.get_pages(user_posts)
+        for post in user_posts:
             votes = post.pos_votes - post.neg_votes
-            if post.pk == post.thread.first_post.pk:
+            if post.pk == post.thread.first_post_id:
                 threads.append((post.thread, votes))
             else:
-                posts.append((post, votes, post.get_page))
+                posts.append((post, votes, pages[post.pk]))
         posts.sort(key=itemgetter(1), reverse=True)
         top_posts = posts[:5]
         threads.sort(key=itemgetter(1), reverse=True)
@@ -241,16 +246,17 @@ def del_post(request, post_pk):
     """
     post = get_object_or_404(Post, pk=post_pk)
     if (request.user.username == post.author.username) or\
-            request.user.moderation_set.filter(board=post.thread.board).exists() or\
+            post.thread.board in request.user.modded_boards() or\
             request.user.is_supermod():
         if post.thread.first_post == post:
             thread = post.thread
-            del_mail.delay(thread.first_post, thread)
+            del_mail.delay(payloads.dump(thread.first_post, *payloads.POST),
+                           payloads.dump(thread, *payloads.THREAD))
             thread.remove()
             return HttpResponseRedirect(reverse('forum:board', kwargs={'board_code': thread.board.code, 'page': ''}))
         else:
             redirect_to = request.GET.get('next', '')
-            del_mail.delay(post)
+            del_mail.delay(payloads.dump(post, *payloads.POST))
             post.remove()
             return HttpResponseRedirect(redirect_to)
     raise PermissionError
@@ -289,10 +295,11 @@ def del_comment(request, comment_pk):
     """
     comm = get_object_or_404(Comment, pk=comment_pk)
     if (request.user.username == comm.author.username) or\
-            request.user.moderation_set.filter(board=comm.post.thread.board).exists() or\
+            comm.post.thread.board in request.user.modded_boards() or\
             request.user.is_supermod():
-        del_comment_mail.delay(comm)
+        del_comment_mail.delay(payloads.dump(comm, *payloads.COMMENT))
         comm.delete()
+        bump_version('thread:%d' % comm.post.thread_id)
         redirect_to = request.GET.get('next', '')
         return HttpResponseRedirect(redirect_to)
     raise PermissionError
@@ -333,6 +340,7 @@ def edit_profile(request):
                     image.name = request.user.username + '.' + extension
                     image.name = request.user.username + '.' + extension
                     if not request.user.avatar.name.endswith('Djangle_user_default.png'):
+                        avatars.delete_variants(request.user.avatar.name, request.user.avatar_hash)
                         img_del = request.user.avatar.path
                         try:
                             os.remove(img_del)
@@ -342,7 +350,10 @@ def edit_profile(request):
                             errors.append(str(error))
                             return render(request, 'errors.html', {'errors': errors})
                     request.user.avatar = image
+                    # the uploaded file is written to the storage when the user is saved, then it's resized
                     request.user.save()
+                    request.user.record_avatar()
+                    request.user.save(update_fields=['has_avatar', 'avatar_hash'])
                 else:
                     errors.append('image must end with .jpg, .jpeg, .gif or .png')
 
@@ -438,14 +449,15 @@ def toggle_close_thread(request, thread_pk):
     """
     thread = get_object_or_404(Thread, pk=thread_pk)
     if (thread.first_post.author.username == request.user.username or
-            request.user.moderation_set.filter(board=thread.board).exists() or
+            thread.board in request.user.modded_boards() or
             request.user.is_supermod()):
         if thread.is_closed():
             thread.close_date = None
         else:
             thread.close_date = timezone.now()
             thread.closer = request.user
-        thread.save()
+        thread.save(update_fields=['close_date', 'closer'])
+        bump_version('thread:%d' % thread.pk, 'board:%d' % thread.board_id)
     return HttpResponseRedirect(reverse('forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}))
 
 
@@ -512,7 +524,9 @@ def ban_user(request, user_pk):
             ban.save()
             user.is_active = False
             user.save()
-            ban_create_mail.delay(ban)
+            ban_create_mail.delay(payloads.dump(ban, *payloads.BAN))
+            if BAN_EXPIRY_ETA and ban.expires_at is not None:
+                expire_ban.apply_async((ban.pk,), eta=ban.expires_at)
             if ban_old:
                 ban_old.delete()
             return HttpResponseRedirect(reverse('forum:profile', kwargs={'username': user.username}))
@@ -535,7 +549,7 @@ def unban_user(request, user_pk):
     user = get_object_or_404(User, pk=user_pk)
     ban = Ban.objects.filter(user=user).last()
     ban.remove()
-    ban_remove_mail.delay(user)
+    ban_remove_mail.delay(payloads.dump(user, *payloads.USER))
     return HttpResponseRedirect(reverse('forum:profile', kwargs={'username': user.username}))
 
 
@@ -549,10 +563,8 @@ def manage_supermods(request):
     :param request: the user's request
     :return: render supermoderators' list
     """
-    supermods = []
-    for user in User.objects.exclude(username='admin'):
-        if user.is_supermod():
-            supermods.append(user)
+    supermods = User.objects.exclude(username='admin').filter(Q(is_superuser=True) | Q(groups__name='supermod'))
+    supermods = supermods.distinct()
     return render(request, 'forum/supermods.html', {'supermods': supermods})
 
 
@@ -589,10 +601,11 @@ def stick_thread(request, thread_pk):
     thread = get_object_or_404(Thread, pk=thread_pk)
     if thread.sticky:
         thread.sticky = False
-        thread.save()
+        thread.save(update_fields=['sticky'])
     else:
         thread.sticky = True
-        thread.save()
+        thread.save(update_fields=['sticky'])
+    bump_version('thread:%d' % thread.pk, 'board:%d' % thread.board_id, 'listing:board:%d' % thread.board_id)
     return HttpResponseRedirect(reverse('forum:thread', kwargs={'thread_pk': thread.pk, 'page': ''}))
 
 
@@ -607,7 +620,7 @@ def moderators_view(request):
     :return: render the list of moderators for each board
     """
     moderators = {}
-    for board in Board.objects.all():
+    for board in Board.objects.prefetch_related('moderation_set__user'):
         moderators[board] = board.moderation_set.all()
     boards = sorted(list(moderators.keys()), key=lambda name: operator.attrgetter('name')(name).lower(), reverse=False)
     return render(request, 'forum/moderators.html', {'moderators': moderators, 'boards': boards})
@@ -674,23 +687,18 @@ def tag_view(request, tag, page):
     :param page: page of threads' list to show
     :return: render the list of threads in selected page
     """
-    threads = Thread.objects.filter(Q(tag1=tag) | Q(tag2=tag) | Q(tag3=tag))
-    posts = []
-    for thread in threads:
-        if thread.last_post() is not None:
-            posts.append(thread.last_post())
-    posts = sorted(posts, key=attrgetter('pub_date'), reverse=True)
-    threads = []
-    for post in posts:
-        threads.append(post.thread)
-    paginator = Paginator(threads, ELEM_PER_PAGE)
+    thread_tags = ThreadTag.objects.filter(tag__name=tag, last_activity__isnull=False)
+    thread_tags = thread_tags.select_related('thread__first_post__author', 'thread__latest_post',
+                                             'thread__last_poster').order_by('-last_activity', '-thread')
+    paginator = Paginator(thread_tags, ELEM_PER_PAGE)
     try:
         threads = paginator.page(page)
     except PageNotAnInteger:
         threads = paginator.page(1)
     except EmptyPage:
         threads = paginator.page(paginator.num_pages)
-    return render(request, 'forum/search_threads.html', {'search': 'Tag = ' + tag, 'threads': threads})
+    threads.object_list = [thread_tag.thread for thread_tag in threads.object_list]
+    return render(request, 'forum/tag.html', {'tag': tag, 'threads': threads})
 
 
 @login_required
@@ -734,32 +742,25 @@ def search(request, page):
                                                                      'threads': threads,
                                                                      'page': page,
                                                                      'errors': ['empty form']})
-            threads = Thread.objects.all()
             if form.cleaned_data['title']:
-                title = form.cleaned_data['title']
-                threads = threads.filter(title__icontains=title)
-                search_message = 'Title : ' + title
+                search_message = 'Title : ' + form.cleaned_data['title']
             if form.cleaned_data['tag']:
-                tags = form.cleaned_data['tag']
-                threads = threads.filter(Q(tag1__icontains=tags) | Q(tag2__icontains=tags) | Q(tag3__icontains=tags))
-                search_message += ' Tag : ' + tags
+                search_message += ' Tag : ' + form.cleaned_data['tag']
             if form.cleaned_data['username']:
-                username = form.cleaned_data['username']
-                threads = threads.filter(first_post__author__username__icontains=username)
-                search_message += ' Author : ' + username
-            posts = []
-            for thread in threads:
-                if thread.last_post() is not None:
-                    posts.append(thread.last_post())
-            posts = sorted(posts, key=attrgetter('pub_date'), reverse=True)
-            threads = [post.thread for post in posts]
-            paginator = Paginator(threads, ELEM_PER_PAGE)
+                search_message += ' Author : ' + form.cleaned_data['username']
+            results = search_threads(title=form.cleaned_data['title'], tag=form.cleaned_data['tag'],
+                                     username=form.cleaned_data['username'])
+            paginator = Paginator(results, ELEM_PER_PAGE)
             try:
                 threads = paginator.page(page)
             except PageNotAnInteger:
                 threads = paginator.page(1)
             except EmptyPage:
                 threads = paginator.page(paginator.num_pages)
+            pks = [result['thread'] for result in threads.object_list]
+            found = Thread.objects.filter(pk__in=pks).select_related('first_post__author', 'latest_post',
+                                                                     'last_poster').in_bulk(pks)
+            threads.object_list = [found[pk] for pk in pks if pk in found]
         return render(request, 'forum/search_threads.html',
                       {'search': search_message, 'threads': threads, 'page': page})
     return render(request, 'forum/create.html', {'forms': [form], 'object': 'search'})
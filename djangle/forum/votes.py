@@ -0,0 +1,121 @@
+"""
+module for votes' counters aggregation
+
+by default Vote.vote updates post's counters and author's reputation in the same transaction of the vote. when
+ASYNC_VOTES is set (see djangle.settings) votes only append their effect to the votes log (see forum.models.VoteDelta)
+and the fold_votes task periodically adds the pending deltas to the counters, with one UPDATE for many posts or users,
+so that popular posts and authors are not written by every single vote.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum, Case, When, Value, IntegerField
+from . import fragments, pagecache
+
+UPDATE_CHUNK = 500
+"""
+maximum number of rows changed by a single UPDATE
+"""
+
+
+def is_async():
+    """
+    return whether votes' counters are updated asynchronously
+
+    :return: value of ASYNC_VOTES setting
+    """
+    return getattr(settings, 'ASYNC_VOTES', False)
+
+
+def add_to_counters(model, deltas):
+    """
+    add values to integer columns of many rows
+
+    rows are changed by UPDATE queries selecting the value to add to each row with a CASE expression, so the cost does
+    not depend on the number of rows (up to UPDATE_CHUNK of them per query)
+
+    :param model: model of the rows
+    :param deltas: dictionary mapping primary keys to dictionaries of {column: value to add}
+    :return: nothing
+    """
+    pks = sorted(deltas)
+    fields = set(field for delta in deltas.values() for field in delta)
+    for start in range(0, len(pks), UPDATE_CHUNK):
+        chunk = pks[start:start + UPDATE_CHUNK]
+        changes = {}
+        for field in fields:
+            whens = [When(pk=pk, then=Value(deltas[pk][field])) for pk in chunk if deltas[pk].get(field)]
+            if whens:
+                output_field = model._meta.get_field(field).__class__()
+                changes[field] = F(field) + Case(*whens, default=Value(0), output_field=output_field)
+        if changes:
+            model.objects.filter(pk__in=chunk).update(**changes)
+
+
+def fold_votes():
+    """
+    add pending votes' deltas to posts' counters and authors' reputation
+
+    pending deltas are locked and their primary keys read once, then exactly those deltas are summed by the database,
+    grouped by post and by author, applied and removed in a single transaction: a delta committed while folding is left
+    for the next run, never deleted without being counted
+
+    :return: number of folded deltas
+    """
+    from .models import GenericPost, User, VoteDelta
+    with transaction.atomic():
+        pks = list(VoteDelta.objects.select_for_update().order_by('pk').values_list('pk', flat=True))
+        if not pks:
+            return 0
+        posts = {}
+        users = {}
+        for start in range(0, len(pks), UPDATE_CHUNK):
+            pending = VoteDelta.objects.filter(pk__in=pks[start:start + UPDATE_CHUNK])
+            for row in pending.values('post').annotate(pos=Sum('pos'), neg=Sum('neg')):
+                delta = posts.setdefault(row['post'], {'pos_votes': 0, 'neg_votes': 0})
+                delta['pos_votes'] += row['pos']
+                delta['neg_votes'] += row['neg']
+            for row in pending.values('author').annotate(pos=Sum('pos'), neg=Sum('neg')):
+                delta = users.setdefault(row['author'], {'rep': 0})
+                delta['rep'] += row['pos'] - row['neg']
+        add_to_counters(GenericPost, posts)
+        add_to_counters(User, users)
+        for start in range(0, len(pks), UPDATE_CHUNK):
+            VoteDelta.objects.filter(pk__in=pks[start:start + UPDATE_CHUNK]).delete()
+    fragments.invalidate_users(*users)
+    pagecache.purge_posts(posts)
+    return len(pks)
+
+
+def reconcile_votes():
+    """
+    recompute posts' counters and authors' reputation from votes
+
+    pending deltas are dropped, since their votes are already counted. only rows whose values differ are updated.
+    votes given while reconciling may be counted twice or not at all, so run it when the forum is quiet.
+
+    :return: number of changed posts and number of changed users
+    """
+    from .models import GenericPost, User, Vote, VoteDelta
+    positive = Sum(Case(When(value=True, then=Value(1)), default=Value(0), output_field=IntegerField()))
+    negative = Sum(Case(When(value=False, then=Value(1)), default=Value(0), output_field=IntegerField()))
+    with transaction.atomic():
+        VoteDelta.objects.all().delete()
+        posts = dict((row['post'], (row['pos'], row['neg'])) for row in
+                     Vote.objects.values('post').annotate(pos=positive, neg=negative))
+        users = {}
+        for row in Vote.objects.values('post__author').annotate(pos=positive, neg=negative):
+            users[row['post__author']] = row['pos'] - row['neg']
+        post_deltas = {}
+        for pk, pos_votes, neg_votes in GenericPost.objects.values_list('pk', 'pos_votes', 'neg_votes').iterator():
+            pos, neg = posts.get(pk, (0, 0))
+            if (pos, neg) != (pos_votes, neg_votes):
+                post_deltas[pk] = {'pos_votes': pos - pos_votes, 'neg_votes': neg - neg_votes}
+        user_deltas = {}
+        for pk, rep in User.objects.values_list('pk', 'rep').iterator():
+            if users.get(pk, 0) != rep:
+                user_deltas[pk] = {'rep': users.get(pk, 0) - rep}
+        add_to_counters(GenericPost, post_deltas)
+        add_to_counters(User, user_deltas)
+    fragments.invalidate_users(*user_deltas)
+    pagecache.purge_posts(post_deltas)
+    return len(post_deltas), len(user_deltas)